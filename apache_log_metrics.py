@@ -7,14 +7,26 @@
 """Script to upload metrics from apache logs to Monarch.
 
 We are interested in static file bandwidth, so it parses out GET requests to
-/static and uploads the sizes to a cumulative metric.
+/static and uploads the sizes to a cumulative metric. The sizes of all
+successful RPC requests are uploaded to another metric.
+
+Each line is parsed by one regex and dispatched by its URL path. The sizes are
+summed up in memory per set of metric fields, and emitted every flush window
+instead of once per request. Rotated logs can be replayed by --replay, which
+splits them into shards and aggregates the shards by a pool of processes.
 """
 from __future__ import print_function
 
 import argparse
-import functools
+import binascii
+import bisect
+import collections
+import gzip
 from logging import handlers
+import multiprocessing
+import os
 import re
+import socket
 import sys
 
 # TODO(ayatane): Fix cros lint pylint to work with virtualenv imports
@@ -23,32 +35,36 @@ import sys
 # only import setup_chromite before chromite import.
 import setup_chromite # pylint: disable=unused-import
 from chromite.lib import ts_mon_config
-from chromite.lib import metrics
 from chromite.lib import cros_logging as logging
 
+# Imports chromite, so after setup_chromite.
+import log_metrics_pipeline
+
 # Log rotation parameters.  Keep about two weeks of old logs.
 #
 # For more, see the documentation in standard python library for
 # logging.handlers.TimedRotatingFileHandler
 _LOG_ROTATION_TIME = 'H'
-_LOG_ROTATION_INTERVAL = 24 # hours
-_LOG_ROTATION_BACKUP = 14 # backup counts
+_LOG_ROTATION_INTERVAL = 24  # hours
+_LOG_ROTATION_BACKUP = 14  # backup counts
+
 
+# Matcher of all request log lines, e.g.
+# <ip addr> - - [datetime] "GET /list_suite_controls?key=val HTTP/1.1" 200...
+LINE_MATCHER = re.compile(
+    r'^(?P<ip_addr>[\da-fA-F.:]+) '
+    r'[^"]*"(?P<http_method>\S+) /(?P<path>\S*)[^"]*" '
+    r'(?P<status>\d\d\d) (?P<size>\S+) ')
 
-STATIC_GET_MATCHER = re.compile(
-    r'^(?P<ip_addr>\d+\.\d+\.\d+\.\d+) '
-    r'.*GET /static/(?P<endpoint>\S*)[^"]*" '
-    r'200 (?P<size>\S+) .*')
-# Matcher of all RPC calls log lines, e.g.
-# <ipv4 addr> - - [datetime] "GET /list_suite_controls?key=val HTTP/1.1" 200...
-RPC_USAGE_MATCHER = re.compile(
-    r'^(?P<ip_addr>\d+\.\d+\.\d+\.\d+) '
-    r'.*"(?P<http_method>\S+) /(?P<rpc_name>(?:api/)?[^/?]+)[^"]*" '
-    r'2\d\d (?P<size>\S+) .*')
+_STATIC_PREFIX = 'static/'
+_API_PREFIX = 'api/'
 
 STATIC_GET_METRIC_NAME = 'chromeos/devserver/apache/static_response_size'
 DEVSERVER_RPC_USAGE_METRIC_NAME = 'chromeos/devserver/rpc_usage'
 
+# Rotated logs are split into shards of this size to be replayed in parallel.
+_SHARD_SIZE = 64 * 1024 * 1024  # bytes
+
 
 LAB_SUBNETS = (
     ("172.17.40.0", 22),
@@ -65,39 +81,158 @@ LAB_SUBNETS = (
     ("100.107.126.0", 25),
 )
 
-def IPToNum(ip):
-  """Returns the integer represented by an IPv4 string.
+_ADDRESS_BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+# The prefix of IPv4-mapped IPv6 addresses, e.g. ::ffff:100.115.128.1.
+_IPV4_MAPPED_PREFIX = 0xffff << 32
+# The max number of client addresses whose lookup results are cached.
+_DEFAULT_CACHE_SIZE = 4096
+
+
+def ParseAddress(ip):
+  """Parses an IPv4 or IPv6 address string.
+
+  An IPv4-mapped IPv6 address is parsed as the IPv4 address.
 
   Args:
-    ip: An IPv4-formatted string.
+    ip: An IPv4 or IPv6 address string.
+
+  Returns:
+    A tuple of the address family and the address as an integer.
+
+  Raises:
+    ValueError if |ip| isn't a valid address.
   """
-  return functools.reduce(lambda seed, x: seed * 2**8 + int(x),
-                          ip.split('.'),
-                          0)
+  family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+  try:
+    value = int(binascii.hexlify(socket.inet_pton(family, ip)), 16)
+  except (socket.error, ValueError):
+    raise ValueError('Invalid IP address: %r' % ip)
+  if family == socket.AF_INET6 and value >> 32 == _IPV4_MAPPED_PREFIX >> 32:
+    return socket.AF_INET, value & 0xffffffff
+  return family, value
+
 
+class SubnetTable(object):
+  """A table of subnets, which looks up an address by a bisection.
 
-def MatchesSubnet(ip, base, mask):
-  """Whether the ip string |ip| matches the subnet |base|, |mask|.
+  The subnets are merged into sorted disjoint intervals of addresses per
+  address family. The lookup results of recent addresses are cached, since
+  the clients of a devserver are mostly the same few hosts.
+  """
+
+  def __init__(self, subnets, cache_size=_DEFAULT_CACHE_SIZE):
+    """Constructor.
+
+    Args:
+      subnets: An iterable of (base address, prefix length) pairs of IPv4 or
+        IPv6 subnets.
+      cache_size: The max number of addresses whose lookup results are cached.
+
+    Raises:
+      ValueError if a subnet is invalid.
+    """
+    intervals = collections.defaultdict(list)
+    for base, prefix_len in subnets:
+      family, value = ParseAddress(base)
+      host_bits = _ADDRESS_BITS[family] - prefix_len
+      if not 0 <= host_bits <= _ADDRESS_BITS[family]:
+        raise ValueError('Invalid prefix length of %s: %d' % (base, prefix_len))
+      start = value >> host_bits << host_bits
+      intervals[family].append((start, start + (1 << host_bits) - 1))
+
+    # Address family => the sorted starts and ends of the intervals.
+    self._starts = {}
+    self._ends = {}
+    for family, ranges in intervals.iteritems():
+      merged = []
+      for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+          merged[-1][1] = max(merged[-1][1], end)
+        else:
+          merged.append([start, end])
+      self._starts[family] = [start for start, _ in merged]
+      self._ends[family] = [end for _, end in merged]
+
+    self._cache = collections.OrderedDict()
+    self._cache_size = cache_size
+
+  def Contains(self, ip):
+    """Whether address string |ip| is in any subnet of the table.
+
+    Invalid addresses are in no subnet.
+    """
+    try:
+      result = self._cache.pop(ip)
+    except KeyError:
+      result = self._Lookup(ip)
+      if len(self._cache) >= self._cache_size:
+        self._cache.popitem(last=False)
+    self._cache[ip] = result
+    return result
+
+  def _Lookup(self, ip):
+    try:
+      family, value = ParseAddress(ip)
+    except ValueError:
+      return False
+    starts = self._starts.get(family)
+    if not starts:
+      return False
+    i = bisect.bisect_right(starts, value) - 1
+    return i >= 0 and value <= self._ends[family][i]
+
+
+def LoadSubnets(path):
+  """Loads subnets from a file.
+
+  Each line of the file is a subnet in the CIDR notation, e.g.
+  100.115.128.0/17 or 2401:fa00:480::/48. A line without a prefix length is a
+  single address. Blank lines and comments starting with '#' are ignored.
 
   Args:
-    ip: An IPv4 string.
-    base: An IPv4 string which is the lowest value in the subnet.
-    mask: The number of bits which are not wildcards in the subnet.
+    path: The path of the file.
+
+  Returns:
+    A list of (base address, prefix length) pairs.
+
+  Raises:
+    ValueError if a line isn't a valid subnet.
   """
-  ip_value = IPToNum(ip)
-  base_value = IPToNum(base)
-  mask = (2**mask - 1) << (32 - mask)
-  return (ip_value & mask) == (base_value & mask)
+  subnets = []
+  with open(path) as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+      if not line:
+        continue
+      base, _, prefix_len = line.partition('/')
+      if prefix_len:
+        prefix_len = int(prefix_len)
+      else:
+        prefix_len = _ADDRESS_BITS[ParseAddress(base)[0]]
+      subnets.append((base, prefix_len))
+  return subnets
+
+
+_lab_subnets = SubnetTable(LAB_SUBNETS)
+
+
+def AddLabSubnets(subnets):
+  """Adds |subnets| to the subnets of the ChromeOS Lab.
+
+  Args:
+    subnets: A list of (base address, prefix length) pairs.
+  """
+  global _lab_subnets  # pylint: disable=global-statement
+  _lab_subnets = SubnetTable(list(LAB_SUBNETS) + list(subnets))
 
 
 def InLab(ip):
-  """Whether |ip| is an IPv4 address which is in the ChromeOS Lab.
+  """Whether |ip| is an IPv4 or IPv6 address which is in the ChromeOS Lab.
 
   Args:
-    ip: An IPv4 address to be tested.
+    ip: An IP address to be tested.
   """
-  return any(MatchesSubnet(ip, base, mask)
-             for (base, mask) in LAB_SUBNETS)
+  return _lab_subnets.Contains(ip)
 
 
 MILESTONE_PATTERN = re.compile(r'R\d+')
@@ -156,68 +291,145 @@ def ParseStaticEndpoint(endpoint):
   return build_config, milestone, filename
 
 
-def EmitStaticRequestMetric(m):
-  """Emits a Counter metric for successful GETs to /static endpoints.
+def _ParseSize(size):
+  """Parses the response size field, where zero is represented by "-"."""
+  try:
+    return int(size)
+  except ValueError:
+    return 0
+
+
+def _RpcName(path):
+  """Gets the RPC name of URL |path|, e.g. 'update' or 'api/hostinfo'.
 
   Args:
-    m: A regex match object
+    path: The URL path without the leading '/'.
   """
-  build_config, milestone, filename = ParseStaticEndpoint(m.group('endpoint'))
+  prefix = ''
+  if path.startswith(_API_PREFIX):
+    prefix, path = _API_PREFIX, path[len(_API_PREFIX):]
+  name = path.split('?', 1)[0].split('/', 1)[0]
+  if not name:
+    # e.g. '/api/?key=val' is the RPC 'api'.
+    return prefix.rstrip('/')
+  return prefix + name
 
-  try:
-    size = int(m.group('size'))
-  except ValueError:  # Zero is represented by "-"
-    size = 0
 
-  metrics.Counter(STATIC_GET_METRIC_NAME).increment_by(
-      size, fields={
-          'build_config': build_config,
-          'milestone': milestone,
-          'in_lab': InLab(m.group('ip_addr')),
-          'endpoint': filename})
+def ClassifyLine(line):
+  """Classifies a line of the apache log into metric updates.
 
+  Args:
+    line: A line of the apache log.
 
-def EmitRpcUsageMetric(m):
-  """Emits a Counter metric for successful RPC requests.
+  Returns:
+    A list of (metric name, fields, size) tuples, where fields is a tuple of
+    sorted (field name, value) pairs.
+  """
+  m = LINE_MATCHER.match(line)
+  if not m or not m.group('status').startswith('2'):
+    return []
+
+  path = m.group('path')
+  rpc_name = _RpcName(path)
+  if not rpc_name:
+    return []
+
+  size = _ParseSize(m.group('size'))
+  in_lab = InLab(m.group('ip_addr'))
+  http_method = m.group('http_method')
+  updates = [(DEVSERVER_RPC_USAGE_METRIC_NAME,
+              (('http_method', http_method),
+               ('in_lab', in_lab),
+               ('rpc_name', rpc_name)),
+              size)]
+
+  if (http_method == 'GET' and m.group('status') == '200' and
+      path.startswith(_STATIC_PREFIX)):
+    build_config, milestone, filename = ParseStaticEndpoint(
+        path[len(_STATIC_PREFIX):])
+    updates.append((STATIC_GET_METRIC_NAME,
+                    (('build_config', build_config),
+                     ('endpoint', filename),
+                     ('in_lab', in_lab),
+                     ('milestone', milestone)),
+                    size))
+  return updates
+
+
+def _NewAggregator():
+  """Creates an aggregator of the lines of the apache log."""
+  return log_metrics_pipeline.Aggregator(ClassifyLine)
+
+
+def _Shards(paths, shard_size=_SHARD_SIZE):
+  """Splits log files into shards.
+
+  Gzipped files can't be read from the middle, so each is a shard.
 
   Args:
-    m: A regex match object
+    paths: A list of paths of log files.
+    shard_size: The size of a shard of uncompressed files.
+
+  Returns:
+    A list of (path, start, end) tuples. A shard has the lines starting in the
+    byte range [start, end) of the file. end is None for the end of the file.
   """
-  try:
-    size = int(m.group('size'))
-  except ValueError:  # Zero is represented by "-"
-    size = 0
+  shards = []
+  for path in paths:
+    if path.endswith('.gz'):
+      shards.append((path, 0, None))
+      continue
+    size = os.path.getsize(path)
+    starts = range(0, size, shard_size) or [0]
+    shards.extend((path, start, start + shard_size) for start in starts)
+  return shards
+
 
-  metrics.Counter(DEVSERVER_RPC_USAGE_METRIC_NAME).increment_by(
-      size, fields={
-          'http_method': m.group('http_method'),
-          'rpc_name': m.group('rpc_name'),
-          'in_lab': InLab(m.group('ip_addr')),
-      })
+def _AggregateShard(shard):
+  """Aggregates the lines of a shard of a log file.
 
+  Args:
+    shard: A (path, start, end) tuple. See _Shards.
 
-def RunMatchers(stream, matchers):
-  """Parses lines of |stream| using patterns and emitters from |matchers|
+  Returns:
+    A tuple of the aggregated counts and the number of lines.
+  """
+  path, start, end = shard
+  aggregator = _NewAggregator()
+  if path.endswith('.gz'):
+    with gzip.open(path) as f:
+      for line in f:
+        aggregator.add_line(line)
+    return aggregator.counts, aggregator.lines
+
+  with open(path) as f:
+    if start:
+      # The line across the start belongs to the previous shard.
+      f.seek(start - 1)
+      f.readline()
+    while f.tell() < end:
+      line = f.readline()
+      if not line:
+        break
+      aggregator.add_line(line)
+  return aggregator.counts, aggregator.lines
+
+
+def Replay(paths, workers=None):
+  """Emits the metrics of rotated log files.
 
   Args:
-    stream: A file object to read from.
-    matchers: A list of pairs of (matcher, emitter), where matcher is a regex
-              and emitter is a function called when the regex matches.
+    paths: A list of paths of log files, which may be gzipped.
+    workers: The number of worker processes. Default to the number of CPUs.
   """
-  for line in iter(stream.readline, ''):
-    for matcher, emitter in matchers:
-      logging.debug('Emitting %s for input "%s"',
-                    emitter.__name__, line.strip())
-      m = matcher.match(line)
-      if m:
-        emitter(m)
-
-
-# TODO(phobbs) add a matcher for all requests, not just static files.
-MATCHERS = [
-    (STATIC_GET_MATCHER, EmitStaticRequestMetric),
-    (RPC_USAGE_MATCHER, EmitRpcUsageMetric),
-]
+  aggregator = _NewAggregator()
+  pool = multiprocessing.Pool(workers)
+  try:
+    for counts, lines in pool.imap_unordered(_AggregateShard, _Shards(paths)):
+      aggregator.merge(counts, lines)
+  finally:
+    pool.terminate()
+  aggregator.flush()
 
 
 def ParseArgs():
@@ -225,12 +437,26 @@ def ParseArgs():
   p = argparse.ArgumentParser(
       description='Parses apache logs and emits metrics to Monarch')
   p.add_argument('--logfile', required=True)
+  p.add_argument('--flush-interval', type=int,
+                 default=log_metrics_pipeline.DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 help='Seconds between emitting the metrics of stdin.')
+  p.add_argument('--replay', nargs='+', metavar='APACHE_LOG',
+                 help='Replay rotated apache logs, which may be gzipped, '
+                 'instead of reading stdin.')
+  p.add_argument('--workers', type=int,
+                 help='The number of processes replaying logs. Default to the '
+                 'number of CPUs.')
+  p.add_argument('--lab-subnets-file',
+                 help='A file of extra subnets of the lab, one per line in '
+                 'the CIDR notation.')
   return p.parse_args()
 
 
 def main():
-  """Sets up logging and runs matchers against stdin"""
+  """Sets up logging and emits the metrics of stdin or rotated logs."""
   args = ParseArgs()
+  if args.lab_subnets_file:
+    AddLabSubnets(LoadSubnets(args.lab_subnets_file))
   root = logging.getLogger()
 
   root.addHandler(handlers.TimedRotatingFileHandler(
@@ -240,7 +466,11 @@ def main():
   root.setLevel(logging.DEBUG)
   with ts_mon_config.SetupTsMonGlobalState('devserver_apache_log_metrics',
                                            indirect=True):
-    RunMatchers(sys.stdin, MATCHERS)
+    if args.replay:
+      Replay(args.replay, workers=args.workers)
+    else:
+      log_metrics_pipeline.run(sys.stdin, _NewAggregator(),
+                               flush_interval=args.flush_interval)
 
 
 if __name__ == '__main__':
@@ -8,10 +8,16 @@
 
 from __future__ import print_function
 
-import mock
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 
+import mock
+
 import apache_log_metrics
+import log_metrics_pipeline
 
 
 STATIC_REQUEST_LINE = (
@@ -34,33 +40,162 @@ class TestParsers(unittest.TestCase):
   """Tests the parsing functions in apache_log_metrics."""
 
   def testParseStaticResponse(self):
-    match = apache_log_metrics.STATIC_GET_MATCHER.match(
-        STATIC_REQUEST_LINE)
-    self.assertTrue(match)
-
-    ip = match.group('ip_addr')
-    self.assertEqual(ip, '172.24.26.30')
-    self.assertFalse(apache_log_metrics.InLab(ip))
-
-    self.assertEqual(match.group('size'), '13805917')
-
-
-class TestEmitters(unittest.TestCase):
-  """Tests the emitter functions in apache_log_metrics."""
-
-  def testEmitStaticResponse(self):
-    match = apache_log_metrics.STATIC_GET_MATCHER.match(
-        STATIC_REQUEST_LINE)
-    # Calling the emitter should not raise any exceptions (for example, by
-    # referencing regex match groups that don't exist.
-    with mock.patch.object(apache_log_metrics, 'metrics'):
-      apache_log_metrics.EmitStaticRequestMetric(match)
-
-  def testEmitRpcUsageMetric(self):
-    for line in RPC_REQUEST_LINE:
-      match = apache_log_metrics.RPC_USAGE_MATCHER.match(line)
-      with mock.patch.object(apache_log_metrics, 'metrics'):
-        apache_log_metrics.EmitRpcUsageMetric(match)
+    updates = apache_log_metrics.ClassifyLine(STATIC_REQUEST_LINE)
+    self.assertEqual(
+        updates,
+        [(apache_log_metrics.DEVSERVER_RPC_USAGE_METRIC_NAME,
+          (('http_method', 'GET'), ('in_lab', False), ('rpc_name', 'static')),
+          13805917),
+         (apache_log_metrics.STATIC_GET_METRIC_NAME,
+          (('build_config', 'veyron_minnie-release'),
+           ('endpoint', 'autotest_server_package.tar.bz2'),
+           ('in_lab', False),
+           ('milestone', 'R52')),
+          13805917)])
+
+  def testParseRpcUsage(self):
+    updates = [apache_log_metrics.ClassifyLine(line)
+               for line in RPC_REQUEST_LINE]
+    self.assertEqual(
+        updates,
+        [[(apache_log_metrics.DEVSERVER_RPC_USAGE_METRIC_NAME,
+           (('http_method', 'GET'), ('in_lab', True),
+            ('rpc_name', 'list_suite_controls')),
+           2724761)],
+         [(apache_log_metrics.DEVSERVER_RPC_USAGE_METRIC_NAME,
+           (('http_method', 'POST'), ('in_lab', True), ('rpc_name', 'update')),
+           416)]])
+
+  def testParseApiRpcName(self):
+    line = ('100.115.245.193 - - [08/Sep/2019:07:30:29 -0700] '
+            '"GET /api/hostinfo?host=foo HTTP/1.1" 200 - "-" "curl/7.35"')
+    [(_, fields, size)] = apache_log_metrics.ClassifyLine(line)
+    self.assertIn(('rpc_name', 'api/hostinfo'), fields)
+    self.assertEqual(size, 0)
+
+  def testParseIPv6(self):
+    line = STATIC_REQUEST_LINE.replace('172.24.26.30', '2401:fa00:480::1')
+    [(_, fields, _), _] = apache_log_metrics.ClassifyLine(line)
+    self.assertIn(('rpc_name', 'static'), fields)
+
+  def testIgnoreFailures(self):
+    line = STATIC_REQUEST_LINE.replace('" 200 ', '" 404 ')
+    self.assertEqual(apache_log_metrics.ClassifyLine(line), [])
+    self.assertEqual(apache_log_metrics.ClassifyLine('garbage'), [])
+
+
+class TestSubnetTable(unittest.TestCase):
+  """Tests the lookup of addresses in subnets."""
+
+  def setUp(self):
+    self.table = apache_log_metrics.SubnetTable([
+        ('100.115.128.0', 17),
+        ('100.115.192.0', 18),  # Contained by the above.
+        ('172.17.40.0', 22),
+        ('172.17.44.0', 22),  # Adjacent to the above.
+        ('2401:fa00:480::', 48),
+    ])
+
+  def testIPv4(self):
+    for ip in ('100.115.128.0', '100.115.245.193', '100.115.255.255',
+               '172.17.40.1', '172.17.47.255'):
+      self.assertTrue(self.table.Contains(ip), ip)
+    for ip in ('100.115.127.255', '100.116.0.0', '172.17.39.255',
+               '172.17.48.0', '1.2.3.4', '255.255.255.255'):
+      self.assertFalse(self.table.Contains(ip), ip)
+
+  def testIPv6(self):
+    self.assertTrue(self.table.Contains('2401:fa00:480::1'))
+    self.assertTrue(self.table.Contains('2401:fa00:480:ffff::1'))
+    self.assertFalse(self.table.Contains('2401:fa00:481::1'))
+    self.assertFalse(self.table.Contains('::1'))
+
+  def testIPv4MappedIPv6(self):
+    self.assertTrue(self.table.Contains('::ffff:100.115.245.193'))
+    self.assertFalse(self.table.Contains('::ffff:1.2.3.4'))
+
+  def testInvalidAddress(self):
+    for ip in ('', 'garbage', '1.2.3', '1.2.3.256', '1::2::3'):
+      self.assertFalse(self.table.Contains(ip), ip)
+    with self.assertRaises(ValueError):
+      apache_log_metrics.SubnetTable([('1.2.3.0', 33)])
+
+  def testCache(self):
+    table = apache_log_metrics.SubnetTable([('10.0.0.0', 8)], cache_size=2)
+    with mock.patch.object(table, '_Lookup', wraps=table._Lookup) as lookup:
+      for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3', '10.0.0.1',
+                 '10.0.0.2'):
+        self.assertTrue(table.Contains(ip))
+    self.assertEqual([args[0] for args, _ in lookup.call_args_list],
+                     ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.2'])
+
+  def testLoadSubnets(self):
+    tempdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tempdir)
+    path = os.path.join(tempdir, 'subnets')
+    with open(path, 'w') as f:
+      f.write('# Extra subnets.\n'
+              '\n'
+              '10.1.0.0/16\n'
+              '2401:fa00:480::/48  # IPv6\n'
+              '192.168.0.1\n')
+    self.assertEqual(apache_log_metrics.LoadSubnets(path),
+                     [('10.1.0.0', 16), ('2401:fa00:480::', 48),
+                      ('192.168.0.1', 32)])
+
+
+class TestAggregator(unittest.TestCase):
+  """Tests the aggregation and emission of metrics."""
+
+  def testFlush(self):
+    aggregator = apache_log_metrics._NewAggregator()
+    for _ in range(3):
+      aggregator.add_line(STATIC_REQUEST_LINE)
+    with mock.patch.object(log_metrics_pipeline, 'metrics') as metrics:
+      aggregator.flush()
+    metrics.Counter.assert_any_call(apache_log_metrics.STATIC_GET_METRIC_NAME)
+    metrics.Counter.return_value.increment_by.assert_any_call(
+        3 * 13805917,
+        fields={'build_config': 'veyron_minnie-release',
+                'endpoint': 'autotest_server_package.tar.bz2',
+                'in_lab': False,
+                'milestone': 'R52'})
+    self.assertEqual(metrics.Counter.return_value.increment_by.call_count, 2)
+    self.assertFalse(aggregator.counts)
+
+
+class TestReplay(unittest.TestCase):
+  """Tests replaying rotated logs."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.lines = [STATIC_REQUEST_LINE] + list(RPC_REQUEST_LINE)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _Aggregate(self, paths, shard_size):
+    aggregator = apache_log_metrics._NewAggregator()
+    for shard in apache_log_metrics._Shards(paths, shard_size):
+      aggregator.merge(*apache_log_metrics._AggregateShard(shard))
+    return aggregator
+
+  def testShardsCoverEachLineOnce(self):
+    plain = os.path.join(self.tempdir, 'access.log')
+    with open(plain, 'w') as f:
+      f.write('\n'.join(self.lines * 10) + '\n')
+    compressed = os.path.join(self.tempdir, 'access.log.1.gz')
+    with gzip.open(compressed, 'w') as f:
+      f.write('\n'.join(self.lines) + '\n')
+
+    expected = apache_log_metrics._NewAggregator()
+    for line in self.lines * 11:
+      expected.add_line(line)
+
+    for shard_size in (1, 100, 1000, 1 << 20):
+      aggregator = self._Aggregate([plain, compressed], shard_size)
+      self.assertEqual(aggregator.lines, len(self.lines) * 11)
+      self.assertEqual(aggregator.counts, expected.counts)
 
 
 if __name__ == '__main__':
@@ -34,7 +34,6 @@ import socket
 import subprocess
 import sys
 import tempfile
-import threading
 import types
 from logging import handlers
 
@@ -49,6 +48,9 @@ from cherrypy.process import plugins
 import autoupdate
 import cherrypy_ext
 import health_checker
+import inflight_registry
+import staged_cache
+import staging_queue
 
 # This must happen before any local modules get a chance to import
 # anything from chromite.  Otherwise, really bad things will happen, and
@@ -248,19 +250,73 @@ def _get_downloader_and_factory(kwargs):
   """
   artifacts, files = _get_artifacts(kwargs)
   dl = _get_downloader(kwargs)
+  factory_class = _get_factory_class(dl)
+  factory = factory_class(dl.GetBuildDir(), artifacts, files, dl.GetBuild())
+
+  return dl, factory
 
+
+def _get_factory_class(dl):
+  """Returns the artifact factory class of the downloader |dl|."""
   if (isinstance(dl, (downloader.GoogleStorageDownloader,
                       downloader.LocalDownloader))):
-    factory_class = build_artifact.ChromeOSArtifactFactory
+    return build_artifact.ChromeOSArtifactFactory
   elif isinstance(dl, downloader.AndroidBuildDownloader):
-    factory_class = build_artifact.AndroidArtifactFactory
+    return build_artifact.AndroidArtifactFactory
   else:
     raise DevServerError(
         'Unrecognized value for downloader type: %s' % type(dl))
 
-  factory = factory_class(dl.GetBuildDir(), artifacts, files, dl.GetBuild())
 
-  return dl, factory
+def _get_staging_key(dl, kwargs):
+  """Returns the key identifying identical staging jobs.
+
+  Args:
+    dl: The downloader of the request.
+    kwargs: Keyword arguments for the request.
+  """
+  artifacts, files = _get_artifacts(kwargs)
+  clean = xbuddy.XBuddy.ParseBoolean(kwargs.get('clean'))
+  return (dl.GetBuildDir(), tuple(sorted(artifacts)), tuple(sorted(files)),
+          clean)
+
+
+def _stage_artifacts(dl, artifacts, files, clean, flights, cache):
+  """Downloads artifacts of a build. Runs in a staging worker thread.
+
+  Each artifact is downloaded in a flight keyed by (build, artifact), so an
+  artifact requested by concurrent jobs is downloaded once. Cleaning the build
+  holds it exclusively, so it neither removes the files of a download in
+  flight nor lets a download start meanwhile.
+
+  Args:
+    dl: The downloader of the build.
+    artifacts: A list of named artifacts to stage.
+    files: A list of file artifacts to stage.
+    clean: True to remove any previously staged artifacts first.
+    flights: The inflight_registry.InFlightRegistry of artifact downloads.
+    cache: The staged_cache.StagedCache to remember the staged artifacts.
+  """
+  build_dir = dl.GetBuildDir()
+  if clean:
+    with flights.exclusive(build_dir):
+      cache.invalidate(build_dir)
+      if os.path.exists(build_dir):
+        _Log('Removing %s' % build_dir)
+        shutil.rmtree(build_dir)
+
+  def download(name, factory):
+    dl.Download(factory)
+    # Marked in the flight, so a clean can't remove the files before it.
+    cache.mark_staged(build_dir, [name])
+
+  factory_class = _get_factory_class(dl)
+  requests = ([(a, [a], []) for a in artifacts] +
+              [(f, [], [f]) for f in files])
+  for name, named_artifacts, file_artifacts in requests:
+    factory = factory_class(build_dir, named_artifacts, file_artifacts,
+                            dl.GetBuild())
+    flights.run((build_dir, name), download, name, factory)
 
 
 def _LeadingWhiteSpaceCount(string):
@@ -558,20 +614,22 @@ class DevServerRoot(object):
   # Method names that should not be listed on the index page.
   _UNLISTED_METHODS = ['index', 'doc']
 
-  # Number of threads that devserver is staging images.
-  _staging_thread_count = 0
-  # Lock used to lock increasing/decreasing count.
-  _staging_thread_count_lock = threading.Lock()
-
-  def __init__(self, _xbuddy):
+  def __init__(self, _xbuddy, staging_workers=staging_queue.DEFAULT_WORKERS,
+               staging_max_queued=staging_queue.DEFAULT_MAX_QUEUED,
+               staging_max_waiters=staging_queue.DEFAULT_MAX_WAITERS):
     self._builder = None
     self._telemetry_lock_dict = common_util.LockDict()
     self._xbuddy = _xbuddy
+    self._staging_queue = staging_queue.StagingQueue(
+        workers=staging_workers, max_queued=staging_max_queued,
+        max_waiters=staging_max_waiters)
+    self._artifact_flights = inflight_registry.InFlightRegistry()
+    self._staged_cache = staged_cache.StagedCache()
 
   @property
   def staging_thread_count(self):
-    """Get the staging thread count."""
-    return self._staging_thread_count
+    """Get the number of threads staging artifacts."""
+    return self._staging_queue.running_count
 
   @cherrypy.expose
   def build(self, board, pkg, **kwargs):
@@ -588,6 +646,9 @@ class DevServerRoot(object):
   def is_staged(self, **kwargs):
     """Check if artifacts have been downloaded.
 
+    Artifacts known to be staged are answered from memory. Only the others
+    are checked on disk.
+
     Examples:
       To check if autotest and test_suites are staged:
         http://devserver_url:<port>/is_staged?archive_url=gs://your_url/path&
@@ -605,8 +666,17 @@ class DevServerRoot(object):
     Returns:
       True of all artifacts are staged.
     """
-    dl, factory = _get_downloader_and_factory(kwargs)
-    response = str(dl.IsStaged(factory))
+    dl = _get_downloader(kwargs)
+    artifacts, files = _get_artifacts(kwargs)
+    build_dir = dl.GetBuildDir()
+    staged = self._staged_cache.is_staged(build_dir, artifacts + files)
+    if not staged:
+      factory = _get_factory_class(dl)(build_dir, artifacts, files,
+                                       dl.GetBuild())
+      staged = dl.IsStaged(factory)
+      if staged:
+        self._staged_cache.mark_staged(build_dir, artifacts + files)
+    response = str(staged)
     _Log('Responding to is_staged %s request with %r', kwargs, response)
     return response
 
@@ -626,12 +696,16 @@ class DevServerRoot(object):
       A string with information about the contents of the image directory.
     """
     dl = _get_downloader(kwargs)
+    image_dir_contents = self._staged_cache.get_listing(dl.GetBuildDir())
+    if image_dir_contents:
+      return image_dir_contents
     try:
       image_dir_contents = dl.ListBuildDir()
     except build_artifact.ArtifactDownloadError as e:
       return 'Cannot list the contents of staged artifacts. %s' % e
     if not image_dir_contents:
       return '%s has not been staged on this devserver.' % dl.DescribeSource()
+    self._staged_cache.set_listing(dl.GetBuildDir(), image_dir_contents)
     return image_dir_contents
 
   @cherrypy.expose
@@ -648,6 +722,14 @@ class DevServerRoot(object):
     These artifacts will then be available from the static/ sub-directory of
     the devserver.
 
+    Artifacts are downloaded by a dedicated pool of staging threads. A call
+    identical to a queued or running one waits for that job instead of
+    queuing another, and an artifact requested by concurrent jobs is
+    downloaded once. The ID of the job is returned by header
+    X-Staging-Job-Id, which can be queried by stage_status. A call is
+    rejected with 503 if too many jobs are waiting, or if too many calls are
+    waiting for their jobs, in which case its job is still queued.
+
     Examples:
       To download the autotest and test suites tarballs:
         http://devserver_url:<port>/stage?archive_url=gs://your_url/path&
@@ -678,7 +760,8 @@ class DevServerRoot(object):
           source files should be deleted. This is especially useful when staging
           a file locally in resource constrained environments as it allows us to
           move the relevant files locally instead of copying them.
-      async: True to return without waiting for download to complete.
+      async: True to return once the job is queued, without waiting for
+        download to complete.
       artifacts: Comma separated list of named artifacts to download.
         These are defined in artifact_info and have their implementation
         in build_artifact.py.
@@ -687,23 +770,72 @@ class DevServerRoot(object):
         custom post-processing.
       clean: True to remove any previously staged artifacts first.
     """
-    dl, factory = _get_downloader_and_factory(kwargs)
-
-    with DevServerRoot._staging_thread_count_lock:
-      DevServerRoot._staging_thread_count += 1
+    dl, _ = _get_downloader_and_factory(kwargs)
+    artifacts, files = _get_artifacts(kwargs)
+    clean = xbuddy.XBuddy.ParseBoolean(kwargs.get('clean'))
+    description = '%s: %s' % (dl.DescribeSource(), ','.join(artifacts + files))
     try:
-      boolean_string = kwargs.get('clean')
-      clean = xbuddy.XBuddy.ParseBoolean(boolean_string)
-      if clean and os.path.exists(dl.GetBuildDir()):
-        _Log('Removing %s' % dl.GetBuildDir())
-        shutil.rmtree(dl.GetBuildDir())
-      is_async = kwargs.get('async', False)
-      dl.Download(factory, is_async=is_async)
-    finally:
-      with DevServerRoot._staging_thread_count_lock:
-        DevServerRoot._staging_thread_count -= 1
+      job = self._staging_queue.submit(
+          _get_staging_key(dl, kwargs), _stage_artifacts,
+          (dl, artifacts, files, clean, self._artifact_flights,
+           self._staged_cache),
+          description=description)
+    except staging_queue.QueueFullError as e:
+      raise DevServerHTTPError(http_client.SERVICE_UNAVAILABLE, str(e))
+    cherrypy.response.headers['X-Staging-Job-Id'] = job.id
+
+    if not xbuddy.XBuddy.ParseBoolean(kwargs.get('async')):
+      # The job goes on if too many callers are waiting, so it can be polled
+      # by stage_status.
+      try:
+        self._staging_queue.wait(job)
+      except staging_queue.QueueFullError as e:
+        raise DevServerHTTPError(http_client.SERVICE_UNAVAILABLE,
+                                 '%s Poll the job %s by stage_status.' %
+                                 (e, job.id))
     return 'Success'
 
+  @cherrypy.expose
+  def stage_status(self, **kwargs):
+    """Get the state of staging jobs.
+
+    Examples:
+      To get the state of a job by its ID:
+        http://devserver_url:<port>/stage_status?job_id=<job ID>
+      To get the state of the latest job staging autotest of a build:
+        http://devserver_url:<port>/stage_status?archive_url=gs://your_url/path&
+            artifacts=autotest
+      To get the state of the queue and all recent jobs:
+        http://devserver_url:<port>/stage_status
+
+    Args:
+      job_id: The ID of the job, returned by header X-Staging-Job-Id of stage.
+      Otherwise, the same arguments as stage to find the latest identical job.
+
+    Returns:
+      A JSON dictionary of the state of the job, including id, description,
+      state (queued, running, done or failed), the timestamps of queued,
+      started and finished, elapsed seconds, error if failed and
+      queue_position if queued. Without arguments, a JSON dictionary of the
+      numbers of workers, queued and running jobs, waiting calls, the states
+      of recent jobs, and artifact_flights, the metrics of in-flight artifact
+      downloads including the time spent waiting for them.
+    """
+    job_id = kwargs.get('job_id')
+    if not kwargs:
+      status = self._staging_queue.status()
+      status['artifact_flights'] = self._artifact_flights.status()
+      return json.dumps(status)
+    if job_id:
+      status = self._staging_queue.get_status(job_id=job_id)
+    else:
+      key = _get_staging_key(_get_downloader(kwargs), kwargs)
+      status = self._staging_queue.get_status(key=key)
+    if not status:
+      raise DevServerHTTPError(http_client.NOT_FOUND,
+                               'No staging job of %s.' % kwargs)
+    return json.dumps(status)
+
   @cherrypy.expose
   def cros_au(self, **kwargs):
     """Auto-update a CrOS DUT.
@@ -1537,6 +1669,19 @@ def _AddProductionOptions(parser):
                    help='have the devserver use production values when '
                    'starting up. This includes using more threads and '
                    'performing less logging.')
+  group.add_option('--staging_workers',
+                   default=staging_queue.DEFAULT_WORKERS, type='int',
+                   help='number of threads staging artifacts (default: '
+                   '%default)')
+  group.add_option('--staging_max_queued',
+                   default=staging_queue.DEFAULT_MAX_QUEUED, type='int',
+                   help='max number of staging jobs waiting for a thread; '
+                   'stage calls beyond it are rejected (default: %default)')
+  group.add_option('--staging_max_waiters',
+                   default=staging_queue.DEFAULT_MAX_WAITERS, type='int',
+                   help='max number of synchronous stage calls waiting for '
+                   'their jobs; calls beyond it are rejected after queuing '
+                   'the jobs (default: %default)')
   parser.add_option_group(group)
 
 
@@ -1632,7 +1777,10 @@ def main():
   if options.exit:
     return
 
-  dev_server = DevServerRoot(_xbuddy)
+  dev_server = DevServerRoot(_xbuddy,
+                             staging_workers=options.staging_workers,
+                             staging_max_queued=options.staging_max_queued,
+                             staging_max_waiters=options.staging_max_waiters)
   health_checker_app = health_checker.Root(dev_server, options.static_dir)
 
   if options.pidfile:
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Admission control of the RPCs transferring GS objects.
+
+Without limits, a few huge decompressions can take all threads and bandwidth
+of the server, and starve the small extracts which test schedulers block on.
+An admission controller limits the number of concurrent requests of each RPC.
+Requests exceeding the limit wait in a queue ordered by priority, so
+interactive requests (e.g. extracting control files, range requests) are
+admitted before bulk transfers of payloads.
+
+The egress bandwidth is shaped by a token bucket shared by all RPCs. Bulk
+responses wait for tokens, while interactive ones only consume them.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import itertools
+import threading
+import time
+
+import closing_content
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+DEFAULT_TIMEOUT_SECONDS = 120
+
+
+class AdmissionTimeoutError(Exception):
+  """Exception raised when a request waits too long to be admitted."""
+
+
+class TokenBucket(object):
+  """A token bucket shaping the rate of bytes."""
+
+  def __init__(self, rate, burst=None):
+    """Constructor.
+
+    Args:
+      rate: The number of tokens (bytes) added per second.
+      burst: The max number of tokens in the bucket. Default to |rate|.
+    """
+    self._rate = rate
+    self._burst = burst or rate
+    self._tokens = self._burst
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  def consume(self, tokens, wait=True):
+    """Take |tokens| from the bucket.
+
+    The bucket may go into debt, which is paid back by the later consumers.
+
+    Args:
+      tokens: The number of tokens to take.
+      wait: Whether to sleep until the bucket isn't in debt.
+    """
+    with self._lock:
+      now = time.time()
+      self._tokens = min(self._burst,
+                         self._tokens + (now - self._last) * self._rate)
+      self._last = now
+      self._tokens -= tokens
+      delay = -self._tokens / self._rate
+    if wait and delay > 0:
+      time.sleep(delay)
+
+
+class _Waiter(object):
+  """A request waiting to be admitted."""
+
+  def __init__(self, rpc, priority, seq):
+    self.rpc = rpc
+    self.priority = priority
+    self.key = (priority, seq)
+
+
+class AdmissionController(object):
+  """Limit the concurrent requests of RPCs and the egress bandwidth."""
+
+  def __init__(self, limits=None, egress_rate=None, egress_burst=None,
+               timeout=DEFAULT_TIMEOUT_SECONDS):
+    """Constructor.
+
+    Args:
+      limits: A dict of RPC name => the max number of concurrent requests.
+        RPCs not in it, or with a limit of 0, are not limited.
+      egress_rate: The max egress bytes per second of all admitted responses.
+        The egress is not shaped if it's None.
+      egress_burst: The max bytes of a burst exceeding |egress_rate|.
+      timeout: The max seconds of a request waiting to be admitted.
+    """
+    self._limits = dict(limits or {})
+    self._timeout = timeout
+    self._bucket = (TokenBucket(egress_rate, egress_burst) if egress_rate
+                    else None)
+    self._cond = threading.Condition()
+    self._seq = itertools.count()
+    # RPC name => the list of waiters ordered by priority and arrival.
+    self._waiters = collections.defaultdict(list)
+    self._running = collections.Counter()
+    self._admitted = collections.Counter()
+    self._rejected = collections.Counter()
+    self._max_queue_depth = 0
+
+  def admit(self, rpc, priority=BULK):
+    """Wait until a request of |rpc| can be admitted.
+
+    Args:
+      rpc: The name of the RPC.
+      priority: The priority of the request, INTERACTIVE or BULK.
+
+    Returns:
+      A Ticket, which must be released once the request is done.
+
+    Raises:
+      AdmissionTimeoutError if the request isn't admitted in time.
+    """
+    limit = self._limits.get(rpc)
+    with self._cond:
+      if limit and (self._running[rpc] >= limit or self._waiters[rpc]):
+        self._wait(rpc, priority, limit)
+      self._running[rpc] += 1
+      self._admitted[rpc] += 1
+    return Ticket(self, rpc, priority)
+
+  def _wait(self, rpc, priority, limit):
+    """Wait in the queue of |rpc|. Called with the lock held."""
+    waiters = self._waiters[rpc]
+    waiter = _Waiter(rpc, priority, next(self._seq))
+    waiters.append(waiter)
+    waiters.sort(key=lambda w: w.key)
+    self._max_queue_depth = max(self._max_queue_depth, self._queue_depth())
+    deadline = time.time() + self._timeout
+    try:
+      while self._running[rpc] >= limit or waiters[0] is not waiter:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          self._rejected[rpc] += 1
+          raise AdmissionTimeoutError(
+              'Timed out waiting for %d running %s requests.' %
+              (self._running[rpc], rpc))
+        self._cond.wait(remaining)
+    finally:
+      waiters.remove(waiter)
+      # The next waiter may be admitted now.
+      self._cond.notify_all()
+
+  def _release(self, rpc):
+    with self._cond:
+      self._running[rpc] -= 1
+      self._cond.notify_all()
+
+  def _queue_depth(self):
+    return sum(len(w) for w in self._waiters.itervalues())
+
+  def throttle(self, size, priority):
+    """Account |size| bytes of egress, and wait for bandwidth if bulk."""
+    if self._bucket:
+      self._bucket.consume(size, wait=priority != INTERACTIVE)
+
+  def status(self):
+    """Get the metrics of admission.
+
+    Returns:
+      A dict of:
+        queue_depth: The number of waiting requests.
+        max_queue_depth: The max number of waiting requests ever.
+        waiting: RPC name => priority name => the number of waiting requests.
+        running, admitted, rejected: RPC name => the number of requests.
+        limits: RPC name => the max number of concurrent requests.
+    """
+    with self._cond:
+      waiting = {}
+      for rpc, waiters in self._waiters.iteritems():
+        counts = collections.Counter(PRIORITY_NAMES[w.priority]
+                                     for w in waiters)
+        if counts:
+          waiting[rpc] = dict(counts)
+      return {
+          'queue_depth': self._queue_depth(),
+          'max_queue_depth': self._max_queue_depth,
+          'waiting': waiting,
+          'running': {k: v for k, v in self._running.iteritems() if v},
+          'admitted': dict(self._admitted),
+          'rejected': dict(self._rejected),
+          'limits': dict(self._limits),
+      }
+
+
+class Ticket(object):
+  """An admitted request, holding a slot of the RPC until released."""
+
+  def __init__(self, controller, rpc, priority):
+    self._controller = controller
+    self.rpc = rpc
+    self.priority = priority
+    self._released = False
+    self._streaming = False
+    self._lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    # Once streaming, the ticket is released when the content is done.
+    if exc_type is not None or not self._streaming:
+      self.release()
+
+  def release(self):
+    """Release the slot. It's safe to be called more than once."""
+    with self._lock:
+      if self._released:
+        return
+      self._released = True
+    self._controller._release(self.rpc)  # pylint: disable=protected-access
+
+  def stream(self, content):
+    """Wrap the response content, which releases the ticket once done.
+
+    Args:
+      content: The response content, either a string, an iterable of strings
+        or None.
+
+    Returns:
+      An iterable of the content shaped by the egress bandwidth. The ticket is
+      released when it's exhausted or closed.
+    """
+    if content is None or isinstance(content, basestring):
+      self.release()
+      return content
+    self._streaming = True
+    return closing_content.ClosingContent(content, self.release,
+                                          on_chunk=self._throttle)
+
+  def _throttle(self, data):
+    """Shape the egress bandwidth of sending |data|."""
+    self._controller.throttle(len(data), self.priority)
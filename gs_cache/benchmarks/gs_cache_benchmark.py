@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark suite of the hot paths of gs_cache.
+
+It generates synthetic tar archives, one of many small members and one of a
+few huge members, and serves them by a local fake caching server. Then it
+runs each benchmark case several times and measures:
+  - The throughput of the output of the case.
+  - The percentiles of the latency of an iteration.
+  - The peak RSS of the process running the case. Each case runs in a forked
+    process, so the peak isn't affected by the other cases.
+
+The cases cover parsing tar headers (tarfile_utils.list_tar_members), parsing
+multipart/byteranges responses (range_response), and the RPCs `list_member`,
+`extract` and `decompress` of gs_archive_server against the fake caching
+server.
+
+The results are written as JSON, so results of different commits can be
+compared:
+  python benchmarks/gs_cache_benchmark.py --output /tmp/before.json
+  (apply the change)
+  python benchmarks/gs_cache_benchmark.py --output /tmp/after.json \\
+      --compare /tmp/before.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import BaseHTTPServer
+import collections
+import fnmatch
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import cherrypy
+from cherrypy.lib import httputil
+
+import constants
+import gs_archive_server
+import range_response
+import tarfile_utils
+
+_SMALL_TAR = 'bucket/build/small_members.tar'
+_HUGE_TAR = 'bucket/build/huge_members.tar'
+
+# The latency percentiles to report.
+_PERCENTILES = (50, 90, 99)
+
+# A case is run |iterations| times by |func|, which returns the number of bytes
+# it outputs.
+_Case = collections.namedtuple('_Case', ['name', 'func', 'iterations'])
+
+
+class _Content(object):
+  """A file-like object of |size| bytes of compressible pseudo-random data."""
+
+  _BLOCK = ''.join(chr(random.Random(0).randint(0, 15) + 65)
+                   for _ in xrange(64 * 1024))
+
+  def __init__(self, size):
+    self._remaining = size
+
+  def read(self, size=-1):
+    if size < 0:
+      size = self._remaining
+    size = min(size, self._remaining, len(self._BLOCK))
+    self._remaining -= size
+    return self._BLOCK[:size]
+
+
+def _make_tar(path, members):
+  """Create a tar archive at |path| of |members|, a list of (name, size)."""
+  with tarfile.open(path, 'w', format=tarfile.GNU_FORMAT) as tar:
+    for name, size in members:
+      info = tarfile.TarInfo(name)
+      info.size = size
+      info.mtime = 0
+      tar.addfile(info, _Content(size))
+
+
+def _make_archives(root, args):
+  """Create the synthetic archives under |root|."""
+  small = os.path.join(root, _SMALL_TAR)
+  huge = os.path.join(root, _HUGE_TAR)
+  os.makedirs(os.path.dirname(small))
+  _make_tar(small, [('dir%d/file%d.py' % (i // 100, i), args.small_size)
+                    for i in xrange(args.small_members)])
+  _make_tar(huge, [('payload%d.bin' % i, args.huge_mb * 1024 * 1024)
+                   for i in xrange(args.huge_members)])
+  with open(small, 'rb') as src, gzip.open('%s.gz' % small, 'wb') as dst:
+    shutil.copyfileobj(src, dst)
+
+
+class _FakeCachingServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """The handler of a fake caching server, serving files under a directory.
+
+  It supports `download` RPC with single or multiple ranges and `list_member`
+  RPC. The files are served as they are on GS.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    # pylint: disable=protected-access
+    action, _, path = self.path.lstrip('/').partition('/')
+    path = os.path.join(self.server.root, path.partition('?')[0])
+    if not os.path.isfile(path):
+      self.send_error(404)
+      return
+
+    if action == 'list_member':
+      with open(path, 'rb') as f:
+        chunks = iter(lambda: f.read(constants.READ_BUFFER_SIZE_BYTES), '')
+        body = ''.join(gs_archive_server._member_list_csv(
+            tarfile_utils.list_tar_members(chunks)))
+      self._send(200, body, {'Content-Type': 'text/csv'})
+    elif action == 'download':
+      self._download(path)
+    else:
+      self.send_error(400)
+
+  def _send(self, status, body, headers):
+    self.send_response(status)
+    for key, value in headers.iteritems():
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _download(self, path):
+    size = os.path.getsize(path)
+    ranges = httputil.get_ranges(self.headers.get('Range'), size)
+    with open(path, 'rb') as f:
+      if not ranges:
+        self._send(200, f.read(), {'Content-Type': 'application/x-tar'})
+        return
+
+      def read(start, stop):
+        f.seek(start)
+        return f.read(stop - start)
+
+      if len(ranges) == 1:
+        start, stop = ranges[0]
+        self._send(206, read(start, stop), {
+            'Content-Type': 'application/x-tar',
+            'Content-Range': 'bytes %d-%d/%d' % (start, stop - 1, size)})
+        return
+
+      boundary = uuid.uuid4().hex
+      parts = []
+      for start, stop in ranges:
+        parts.append('\r\n--%s\r\nContent-Type: application/x-tar\r\n'
+                     'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                     (boundary, start, stop - 1, size))
+        parts.append(read(start, stop))
+      parts.append('\r\n--%s--\r\n' % boundary)
+      self._send(206, ''.join(parts), {
+          'Content-Type': 'multipart/byteranges; boundary=%s' % boundary})
+
+
+class _FakeCachingServer(SocketServer.ThreadingMixIn,
+                         BaseHTTPServer.HTTPServer):
+  """A fake caching server listening on a local port."""
+
+  daemon_threads = True
+
+  def __init__(self, root):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                       _FakeCachingServerHandler)
+    self.root = root
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+class _FakeMultipartResponse(object):
+  """A fake multipart/byteranges response of files in a tar archive."""
+
+  def __init__(self, archive, members):
+    self._boundary = uuid.uuid4().hex
+    self.headers = {'Content-Type': 'multipart/byteranges; boundary=%s' %
+                                    self._boundary}
+    parts = []
+    with open(archive, 'rb') as f:
+      for m in members:
+        start, size = int(m.content_start), int(m.size)
+        f.seek(start)
+        parts.append('\r\n--%s\r\nContent-Type: application/x-tar\r\n'
+                     'Content-Range: bytes %d-%d/*\r\n\r\n' %
+                     (self._boundary, start, start + size - 1))
+        parts.append(f.read(size))
+    parts.append('\r\n--%s--\r\n' % self._boundary)
+    self._body = ''.join(parts)
+
+  def iter_content(self, chunk_size):
+    for i in xrange(0, len(self._body), chunk_size):
+      yield self._body[i:i + chunk_size]
+
+
+def _read_file(path):
+  """Yield the content of |path| in chunks of the size of reading responses."""
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(constants.READ_BUFFER_SIZE_BYTES), ''):
+      yield chunk
+
+
+def _consume(content):
+  """Iterate |content| and return its size in bytes."""
+  if isinstance(content, basestring):
+    return len(content)
+  return sum(len(data) for data in content)
+
+
+def _list_members(archive):
+  return sum(int(m.record_size) for m in tarfile_utils.list_tar_members(
+      _read_file(archive)))
+
+
+def _parse_multipart(response, members):
+  # pylint: disable=protected-access
+  size = 0
+  file_iter = range_response._file_iterator(
+      response, range_response._FileMap(members))
+  for _, _, content in file_iter:
+    size += _consume(content)
+  return size
+
+
+def _stream_json(response, members):
+  streamer = range_response.JsonStreamer()
+  streamer.queue_response(response, members)
+  return _consume(streamer.stream())
+
+
+def _build_cases(root, server, args):
+  """Get the list of benchmark cases."""
+  small = os.path.join(root, _SMALL_TAR)
+  huge = os.path.join(root, _HUGE_TAR)
+  small_members = list(tarfile_utils.list_tar_members(_read_file(small)))
+  huge_members = list(tarfile_utils.list_tar_members(_read_file(huge)))
+  picked = random.Random(0).sample(small_members,
+                                   min(args.extract_files, len(small_members)))
+  picked_names = [m.filename for m in picked]
+  multipart = _FakeMultipartResponse(small, small_members)
+  rpc_iterations = args.iterations
+  bulk_iterations = max(1, args.iterations // 10)
+
+  def extract(archive, files, output='json'):
+    def func():
+      return _consume(server.extract(archive, file=files, output=output))
+    return func
+
+  cases = [
+      _Case('list_tar_members/small', lambda: _list_members(small),
+            bulk_iterations),
+      _Case('list_tar_members/huge', lambda: _list_members(huge),
+            bulk_iterations),
+      _Case('multipart/parse', lambda: _parse_multipart(multipart,
+                                                        small_members),
+            bulk_iterations),
+      _Case('multipart/json', lambda: _stream_json(multipart, small_members),
+            bulk_iterations),
+      _Case('rpc/list_member/small',
+            lambda: _consume(server.list_member(_SMALL_TAR)), bulk_iterations),
+      _Case('rpc/list_member/huge',
+            lambda: _consume(server.list_member(_HUGE_TAR)), bulk_iterations),
+      _Case('rpc/extract/json', extract(_SMALL_TAR, picked_names),
+            rpc_iterations),
+      _Case('rpc/extract/tar', extract(_SMALL_TAR, picked_names, 'tar'),
+            rpc_iterations),
+      _Case('rpc/extract/pattern', extract(_SMALL_TAR, ['dir1/*']),
+            rpc_iterations),
+      _Case('rpc/extract/huge',
+            extract(_HUGE_TAR, [huge_members[0].filename], 'tar'),
+            bulk_iterations),
+      _Case('rpc/decompress',
+            lambda: _consume(server.decompress('%s.gz' % _SMALL_TAR)),
+            bulk_iterations),
+  ]
+  return [c for c in cases if fnmatch.fnmatch(c.name, args.cases)]
+
+
+def _percentile(sorted_values, percent):
+  """Get the |percent| percentile of |sorted_values| by the nearest rank."""
+  rank = max(int(round(percent / 100 * len(sorted_values))), 1)
+  return sorted_values[rank - 1]
+
+
+def _run_case(case, results):
+  """Run |case| and put its result to the queue |results|.
+
+  It runs in a child process, so the peak RSS is of the case only.
+  """
+  latencies = []
+  total_bytes = 0
+  try:
+    for _ in xrange(case.iterations):
+      start = time.time()
+      total_bytes += case.func()
+      latencies.append(time.time() - start)
+  except Exception as err:  # pylint: disable=broad-except
+    results.put({'name': case.name, 'error': repr(err)})
+    return
+
+  latencies.sort()
+  elapsed = sum(latencies)
+  result = {
+      'name': case.name,
+      'iterations': case.iterations,
+      'bytes': total_bytes,
+      'seconds': elapsed,
+      'throughput_mb_s': total_bytes / elapsed / 1024 / 1024,
+      # ru_maxrss is in kilobytes on Linux.
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+  for percent in _PERCENTILES:
+    result['p%d_ms' % percent] = _percentile(latencies, percent) * 1000
+  results.put(result)
+
+
+def _git_commit():
+  """Get the commit of the working directory, or None if unknown."""
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _print_result(result, baseline=None):
+  """Print a result, and the ratios to the |baseline| result if any."""
+  if 'error' in result:
+    print('%-24s ERROR: %s' % (result['name'], result['error']))
+    return
+  line = ('%-24s %9.1f MB/s  p50 %9.2f ms  p99 %9.2f ms  RSS %7.1f MB' %
+          (result['name'], result['throughput_mb_s'], result['p50_ms'],
+           result['p99_ms'], result['peak_rss_mb']))
+  if baseline and 'error' not in baseline:
+    line += '  (throughput x%.2f, p50 x%.2f, RSS x%.2f)' % (
+        result['throughput_mb_s'] / baseline['throughput_mb_s'],
+        result['p50_ms'] / baseline['p50_ms'],
+        result['peak_rss_mb'] / baseline['peak_rss_mb'])
+  print(line)
+
+
+def parse_args(argv):
+  """Parse arguments."""
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      description=__doc__)
+  parser.add_argument('--cases', default='*',
+                      help='A glob pattern of the names of cases to run. '
+                      'Default: %(default)s.')
+  parser.add_argument('--iterations', type=int, default=50,
+                      help='The number of iterations of RPC cases. Cases '
+                      'processing whole archives run a tenth of it. Default: '
+                      '%(default)s.')
+  parser.add_argument('--small-members', type=int, default=20000,
+                      help='The number of members of the tar of small '
+                      'members. Default: %(default)s.')
+  parser.add_argument('--small-size', type=int, default=1024,
+                      help='The size of each small member in bytes. Default: '
+                      '%(default)s.')
+  parser.add_argument('--huge-members', type=int, default=3,
+                      help='The number of members of the tar of huge members. '
+                      'Default: %(default)s.')
+  parser.add_argument('--huge-mb', type=int, default=128,
+                      help='The size of each huge member in MB. Default: '
+                      '%(default)s.')
+  parser.add_argument('--extract-files', type=int, default=20,
+                      help='The number of files extracted by name from the '
+                      'tar of small members. Default: %(default)s.')
+  parser.add_argument('--output', metavar='JSON_FILE',
+                      help='Write the results to JSON_FILE.')
+  parser.add_argument('--compare', metavar='JSON_FILE',
+                      help='Compare the results with a previous JSON_FILE.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  """Main function."""
+  args = parse_args(argv)
+  baselines = {}
+  if args.compare:
+    with open(args.compare) as f:
+      baselines = {r['name']: r for r in json.load(f)['results']}
+
+  root = tempfile.mkdtemp(prefix='gs_cache_benchmark')
+  try:
+    print('Generating archives in %s' % root)
+    _make_archives(root, args)
+    fake_server = _FakeCachingServer(root)
+    fake_server.start()
+    server = gs_archive_server.GsArchiveServer(
+        gs_archive_server._CachingServer(  # pylint: disable=protected-access
+            ('http', '127.0.0.1:%d' % fake_server.server_address[1])))
+    # The RPCs are called out of a CherryPy request, so give them a context.
+    cherrypy.request.headers = httputil.HeaderMap()
+
+    results = []
+    for case in _build_cases(root, server, args):
+      queue = multiprocessing.Queue()
+      process = multiprocessing.Process(target=_run_case, args=(case, queue))
+      process.start()
+      result = queue.get()
+      process.join()
+      _print_result(result, baselines.get(case.name))
+      results.append(result)
+    fake_server.shutdown()
+  finally:
+    shutil.rmtree(root)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({
+          'commit': _git_commit(),
+          'time': time.time(),
+          'python': platform.python_version(),
+          'args': vars(args),
+          'results': results,
+      }, f, indent=2, sort_keys=True)
+    print('Results are written to %s' % args.output)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
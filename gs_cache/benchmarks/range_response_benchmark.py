@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Microbenchmark of parsing multipart/byteranges responses.
+
+It feeds a synthetic multi-part response to range_response, in chunks of the
+size read from the caching server, and reports the throughput of iterating the
+files in it, and of streaming them as JSON.
+
+Usage:
+  python benchmarks/range_response_benchmark.py --size-mb 1024 --parts 16
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import constants
+import range_response
+import tarfile_utils
+
+_BOUNDARY = '00000000000000000001'
+
+
+class _FakeResponse(object):
+  """A fake response of a multi-part range request."""
+
+  headers = {'Content-Type': 'multipart/byteranges; boundary=%s' % _BOUNDARY}
+
+  def __init__(self, part_size, parts):
+    self._part_size = part_size
+    self._parts = parts
+
+  def iter_content(self, chunk_size):
+    """Yield the response in chunks of |chunk_size|."""
+    chunk = 'x' * chunk_size
+    for i in xrange(self._parts):
+      start = i * self._part_size
+      header = ('\r\n--%s\r\nContent-Type: application/octet-stream\r\n'
+                'Content-Range: bytes %d-%d/*\r\n\r\n' %
+                (_BOUNDARY, start, start + self._part_size - 1))
+      first = min(chunk_size - len(header), self._part_size)
+      yield header + chunk[:first]
+      remaining = self._part_size - first
+      while remaining >= chunk_size:
+        yield chunk
+        remaining -= chunk_size
+      if remaining:
+        yield chunk[:remaining]
+    yield '\r\n--%s--\r\n' % _BOUNDARY
+
+  def members(self):
+    """Get the tar members of the parts."""
+    return [tarfile_utils.TarMemberInfo('file%d' % i, 0, 0,
+                                        i * self._part_size, self._part_size)
+            for i in xrange(self._parts)]
+
+
+def _iterate_files(response):
+  """Iterate the content of all files in the response."""
+  # pylint: disable=protected-access
+  file_iter = range_response._file_iterator(
+      response, range_response._FileMap(response.members()))
+  for _, _, content in file_iter:
+    for _ in content:
+      pass
+
+
+def _stream_json(response):
+  """Stream all files in the response as JSON."""
+  streamer = range_response.JsonStreamer()
+  streamer.queue_response(response, response.members())
+  for _ in streamer.stream():
+    pass
+
+
+def _run(name, func, response, size):
+  """Run |func| with |response| and print the throughput."""
+  start = time.time()
+  func(response)
+  elapsed = time.time() - start
+  print('%-14s %8.3f s %10.1f MB/s' % (name, elapsed,
+                                        size / elapsed / 1024 / 1024))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--size-mb', type=int, default=1024,
+                      help='The total size of parts. Default: %(default)s.')
+  parser.add_argument('--parts', type=int, default=16,
+                      help='The number of parts. Default: %(default)s.')
+  parser.add_argument('--chunk-size', type=int,
+                      default=constants.READ_BUFFER_SIZE_BYTES,
+                      help='The size of chunks. Default: %(default)s.')
+  parser.add_argument('--json', action='store_true',
+                      help='Benchmark streaming the files as JSON too.')
+  args = parser.parse_args(argv)
+
+  part_size = args.size_mb * 1024 * 1024 // args.parts
+  response = _FakeResponse(part_size, args.parts)
+  size = part_size * args.parts
+  print('%d parts, %d MB in chunks of %d B' % (args.parts, size // 1024 // 1024,
+                                               args.chunk_size))
+  _run('iterate files', _iterate_files, response, size)
+  if args.json:
+    _run('stream JSON', _stream_json, response, size)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Response content which calls back once it's done.
+
+Work of a request may outlive the handler when the response is streamed, e.g.
+an admission ticket is held and a span is timed until the content is sent.
+CherryPy closes the response content once it's exhausted or the client is
+gone, so the content is wrapped to call back when it's closed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+class ClosingContent(object):
+  """An iterator of the response content, which calls back once closed.
+
+  It's an iterator class instead of a generator, because a generator closed
+  before started doesn't run its `finally` clause.
+  """
+
+  def __init__(self, content, on_close, on_chunk=None):
+    """Constructor.
+
+    Args:
+      content: An iterable of the response content. It's closed if it has
+        `close`.
+      on_close: A function called once the content is exhausted or closed.
+      on_chunk: An optional function called with each chunk before it's
+        returned.
+    """
+    self._content = content
+    self._iter = iter(content)
+    self._on_close = on_close
+    self._on_chunk = on_chunk
+    self._closed = False
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    try:
+      chunk = next(self._iter)
+    except:
+      self.close()
+      raise
+    if self._on_chunk:
+      self._on_chunk(chunk)
+    return chunk
+
+  def close(self):
+    if self._closed:
+      return
+    self._closed = True
+    try:
+      if hasattr(self._content, 'close'):
+        self._content.close()
+    finally:
+      self._on_close()
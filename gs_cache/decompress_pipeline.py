@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Download, decompress and serve a compressed archive at the same time.
+
+The pipeline has three stages which run concurrently:
+  download: A thread reads the compressed archive from the caching server into
+    a bounded buffer of chunks.
+  decompress: A thread writes the buffered chunks to the stdin of a
+    decompressor process. Parallel decompressors (e.g. lbzip2, pbzip2, pigz,
+    pixz) are preferred when installed, since archives made by parallel
+    compressors consist of independent blocks/streams which are decompressed
+    on multiple cores.
+  serve: The caller iterates the pipeline to get the decompressed content
+    from the stdout of the decompressor process as soon as it's available.
+
+The bounded buffer lets the download go on while the decompressor is busy,
+and stops the download from running too far ahead of a slow consumer.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import distutils.spawn
+import errno
+import os
+import Queue
+import select
+import subprocess
+import sys
+import threading
+
+import constants
+
+# The command lines to decompress from stdin to stdout, in the order of
+# preference. The last one of each is the fallback which is always available.
+_DECOMPRESSORS = {
+    '.gz': (['pigz', '-d', '-c'], ['gzip', '-d', '-c']),
+    '.tgz': (['pigz', '-d', '-c'], ['gzip', '-d', '-c']),
+    '.bz2': (['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c'],
+             ['bzip2', '-d', '-c']),
+    '.xz': (['pixz', '-d'], ['xz', '-d', '-c']),
+}
+
+# The max number of downloaded chunks waiting to be decompressed.
+_DEFAULT_BUFFER_CHUNKS = 16
+
+_commands = {}
+
+
+def decompress_command(ext_name):
+  """Get the command line to decompress a file of |ext_name|.
+
+  Args:
+    ext_name: The extension name of the compressed file, e.g. '.bz2'.
+
+  Returns:
+    A list of the command and its arguments.
+  """
+  if ext_name not in _commands:
+    candidates = _DECOMPRESSORS[ext_name]
+    _commands[ext_name] = next(
+        (c for c in candidates if distutils.spawn.find_executable(c[0])),
+        candidates[-1])
+  return _commands[ext_name]
+
+
+class DecompressPipeline(object):
+  """Decompress the chunks of a compressed file while they're downloading.
+
+  Iterate the pipeline to get the decompressed content. The pipeline is closed
+  after the iteration, or by calling `close` explicitly.
+  """
+
+  def __init__(self, ext_name, chunks, buffer_chunks=_DEFAULT_BUFFER_CHUNKS):
+    """Constructor.
+
+    Args:
+      ext_name: The extension name of the compressed file.
+      chunks: An iterable of the chunks of the compressed file. It's iterated
+        in another thread, and closed if it has `close` when the pipeline is
+        done with it.
+      buffer_chunks: The max number of chunks buffered before decompressed.
+    """
+    self._chunks = chunks
+    self._buffer = Queue.Queue(maxsize=buffer_chunks)
+    self._download_error = None
+    self._stopped = threading.Event()
+    # Close fds of other pipelines, otherwise a decompressor inheriting the
+    # stdin of another one prevents it from seeing EOF.
+    self._proc = subprocess.Popen(decompress_command(ext_name),
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, close_fds=True)
+    self._threads = [threading.Thread(target=self._download),
+                     threading.Thread(target=self._feed)]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  @property
+  def pid(self):
+    return self._proc.pid
+
+  @property
+  def returncode(self):
+    return self._proc.returncode
+
+  def _download(self):
+    """Read the compressed chunks into the buffer."""
+    try:
+      for chunk in self._chunks:
+        if self._stopped.is_set():
+          break
+        self._buffer.put(chunk)
+    except Exception:  # pylint: disable=broad-except
+      self._download_error = sys.exc_info()
+    finally:
+      # Closed by this thread after it stops iterating, because a generator
+      # can't be closed while another thread is running it. It releases the
+      # upstream connection, e.g. back to the pool, instead of waiting for GC.
+      close = getattr(self._chunks, 'close', None)
+      try:
+        if close:
+          close()
+      except Exception:  # pylint: disable=broad-except
+        self._download_error = self._download_error or sys.exc_info()
+      self._buffer.put(None)
+
+  def _feed(self):
+    """Write the buffered chunks to the decompressor."""
+    broken = False
+    while True:
+      chunk = self._buffer.get()
+      if chunk is None:
+        break
+      # Keep draining the buffer after the decompressor quits, so the download
+      # thread is never blocked.
+      if not broken:
+        try:
+          self._proc.stdin.write(chunk)
+        except IOError:
+          broken = True
+    try:
+      self._proc.stdin.close()
+    except IOError:
+      pass
+
+  def _read(self, fd):
+    """Read the next decompressed data from |fd|, or '' at the end.
+
+    The pipes are non-blocking when gevent monkey patches subprocess, so wait
+    until |fd| is readable by select, which is cooperative then.
+    """
+    while True:
+      try:
+        return os.read(fd, constants.READ_BUFFER_SIZE_BYTES)
+      except OSError as e:
+        if e.errno != errno.EAGAIN:
+          raise
+      select.select([fd], [], [])
+
+  def __iter__(self):
+    """Yield the decompressed content.
+
+    Raises:
+      Any exception raised when downloading the compressed file.
+    """
+    try:
+      fd = self._proc.stdout.fileno()
+      while True:
+        data = self._read(fd)
+        if not data:
+          break
+        yield data
+
+      for thread in self._threads:
+        thread.join()
+      self._proc.wait()
+      if self._download_error:
+        exc_type, exc_value, exc_traceback = self._download_error
+        raise exc_type, exc_value, exc_traceback
+    finally:
+      self.close()
+
+  def close(self):
+    """Stop the pipeline and release all resources."""
+    self._stopped.set()
+    if self._proc.poll() is None:
+      self._proc.kill()
+      self._proc.wait()
+    self._proc.stdout.close()
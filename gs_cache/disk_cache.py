@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A disk cache of GS objects shared by server processes.
+
+Objects are keyed by the GS path and the generation, so a new generation of an
+object never hits the cache of an old one. Each object is saved in a file named
+by the SHA-1 of its key. It's written to a temporary file first and renamed
+when complete, so readers never see a partial object.
+
+The cache is bounded by the total size of objects. The least recently used
+objects, by the access time of files, are evicted first. Only one process
+evicts at a time, which holds an exclusive lock of the cache directory. A file
+being read by a process is still readable after it's evicted.
+
+Evicting walks the whole cache directory, so a process evicts only after it
+has cached a tenth of the max size since its last eviction, or a minute has
+passed. The cache may exceed the max size by that much until then.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import errno
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from chromite.lib import cros_logging as logging
+
+_logger = logging.getLogger(__name__)
+
+_LOCK_FILE = '.lock'
+_TEMP_FILE_PREFIX = '.tmp'
+
+# Temporary files older than this are left by dead processes.
+_STALE_TEMP_FILE_SECONDS = 24 * 60 * 60
+
+# Evict after caching this fraction of the max size, or after this interval.
+_EVICT_FRACTION = 0.1
+_EVICT_INTERVAL_SECONDS = 60
+
+
+def _ignore_missing(func, *args):
+  """Call |func| and ignore the error that the file doesn't exist."""
+  try:
+    return func(*args)
+  except OSError as err:
+    if err.errno != errno.ENOENT:
+      raise
+
+
+class DiskCache(object):
+  """The disk cache of GS objects, keyed by GS path and generation."""
+
+  def __init__(self, cache_dir, max_bytes):
+    """Constructor.
+
+    Args:
+      cache_dir: The directory of cached objects. It's created if not exist.
+      max_bytes: The max total size of cached objects.
+    """
+    self._dir = cache_dir
+    self._max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._last_evict = time.time()
+    self._bytes_since_evict = 0
+    try:
+      os.makedirs(cache_dir)
+    except OSError as err:
+      if err.errno != errno.EEXIST:
+        raise
+
+  @property
+  def max_bytes(self):
+    return self._max_bytes
+
+  def _path(self, gs_path, generation):
+    """Get the path of the cache file of an object."""
+    key = hashlib.sha1('%s#%s' % (gs_path, generation)).hexdigest()
+    return os.path.join(self._dir, key[:2], key)
+
+  def open(self, gs_path, generation):
+    """Open the cached object.
+
+    Args:
+      gs_path: The GS path of the object.
+      generation: The generation of the object.
+
+    Returns:
+      The file object of the cached object, or None if not cached.
+    """
+    path = self._path(gs_path, generation)
+    try:
+      cache_file = open(path, 'rb')
+    except IOError as err:
+      if err.errno == errno.ENOENT:
+        return None
+      raise
+
+    # Keep the modification time, which is served as Last-Modified.
+    _ignore_missing(os.utime, path,
+                    (time.time(), os.fstat(cache_file.fileno()).st_mtime))
+    return cache_file
+
+  def cache(self, gs_path, generation, chunks):
+    """Yield all |chunks| and save them as the object after the last one.
+
+    The object isn't saved if the iteration is not completed, e.g. the client
+    disconnected. An error of writing the cache doesn't fail the iteration.
+
+    Args:
+      gs_path: The GS path of the object.
+      generation: The generation of the object.
+      chunks: An iterable of the chunks of the object.
+
+    Yields:
+      The chunks of the object.
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=_TEMP_FILE_PREFIX, dir=self._dir)
+    temp_file = os.fdopen(fd, 'wb')
+    size = 0
+    completed = False
+    try:
+      for chunk in chunks:
+        if temp_file:
+          try:
+            temp_file.write(chunk)
+            size += len(chunk)
+          except IOError as err:
+            _logger.warning('Failed to cache %s: %s', gs_path, err)
+            temp_file.close()
+            temp_file = None
+        yield chunk
+      completed = temp_file is not None
+    finally:
+      if temp_file:
+        temp_file.close()
+      if completed:
+        self._commit(gs_path, temp_path, self._path(gs_path, generation), size)
+      else:
+        _ignore_missing(os.unlink, temp_path)
+
+  def _commit(self, gs_path, temp_path, path, size):
+    """Move a completed temporary file to |path| and evict old objects.
+
+    Errors are logged instead of raised, because the object has been sent.
+    """
+    try:
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError as err:
+        if err.errno != errno.EEXIST:
+          raise
+      os.rename(temp_path, path)
+    except OSError as err:
+      _logger.warning('Failed to cache %s: %s', gs_path, err)
+      try:
+        os.unlink(temp_path)
+      except OSError:
+        pass
+      return
+
+    now = time.time()
+    with self._lock:
+      self._bytes_since_evict += size
+      if (self._bytes_since_evict < self._max_bytes * _EVICT_FRACTION and
+          now < self._last_evict + _EVICT_INTERVAL_SECONDS):
+        return
+      self._bytes_since_evict = 0
+      self._last_evict = now
+    try:
+      self.evict()
+    except (IOError, OSError) as err:
+      _logger.warning('Failed to evict the disk cache: %s', err)
+
+  def evict(self):
+    """Evict the least recently used objects until the cache isn't too large.
+
+    Stale temporary files are removed too. It's skipped if another process is
+    evicting.
+    """
+    with open(os.path.join(self._dir, _LOCK_FILE), 'a') as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+          return
+        raise
+
+      now = time.time()
+      total_bytes = 0
+      objects = []
+      for dirpath, _, filenames in os.walk(self._dir):
+        for filename in filenames:
+          path = os.path.join(dirpath, filename)
+          st = _ignore_missing(os.stat, path)
+          if st is None or filename == _LOCK_FILE:
+            continue
+          if filename.startswith(_TEMP_FILE_PREFIX):
+            if st.st_mtime < now - _STALE_TEMP_FILE_SECONDS:
+              _ignore_missing(os.unlink, path)
+            continue
+          total_bytes += st.st_size
+          objects.append((st.st_atime, st.st_size, path))
+
+      objects.sort()
+      for _, size, path in objects:
+        if total_bytes <= self._max_bytes:
+          break
+        _logger.info('Evicting %s of %d bytes from the disk cache.', path,
+                     size)
+        _ignore_missing(os.unlink, path)
+        total_bytes -= size
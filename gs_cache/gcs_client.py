@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An in-process client of the Google Cloud Storage JSON API.
+
+It's an alternative of gsutil for the few operations the server needs, i.e.
+getting the metadata of an object and downloading (a range of) it. Calling
+gsutil costs a subprocess and seconds of Python startup for each operation,
+while the client reuses pooled HTTPS connections.
+
+A large object is downloaded in slices by parallel range requests. All slices
+are of the same generation of the object, so a new generation uploaded in the
+middle of downloading doesn't mess up the content. The slices read ahead of
+the consumer are bounded by a byte budget shared by all downloads, so many
+concurrent downloads to slow clients don't exhaust the memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import subprocess
+import threading
+import time
+import urllib
+from multiprocessing import pool
+
+import requests
+
+import constants
+import http_pool
+from chromite.lib import cros_logging as logging
+from chromite.lib import gs
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_ENDPOINT = 'https://storage.googleapis.com'
+DEFAULT_SLICE_SIZE_BYTES = 8 * 1024 * 1024  # 8 MB
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_READ_AHEAD_SLICES = 4
+DEFAULT_READ_AHEAD_BYTES = 128 * 1024 * 1024  # 128 MB
+
+_METADATA_SERVER_TOKEN_URL = (
+    'http://metadata.google.internal/computeMetadata/v1/instance/'
+    'service-accounts/default/token')
+# Refresh the access token a while before it expires.
+_TOKEN_EXPIRATION_MARGIN_SECONDS = 60
+# The lifetime of an access token printed by a command, which is usually one
+# hour.
+_COMMAND_TOKEN_LIFETIME_SECONDS = 30 * 60
+_TIMEOUT_SECONDS = 60
+
+StatResult = collections.namedtuple(
+    'StatResult', ['content_length', 'content_type', 'generation'])
+
+
+class Error(Exception):
+  """Error of accessing GCS, other than the object doesn't exist."""
+
+
+def _split_gs_path(path):
+  """Split a GS path into the bucket and the object name.
+
+  Examples:
+    >>> _split_gs_path('gs://bucket/path/to/file')
+    ('bucket', 'path/to/file')
+  """
+  if not path.startswith('gs://'):
+    raise ValueError('Not a GS path: %s' % path)
+  bucket, _, name = path[len('gs://'):].partition('/')
+  if not bucket or not name:
+    raise ValueError('Not a GS object: %s' % path)
+  return bucket, name
+
+
+class _ByteBudget(object):
+  """A number of bytes shared by downloads, e.g. of the buffered slices."""
+
+  def __init__(self, size):
+    self._lock = threading.Lock()
+    self._available = size
+
+  def try_acquire(self, size):
+    """Take |size| bytes from the budget if available.
+
+    Returns:
+      True if the bytes are taken.
+    """
+    with self._lock:
+      if size > self._available:
+        return False
+      self._available -= size
+      return True
+
+  def release(self, size):
+    """Give |size| bytes back to the budget."""
+    with self._lock:
+      self._available += size
+
+
+class _BudgetedSlice(object):
+  """The budget taken by a slice read ahead.
+
+  The bytes are held by both the download and the consumer of the slice, and
+  given back when both release them, i.e. the download is done and the
+  consumer either took the slice or is gone.
+  """
+
+  def __init__(self, budget, size):
+    self._budget = budget
+    self._size = size
+    self._lock = threading.Lock()
+    self._holders = 2
+    # Whether the consumer is gone, so the slice needn't be downloaded.
+    self.abandoned = False
+
+  def release(self):
+    """Release the bytes held by the download or the consumer."""
+    with self._lock:
+      self._holders -= 1
+      last = not self._holders
+    if last:
+      self._budget.release(self._size)
+
+
+class _Credentials(object):
+  """The access token of GCS, which is refreshed before expired."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._token = None
+    self._expiration = 0
+
+  def _refresh(self):
+    """Get a new access token.
+
+    Returns:
+      A tuple of the access token and its lifetime in seconds.
+    """
+    raise NotImplementedError()
+
+  def authorization(self):
+    """Get the value of Authorization header."""
+    with self._lock:
+      if time.time() >= self._expiration:
+        token, lifetime = self._refresh()
+        self._token = token
+        self._expiration = (time.time() + lifetime -
+                            _TOKEN_EXPIRATION_MARGIN_SECONDS)
+      return 'Bearer %s' % self._token
+
+
+class MetadataServerCredentials(_Credentials):
+  """The credentials of the default service account of a GCE instance."""
+
+  def __init__(self, url=_METADATA_SERVER_TOKEN_URL):
+    super(MetadataServerCredentials, self).__init__()
+    self._url = url
+
+  def _refresh(self):
+    try:
+      rsp = requests.get(self._url, headers={'Metadata-Flavor': 'Google'},
+                         timeout=_TIMEOUT_SECONDS)
+      rsp.raise_for_status()
+      token = rsp.json()
+      return token['access_token'], token['expires_in']
+    except (requests.RequestException, ValueError, KeyError) as err:
+      raise Error('Failed to get the access token from %s: %s' %
+                  (self._url, err))
+
+
+class CommandCredentials(_Credentials):
+  """The credentials printed by a command.
+
+  For example, `gcloud auth print-access-token`.
+  """
+
+  def __init__(self, command):
+    """Constructor.
+
+    Args:
+      command: The command line, which is run by shell.
+    """
+    super(CommandCredentials, self).__init__()
+    self._command = command
+
+  def _refresh(self):
+    try:
+      token = subprocess.check_output(self._command, shell=True).strip()
+    except (OSError, subprocess.CalledProcessError) as err:
+      raise Error('Failed to get the access token by "%s": %s' %
+                  (self._command, err))
+    return token, _COMMAND_TOKEN_LIFETIME_SECONDS
+
+
+class GcsClient(object):
+  """A client of GCS JSON API."""
+
+  def __init__(self, endpoint=DEFAULT_ENDPOINT, credentials=None,
+               pool_size=http_pool.DEFAULT_POOL_SIZE,
+               slice_size=DEFAULT_SLICE_SIZE_BYTES,
+               download_workers=DEFAULT_DOWNLOAD_WORKERS,
+               read_ahead_slices=DEFAULT_READ_AHEAD_SLICES,
+               read_ahead_bytes=DEFAULT_READ_AHEAD_BYTES):
+    """Constructor.
+
+    Args:
+      endpoint: The URL of GCS.
+      credentials: An instance of _Credentials to authorize requests. Requests
+        are anonymous if it's None.
+      pool_size: The max number of connections kept alive by each thread.
+      slice_size: The size of each slice when downloading an object.
+      download_workers: The max number of slices downloaded concurrently,
+        shared by all downloads.
+      read_ahead_slices: The max number of slices a download reads ahead.
+      read_ahead_bytes: The max bytes of slices read ahead by all downloads.
+        Each download has one slice in flight regardless of it, so it goes on
+        when the others use up the budget.
+    """
+    self._endpoint = endpoint.rstrip('/')
+    self._credentials = credentials
+    self._pool_size = pool_size
+    self._slice_size = slice_size
+    self._download_workers = download_workers
+    self._read_ahead_slices = read_ahead_slices
+    self._read_ahead_budget = _ByteBudget(read_ahead_bytes)
+    self._download_pool = None
+    self._download_pool_lock = threading.Lock()
+    # Sessions aren't thread safe, so each thread has its own.
+    self._thread_local = threading.local()
+
+  def _get_session(self):
+    """Get the session of current thread, which keeps connections alive."""
+    session = getattr(self._thread_local, 'session', None)
+    if session is None:
+      session = http_pool.new_session(self._pool_size)
+      self._thread_local.session = session
+    return session
+
+  def _get_download_pool(self):
+    """Get the thread pool downloading slices, which is created on demand."""
+    with self._download_pool_lock:
+      if self._download_pool is None:
+        self._download_pool = pool.ThreadPool(self._download_workers)
+      return self._download_pool
+
+  def _request(self, path, params, headers=None, stream=False):
+    """Send a GET request of the object |path|.
+
+    Returns:
+      The response, which is successful.
+
+    Raises:
+      gs.GSNoSuchKey if the object doesn't exist.
+      Error for other errors.
+    """
+    bucket, name = _split_gs_path(path)
+    url = '%s/storage/v1/b/%s/o/%s' % (self._endpoint,
+                                       urllib.quote(bucket, safe=''),
+                                       urllib.quote(name, safe=''))
+    headers = dict(headers or {})
+    if self._credentials:
+      headers['Authorization'] = self._credentials.authorization()
+    try:
+      rsp = self._get_session().get(url, params=params, headers=headers,
+                                    stream=stream, timeout=_TIMEOUT_SECONDS)
+    except requests.RequestException as err:
+      raise Error('Failed to request %s: %s' % (path, err))
+
+    if rsp.status_code == 404:
+      rsp.close()
+      raise gs.GSNoSuchKey('%s: No such object.' % path)
+    if not 200 <= rsp.status_code < 300:
+      rsp.close()
+      raise Error('GCS responded %d to the request of %s' %
+                  (rsp.status_code, path))
+    return rsp
+
+  def stat(self, path):
+    """Get the metadata of the object |path|.
+
+    Returns:
+      An instance of StatResult.
+    """
+    rsp = self._request(path, {'fields': 'size,contentType,generation'})
+    try:
+      metadata = rsp.json()
+      return StatResult(content_length=int(metadata['size']),
+                        content_type=metadata.get('contentType'),
+                        generation=int(metadata['generation']))
+    except (ValueError, KeyError) as err:
+      raise Error('Bad metadata of %s: %s' % (path, err))
+
+  def _download_slice(self, path, generation, start, stop):
+    """Download the bytes [start, stop) of the object."""
+    rsp = self._request(path, {'alt': 'media', 'generation': generation},
+                        headers={'Range': 'bytes=%d-%d' % (start, stop - 1)})
+    if len(rsp.content) != stop - start:
+      raise Error('Got %d bytes of %s, expected %d' %
+                  (len(rsp.content), path, stop - start))
+    return rsp.content
+
+  def _download_budgeted_slice(self, budgeted, path, generation, start, stop):
+    """Download a slice unless its consumer is gone, then release its budget.
+
+    Returns:
+      The content of the slice, or None if the consumer is gone.
+    """
+    try:
+      if budgeted.abandoned:
+        return None
+      return self._download_slice(path, generation, start, stop)
+    finally:
+      budgeted.release()
+
+  def cat(self, path, generation=None, start=0, stop=None):
+    """Download the object |path|.
+
+    The first slice is requested before returning, so an error of the request,
+    e.g. the object doesn't exist, is raised by this function.
+
+    Args:
+      path: The GS path of the object.
+      generation: The generation of the object. Default to the latest one.
+      start: The start of the range to download.
+      stop: The end of the range to download, exclusive. Default to the end of
+        the object.
+
+    Returns:
+      An iterator of the content.
+    """
+    params = {'alt': 'media'}
+    if generation is not None:
+      params['generation'] = generation
+    first_stop = start + self._slice_size
+    if stop is not None:
+      if start >= stop:
+        return iter([])
+      first_stop = min(first_stop, stop)
+
+    rsp = self._request(path, params, stream=True, headers={
+        'Range': 'bytes=%d-%d' % (start, first_stop - 1)})
+    if rsp.status_code != 206:
+      # The whole object is responded, e.g. it's empty.
+      if start:
+        rsp.close()
+        raise Error('GCS ignored the range of %s' % path)
+      return rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES)
+
+    # Content-Range: bytes <first>-<last>/<size>
+    size = int(rsp.headers['Content-Range'].rpartition('/')[2])
+    stop = size if stop is None else min(stop, size)
+    generation = rsp.headers.get('x-goog-generation', generation)
+    if first_stop < stop:
+      _logger.debug('Downloading %s (generation %s) in slices of %d bytes.',
+                    path, generation, self._slice_size)
+    return self._iter_slices(rsp, path, generation, first_stop, stop)
+
+  def _iter_slices(self, rsp, path, generation, start, stop):
+    """Yield the content of |rsp| and the slices of [start, stop) after it.
+
+    Slices are downloaded in the background while the content is yielded.
+    """
+    # Tuples of the async result of a slice and its _BudgetedSlice.
+    slices = collections.deque()
+    pending = collections.deque(xrange(start, stop, self._slice_size))
+
+    def read_ahead():
+      while pending and len(slices) < self._read_ahead_slices:
+        offset = pending[0]
+        size = min(offset + self._slice_size, stop) - offset
+        # The first slice in flight is free, so the download never stalls.
+        cost = size if slices else 0
+        if cost and not self._read_ahead_budget.try_acquire(cost):
+          return
+        pending.popleft()
+        budgeted = _BudgetedSlice(self._read_ahead_budget, cost)
+        slices.append((self._get_download_pool().apply_async(
+            self._download_budgeted_slice,
+            (budgeted, path, generation, offset, offset + size)), budgeted))
+
+    try:
+      read_ahead()
+      for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
+        yield chunk
+      rsp.close()
+      while slices:
+        result, budgeted = slices.popleft()
+        try:
+          data = result.get()
+        finally:
+          budgeted.release()
+        read_ahead()
+        yield data
+    finally:
+      rsp.close()
+      # The budget of slices downloading is released when they are done.
+      for _, budgeted in slices:
+        budgeted.abandoned = True
+        budgeted.release()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Serve gs_archive_server by gevent instead of a pool of threads.
+
+CherryPy serves each connection by a thread of its pool, and a long download
+to a slow client holds the thread while it's mostly waiting on I/O. In this
+mode, the same RPCs are served by a WSGI server of gevent, where each
+connection is a greenlet. Thousands of slow downloads are held without a
+thread per connection.
+
+The standard library is monkey patched before anything else is imported, so
+sockets, subprocesses and the thread local request context of CherryPy are
+cooperative. A response is streamed with backpressure: the next chunk isn't
+produced until the previous one is written to the socket. Decompressing in
+process, which holds the CPU, runs in the native thread pool of gevent.
+
+Run `./bin/gs_archive_server --gevent` with the other arguments of
+gs_archive_server.
+"""
+
+# pylint: disable=wrong-import-position
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import socket
+import sys
+
+import cherrypy
+import gevent
+from gevent import pool
+from gevent import pywsgi
+
+import gs_archive_server
+
+_DEFAULT_MAX_CONNECTIONS = 10000
+
+
+def _listen(args):
+  """Create the listening socket of the server."""
+  if args.socket:
+    if os.path.exists(args.socket):
+      os.unlink(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(args.socket)
+  else:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', args.port))
+  sock.listen(socket.SOMAXCONN)
+  return sock
+
+
+def _run_in_threadpool(func, *args):
+  """Run |func| in a native thread, without blocking other greenlets."""
+  return gevent.get_hub().threadpool.apply(func, args)
+
+
+def parse_args(argv):
+  """Parse arguments."""
+  parser = gs_archive_server.create_parser()
+  parser.add_argument(
+      '--max-connections', metavar='N', type=int,
+      default=_DEFAULT_MAX_CONNECTIONS,
+      help='The max number of connections served concurrently. Default: '
+      '%(default)s.')
+  return parser.parse_args(argv)
+
+
+def main(argv):
+  """Main function."""
+  args = parse_args(argv)
+  gs_archive_server.setup_logger()
+
+  if args.socket:
+    # in order to allow group user writing to domain socket, the directory
+    # should have GID bit set, i.e. g+s
+    os.umask(0002)
+
+  # Greenlets never preempt each other, so they can share the connections to
+  # the caching server.
+  app = cherrypy.tree.mount(gs_archive_server.create_server(
+      args, shared_session=True, cpu_executor=_run_in_threadpool))
+  cherrypy.config.update({'environment': 'embedded'})
+  cherrypy.server.unsubscribe()
+  cherrypy.engine.start()
+
+  server = pywsgi.WSGIServer(_listen(args), app,
+                             spawn=pool.Pool(args.max_connections))
+  try:
+    server.serve_forever()
+  finally:
+    cherrypy.engine.exit()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -9,11 +9,20 @@ Run `./bin/gs_archive_server` to start the server. After started, it listens on
 a TCP port and/or an Unix domain socket. The latter performs better when work
 with a local hosted reverse proxy server, e.g. Nginx.
 
+Run `./bin/gs_archive_server --gevent` to serve connections by greenlets
+instead of a pool of threads. See gevent_server.
+
 The server accepts below requests:
   - GET /download/<bucket>/path/to/file
       Download the file from google storage.
   - GET /extract/<bucket>/path/to/archive?file=path/to/file
       Extract a file form a compressed/uncompressed TAR archive.
+  - POST /prefetch/<bucket>/path/to/file
+      Download, decompress and index the file in the background.
+  - GET /admission_status
+      Get the metrics of the admission control of RPCs.
+  - GET /stats
+      Get the histograms of the timing of the phases of RPCs.
 """
 
 from __future__ import absolute_import
@@ -26,25 +35,60 @@ import fnmatch
 import functools
 import httplib
 import itertools
+import json
 import os
+import sqlite3
 import StringIO
-import subprocess
 import sys
 import tempfile
+import threading
 import urllib
 import urlparse
+import uuid
+from multiprocessing import pool
 
 import cherrypy
 import requests
+from cherrypy.lib import httputil
+from cherrypy.lib import static
 
+import admission
 import constants
+import decompress_pipeline
+import disk_cache
+import gcs_client
+import http_pool
+import member_index
+import prefetcher
 import range_response
+import seek_index
+import single_flight
+import stat_cache
 import tarfile_utils
+import tracing
 from chromite.lib import cros_logging as logging
 from chromite.lib import gs
 
 _WRITE_BUFFER_SIZE_BYTES = 1024 * 1024  # 1 MB
-_MAX_RANGES_PER_REQUEST = 100
+_MAX_RANGES_PER_REQUEST = 1000
+# Too long Range header results in error of 'request header too long'. Nginx
+# accepts header lines up to 8 KB by default (large_client_header_buffers).
+_MAX_RANGE_HEADER_BYTES = 7 * 1024
+
+_DEFAULT_RANGE_REQUEST_WORKERS = 4
+_DEFAULT_RANGE_REQUEST_THREADS = 32
+# Tar members are aligned to 512 bytes blocks and each has a header of 512
+# bytes. So small members in a directory are usually a few blocks apart.
+_DEFAULT_RANGE_MERGE_GAP_BYTES = 4096
+
+# The formats of the output of `extract` RPC.
+_EXTRACT_OUTPUTS = ('json', 'tar', 'frames', 'multipart')
+
+_TAR_EXT_NAMES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# Downloads of objects up to this size, e.g. control files, are admitted before
+# bulk transfers of payloads.
+_DEFAULT_INTERACTIVE_MAX_BYTES = 1024 * 1024
 
 # When extract files from TAR (either compressed or uncompressed), we suppose
 # the TAR exists, so we can call `download` RPC to get it. It's straightforward
@@ -62,6 +106,8 @@ _SPOOL_FILE_SIZE_BYTES = 100 * 1024 * 1024  # 100 MB
 
 _logger = logging.getLogger(__file__)
 
+_NULL_TRACE = tracing.NullTrace()
+
 
 def _log(*args, **kwargs):
   """A wrapper function of logging.debug/info, etc."""
@@ -75,6 +121,24 @@ def _log_filtered_headers(all_headers, filtered_headers, level=logging.DEBUG):
                                 filtered_headers}, level=level)
 
 
+def _read_raw_body():
+  """Read the body of a request whose body isn't processed by CherryPy.
+
+  The body is read from the raw socket file, which must be read by exactly
+  Content-Length bytes.
+  """
+  length = cherrypy.request.headers.get('Content-Length')
+  if length is None:
+    raise cherrypy.HTTPError(httplib.LENGTH_REQUIRED,
+                             'Content-Length is required.')
+  try:
+    length = int(length)
+  except ValueError:
+    raise cherrypy.HTTPError(httplib.BAD_REQUEST,
+                             'Invalid Content-Length: %s' % length)
+  return cherrypy.request.rfile.read(length)
+
+
 def _check_file_extension(filename, ext_names=None):
   """Check the file name and, optionally, the ext name.
 
@@ -148,6 +212,39 @@ def _to_cherrypy_error(func):
   return func_wrapper
 
 
+def _trace():
+  """Get the tracing.Trace of current request."""
+  return getattr(cherrypy.request, 'gs_cache_trace', None) or _NULL_TRACE
+
+
+def _traced(func):
+  """A decorator to trace the phases of a RPC of GsArchiveServer.
+
+  The spans finished before the response is sent are reported by the header
+  Server-Timing. The trace, including the span of streaming the response, is
+  added to the stats of the server once the request is done.
+  """
+  @functools.wraps(func)
+  def func_wrapper(self, *args, **kwargs):
+    trace = tracing.Trace(func.__name__)
+    cherrypy.request.gs_cache_trace = trace
+    # pylint: disable=protected-access
+    try:
+      content = func(self, *args, **kwargs)
+    except cherrypy.HTTPError as err:
+      self._stats.record(trace, err.status)
+      raise
+    except Exception:
+      self._stats.record(trace, httplib.INTERNAL_SERVER_ERROR)
+      raise
+
+    cherrypy.response.headers['Server-Timing'] = trace.server_timing()
+    status = cherrypy.response.status or httplib.OK
+    return tracing.trace_content(
+        content, trace, lambda: self._stats.record(trace, status))
+  return func_wrapper
+
+
 def _search_lines_by_pattern(all_lines, patterns):
   """Search plain text lines which matches one of shell style glob |patterns|.
 
@@ -166,20 +263,167 @@ def _search_lines_by_pattern(all_lines, patterns):
   return found_lines
 
 
-def _split_into_chunks(iterable, size):
-  """Split the iterable into chunks of |size|.
+def _compressed_tar_name(path, ext_name):
+  """Get the name of compressed TAR by the name of TAR and the extension name.
+
+  Examples:
+    >>> _compressed_tar_name('path/to/foo.tar', '.gz')
+    'path/to/foo.tar.gz'
+    >>> _compressed_tar_name('path/to/foo.tar', '.tgz')
+    'path/to/foo.tgz'
+  """
+  # It's special for '.tgz', i.e. 'foo.tar' + '.tgz' => 'foo.tgz'
+  if ext_name == '.tgz':
+    path, _ = os.path.splitext(path)
+
+  return '%s%s' % (path, ext_name)
+
+
+def _decompressed_tar_name(archive):
+  """Get the name of TAR decompressed from |archive| and the extension name.
+
+  Examples:
+    >>> _decompressed_tar_name('path/to/foo.tgz')
+    ('path/to/foo.tar', '.tgz')
+    >>> _decompressed_tar_name('path/to/foo.tar.xz')
+    ('path/to/foo.tar', '.xz')
+    >>> _decompressed_tar_name('path/to/foo.tar')
+    ('path/to/foo.tar', None)
+  """
+  basename, ext_name = os.path.splitext(archive)
+  if ext_name == '.tar':
+    return archive, None
+  # e.g. foo.tgz => foo.tar, bar.tar.xz => bar.tar, etc.
+  if ext_name == '.tgz':
+    return '%s.tar' % basename, ext_name
+  return basename, ext_name
+
+
+def _member_list_csv(members):
+  """Format tar members as CSV lines and yield them in chunks.
+
+  Args:
+    members: An iterable of tarfile_utils.TarMemberInfo.
+
+  Yields:
+    Chunks of CSV lines. See `GsArchiveServer.list_member` for the format.
+  """
+  with contextlib.closing(StringIO.StringIO()) as stream:
+    for info in members:
+      # Encode file name using URL percent encoding, so ',' in file name
+      # becomes to '%2C'.
+      stream.write('%s,%d,%d,%d,%d\n' % (
+          urllib.quote(info.filename), int(info.record_start),
+          int(info.record_size), int(info.content_start), int(info.size)))
+
+      if stream.tell() > _WRITE_BUFFER_SIZE_BYTES:
+        yield stream.getvalue()
+        stream.seek(0)
+        stream.truncate()
+
+    if stream.tell():
+      yield stream.getvalue()
+
+
+def _new_streamer(output):
+  """Create the streamer of extracted files in format of |output|."""
+  if output == 'tar':
+    return range_response.TarStreamer()
+  if output == 'frames':
+    return range_response.FramesStreamer()
+  if output == 'multipart':
+    return range_response.MultipartStreamer()
+  return range_response.JsonStreamer()
+
+
+def _range_spec(span):
+  """Get the byte range spec covering the content of tar members in |span|.
+
+  Examples:
+    >>> _range_spec([tarfile_utils.TarMemberInfo('foo', 0, 1024, 512, 100)])
+    '512-611'
+    >>> _range_spec([tarfile_utils.TarMemberInfo('foo', 0, 1024, 512, 100),
+    ...              tarfile_utils.TarMemberInfo('bar', 1024, 512, 1536, 8)])
+    '512-1543'
+  """
+  start = int(span[0].content_start)
+  end = max(int(m.content_start) + int(m.size) - 1 for m in span)
+  return '%d-%d' % (start, end)
+
+
+def _coalesce_ranges(members, max_gap):
+  """Merge the ranges of tar members close to each other.
+
+  Members are fetched by one byte range if the gap between them is no more than
+  |max_gap| bytes, and sliced out of the range locally. It saves the framing of
+  multipart/byteranges responses for small members next to each other, e.g.
+  the files in a directory.
 
   Examples:
-    >>> list(_split_into_chunks(range(10), 3))
-    [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
-    >>> list(_split_into_chunks(xrange(8), 4))
-    [[0, 1, 2, 3], [4, 5, 6, 7]]
+    >>> members = [tarfile_utils.TarMemberInfo('', 0, 0, start, 10)
+    ...            for start in (0, 10, 30, 1000)]
+    >>> [[m.content_start for m in s] for s in _coalesce_ranges(members, 512)]
+    [[0, 10, 30], [1000]]
+    >>> [[m.content_start for m in s] for s in _coalesce_ranges(members, -1)]
+    [[0], [10], [30], [1000]]
+
+  Args:
+    members: An iterable of tarfile_utils.TarMemberInfo sorted by the offset.
+    max_gap: The max bytes between two ranges to be merged. A negative value
+      disables merging.
+
+  Yields:
+    Lists of tarfile_utils.TarMemberInfo, each of which is fetched by a range.
   """
-  iter_ = iter(iterable)
-  chunk = list(itertools.islice(iter_, size))
-  while chunk:
-    yield chunk
-    chunk = list(itertools.islice(iter_, size))
+  span = []
+  span_end = -1
+  for member in members:
+    start = int(member.content_start)
+    if span and start - span_end - 1 > max_gap:
+      yield span
+      span = []
+    span.append(member)
+    span_end = max(span_end, start + int(member.size) - 1)
+
+  if span:
+    yield span
+
+
+def _split_into_range_requests(spans):
+  """Split |spans| into groups, each of which is fetched by a range request.
+
+  A group has at most _MAX_RANGES_PER_REQUEST ranges, and its Range header is
+  no longer than _MAX_RANGE_HEADER_BYTES. So short ranges are packed into fewer
+  requests.
+
+  Examples:
+    >>> spans = [[tarfile_utils.TarMemberInfo('', 0, 0, i, 1)]
+    ...          for i in xrange(4)]
+    >>> [[s[0].content_start for s in g] for g in
+    ...  _split_into_range_requests(spans)]
+    [[0, 1, 2, 3]]
+
+  Args:
+    spans: An iterable of lists of tarfile_utils.TarMemberInfo, each of which
+      is fetched by a range.
+
+  Yields:
+    Lists of spans.
+  """
+  group = []
+  header_size = len('bytes=')
+  for span in spans:
+    spec_size = len(_range_spec(span)) + len(',')
+    if group and (len(group) >= _MAX_RANGES_PER_REQUEST or
+                  header_size + spec_size > _MAX_RANGE_HEADER_BYTES):
+      yield group
+      group = []
+      header_size = len('bytes=')
+    group.append(span)
+    header_size += spec_size
+
+  if group:
+    yield group
 
 
 class _CachingServer(object):
@@ -201,16 +445,42 @@ class _CachingServer(object):
                                                          GoogleStorage
   """
 
-  def __init__(self, url):
+  def __init__(self, url, pool_size=http_pool.DEFAULT_POOL_SIZE,
+               shared_session=False):
     """Constructor
 
     Args:
-      url: A tuple of URL scheme and netloc.
+      url: A tuple of URL scheme and netloc, or ('unix', socket path) of an
+        Unix domain socket.
+      pool_size: The max number of connections kept alive by each thread.
+      shared_session: Whether all threads share one session. It's only safe
+        when the threads are greenlets, which don't preempt each other.
 
     Raises:
       ValueError: Raised when input URL in wrong format.
     """
     self._url = url
+    self._unix_socket = None
+    if url[0] == 'unix':
+      self._url = (http_pool.UNIX_SOCKET_SCHEME, http_pool.UNIX_SOCKET_HOST)
+      self._unix_socket = url[1]
+    self._pool_size = pool_size
+    # Sessions aren't thread safe, so each CherryPy thread has its own.
+    self._thread_local = threading.local()
+    self._shared_session = (self._new_session() if shared_session else None)
+
+  def _new_session(self):
+    return http_pool.new_session(self._pool_size, unix_socket=self._unix_socket)
+
+  def _get_session(self):
+    """Get the session of current thread, which keeps connections alive."""
+    if self._shared_session:
+      return self._shared_session
+    session = getattr(self._thread_local, 'session', None)
+    if session is None:
+      session = self._new_session()
+      self._thread_local.session = session
+    return session
 
   def _call(self, action, path, args=None, headers=None):
     """Helper function to generate all RPC calls to the proxy server."""
@@ -220,7 +490,7 @@ class _CachingServer(object):
     # The header to control using or bypass cache.
     _log_filtered_headers(headers, ('Range', 'X-No-Cache',
                                     _HTTP_HEADER_COMPRESSED_TAR_EXT))
-    rsp = requests.get(url, headers=headers, stream=True)
+    rsp = self._get_session().get(url, headers=headers, stream=True)
     _log('Caching server response %s: %s', rsp.status_code, url)
     _log_filtered_headers(rsp.headers, ('Content-Type', 'Content-Length',
                                         'Content-Range', 'X-Cache',
@@ -233,11 +503,7 @@ class _CachingServer(object):
     # The |path| we have is like foo.tar. Combine with |ext_name| we can get
     # the compressed file name on Google storage, e.g.
     # 'foo.tar' + '.gz' => foo.tar.gz
-    # But it's special for '.tgz', i.e. 'foo.tar' + '.tgz' => 'foo.tgz'
-    if ext_name == '.tgz':
-      path, _ = os.path.splitext(path)
-
-    path = '%s%s' % (path, ext_name)
+    path = _compressed_tar_name(path, ext_name)
     _log('Download and decompress %s', path)
     return self._call('decompress', path, headers=headers)
 
@@ -262,12 +528,134 @@ class _CachingServer(object):
 class GsArchiveServer(object):
   """The backend of Google Storage Cache server."""
 
-  def __init__(self, caching_server):
+  def __init__(self, caching_server, tar_member_index=None,
+               seek_indexes=None, stream_decompression=False,
+               range_request_workers=_DEFAULT_RANGE_REQUEST_WORKERS,
+               range_request_threads=_DEFAULT_RANGE_REQUEST_THREADS,
+               range_merge_gap=_DEFAULT_RANGE_MERGE_GAP_BYTES,
+               object_cache=None, single_flight=None, gcs=None,
+               metadata_cache=None, prefetch_workers=0,
+               prefetch_max_queued=prefetcher.DEFAULT_MAX_QUEUED,
+               admission_controller=None,
+               interactive_max_bytes=_DEFAULT_INTERACTIVE_MAX_BYTES,
+               cpu_executor=None):
+    """Constructor.
+
+    Args:
+      caching_server: An instance of _CachingServer.
+      tar_member_index: An instance of member_index.MemberIndex to save the
+        members of tar archives. Members are not indexed if it's None.
+      seek_indexes: An instance of seek_index.SeekIndexCache to save the seek
+        indexes of compressed archives. Range requests of decompressed archives
+        decompress the whole archive if it's None.
+      stream_decompression: Whether to serve the content of `decompress` RPC
+        while decompressing. The response has no Content-Length then, so the
+        caching server must have cached the whole response before serving
+        ranges of it.
+      range_request_workers: The max number of range requests sent
+        concurrently by each `extract` request.
+      range_request_threads: The number of threads sending range requests,
+        shared by all `extract` requests.
+      range_merge_gap: The max bytes between tar members to be fetched by one
+        byte range when extracting files. A negative value disables merging.
+      object_cache: An instance of disk_cache.DiskCache to save downloaded GS
+        objects. Objects are always downloaded from GS if not set.
+      single_flight: An instance of single_flight.SingleFlight to collapse
+        concurrent downloading and decompressing of the same object.
+      gcs: An instance of gcs_client.GcsClient to access GS in process. gsutil
+        is used if it's None or fails.
+      metadata_cache: An instance of stat_cache.StatCache to cache the metadata
+        of GS objects. Every download stats the object on GS if it's None.
+        The generations of indexed tar archives are cached in memory anyway.
+      prefetch_workers: The number of workers prefetching GS objects in the
+        background. The `prefetch` RPC is disabled if it's 0.
+      prefetch_max_queued: The max number of objects waiting to be prefetched.
+      admission_controller: An instance of admission.AdmissionController to
+        limit concurrent `download`, `decompress` and `extract` requests and
+        the egress bandwidth. Requests are not limited if it's None.
+      interactive_max_bytes: Downloads of objects up to this size, and range
+        requests, are admitted before bulk transfers.
+      cpu_executor: A function to run CPU bound work, e.g. decompressing in
+        process, which is called with the work function and its arguments. The
+        work runs in the request thread if it's None.
+    """
     self._gsutil = gs.GSContext()
+    self._gcs = gcs
+    self._stat_cache = metadata_cache
+    # Every request of an indexed tar archive needs its generation, which
+    # would cost a stat of GS without the metadata cache.
+    self._generation_cache = metadata_cache
+    if tar_member_index and not metadata_cache:
+      self._generation_cache = stat_cache.StatCache()
+    self._prefetcher = None
+    if prefetch_workers:
+      self._prefetcher = prefetcher.Prefetcher(
+          self._warm, workers=prefetch_workers,
+          max_queued=prefetch_max_queued)
     self._caching_server = caching_server
+    self._member_index = tar_member_index
+    self._seek_indexes = seek_indexes
+    self._stream_decompression = stream_decompression
+    self._range_request_workers = range_request_workers
+    self._range_request_threads = range_request_threads
+    self._range_request_pool = None
+    self._range_request_pool_lock = threading.Lock()
+    self._range_merge_gap = range_merge_gap
+    self._disk_cache = object_cache
+    self._single_flight = single_flight
+    self._admission = admission_controller
+    self._interactive_max_bytes = interactive_max_bytes
+    self._cpu_executor = cpu_executor
+    self._stats = tracing.Stats()
+
+  def _get_archive_generation(self, archive, headers):
+    """Get the generation of the GS object which |archive| comes from.
+
+    Args:
+      archive: The path of a TAR archive, without gs:// prefix.
+      headers: Http headers of the request. If there's header
+        _HTTP_HEADER_COMPRESSED_TAR_EXT, |archive| is decompressed from a
+        compressed TAR on GS.
+
+    Returns:
+      The generation of the GS object, or None if failed to get it.
+    """
+    ext_name = headers.get(_HTTP_HEADER_COMPRESSED_TAR_EXT)
+    if ext_name:
+      archive = _compressed_tar_name(archive, ext_name)
+
+    try:
+      with _trace().span('stat'):
+        return self._generation_cache.stat('gs://%s' % archive,
+                                           self._stat_from_gs).generation
+    except (gs.GSNoSuchKey, gs.GSCommandError) as err:
+      _log('Cannot get the generation of "%s": %s', archive, err,
+           level=logging.WARNING)
+      return None
+
+  def _index_members(self, archive, generation, members):
+    """Yield all |members| and save them to the index after the last one.
+
+    Errors of saving to the index are logged and ignored, so the listing is
+    complete anyway.
+    """
+    indexed_members = []
+    for info in members:
+      indexed_members.append(info)
+      yield info
+
+    try:
+      self._member_index.put(archive, generation, indexed_members)
+    except sqlite3.Error as err:
+      _log('Failed to index members of "%s": %s', archive, err,
+           level=logging.ERROR)
+      return
+    _log('Indexed %d members of "%s" (generation %s).', len(indexed_members),
+         archive, generation)
 
   @cherrypy.expose
   @cherrypy.config(**{'response.stream': True})
+  @_traced
   @_to_cherrypy_error
   def list_member(self, *args):
     """Get file list of an tar archive in CSV format.
@@ -295,44 +683,190 @@ class GsArchiveServer(object):
       The generator of CSV stream.
     """
     archive = _check_file_extension('/'.join(args), ext_names=['.tar'])
-    rsp = self._caching_server.download(archive, cherrypy.request.headers)
     cherrypy.response.headers['Content-Type'] = 'text/csv'
 
-    # We run tar command to get member list of a tar file (python tarfile module
-    # is too slow). Option '--block-number/-R' of tar prints out the starting
-    # block number for each file record.
-    _log('list member of the tar %s', archive)
-    tar_tv = tempfile.SpooledTemporaryFile(max_size=_SPOOL_FILE_SIZE_BYTES)
-    tar = subprocess.Popen(['tar', 'tv', '--block-number'],
-                           stdin=subprocess.PIPE, stdout=tar_tv)
-    for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
-      tar.stdin.write(chunk)
+    generation = None
+    if self._member_index:
+      generation = self._get_archive_generation(archive,
+                                                cherrypy.request.headers)
+    if generation is not None:
+      members = self._member_index.get(archive, generation)
+      if members is not None:
+        _log('Found members of "%s" (generation %s) in the index.', archive,
+             generation)
+        return _member_list_csv(members)
 
-    tar.wait()
+    rsp = self._caching_server.download(archive, cherrypy.request.headers)
+
+    # Members are parsed from the archive while it's downloading, so the CSV
+    # lines are streamed out without waiting for the whole archive.
+    _log('list member of the tar %s', archive)
+    members = tarfile_utils.list_tar_members(
+        rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES))
+    if generation is not None:
+      members = self._index_members(archive, generation, members)
 
     def _tar_member_list():
-      with tar_tv, contextlib.closing(StringIO.StringIO()) as stream:
-        tar_tv.seek(0)
-        for info in tarfile_utils.list_tar_members(tar_tv):
-          # Encode file name using URL percent encoding, so ',' in file name
-          # becomes to '%2C'.
-          stream.write('%s,%d,%d,%d,%d\n' % (
-              urllib.quote(info.filename), info.record_start, info.record_size,
-              info.content_start, info.size))
-
-          if stream.tell() > _WRITE_BUFFER_SIZE_BYTES:
-            yield stream.getvalue()
-            stream.seek(0)
-
-        if stream.tell():
-          yield stream.getvalue()
+      for csv_lines in _member_list_csv(members):
+        yield csv_lines
 
       _log('list_member done')
 
     return _tar_member_list()
 
+  def _stat(self, path):
+    """Get the metadata of the GS object |path|, which may be cached."""
+    with _trace().span('stat'):
+      if self._stat_cache:
+        return self._stat_cache.stat(path, self._stat_from_gs)
+      return self._stat_from_gs(path)
+
+  def _stat_from_gs(self, path):
+    """Get the metadata of the GS object |path| from GS."""
+    if self._gcs:
+      try:
+        return self._gcs.stat(path)
+      except gcs_client.Error as err:
+        _log('Falling back to gsutil to stat %s: %s', path, err,
+             level=logging.WARNING)
+    return self._gsutil.Stat(path)
+
+  def _cat(self, path, stat):
+    """Get an iterator of the content of the GS object |path|."""
+    return tracing.time_to_first_chunk(_trace(), 'gs_first_byte',
+                                       self._cat_from_gs(path, stat))
+
+  def _cat_from_gs(self, path, stat):
+    """Get an iterator of the content of the GS object |path| from GS."""
+    if self._gcs:
+      try:
+        return self._gcs.cat(path, generation=stat.generation,
+                             stop=int(stat.content_length))
+      except gcs_client.Error as err:
+        _log('Falling back to gsutil to download %s: %s', path, err,
+             level=logging.WARNING)
+    return self._gsutil.StreamingCat(path)
+
+  def _cat_range(self, path, stat):
+    """Download the range of the GS object |path| in the request.
+
+    Only a request of a single range is served by a range of the object, which
+    needs the GCS client.
+
+    Returns:
+      A tuple of the start and the end (exclusive) of the range, and an
+      iterator of the content in it. None if the request isn't served by a
+      range.
+    """
+    if not self._gcs or cherrypy.request.method != 'GET':
+      return None
+    size = int(stat.content_length)
+    ranges = httputil.get_ranges(cherrypy.request.headers.get('Range'), size)
+    if ranges == []:
+      cherrypy.response.headers['Content-Range'] = 'bytes */%d' % size
+      raise cherrypy.HTTPError(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+    if not ranges or len(ranges) > 1:
+      return None
+
+    start, stop = ranges[0]
+    try:
+      return start, stop, self._gcs.cat(path, generation=stat.generation,
+                                        start=start, stop=stop)
+    except gcs_client.Error as err:
+      _log('Failed to download a range of %s: %s', path, err,
+           level=logging.WARNING)
+      return None
+
+  def _should_disk_cache(self, stat):
+    """Check if an object of |stat| should be saved in the disk cache."""
+    return (self._disk_cache is not None and stat.generation is not None and
+            int(stat.content_length) <= self._disk_cache.max_bytes)
+
+  def _open_disk_cache(self, path, stat):
+    """Open the object of |path| in the disk cache for a GET request.
+
+    Returns:
+      The file object of cached object, or None if not cached.
+    """
+    if (cherrypy.request.method != 'GET' or
+        not self._should_disk_cache(stat)):
+      return None
+    try:
+      return self._disk_cache.open(path, stat.generation)
+    except IOError as err:
+      _log('Failed to open the disk cache of %s: %s', path, err,
+           level=logging.WARNING)
+      return None
+
+  def _stream_object(self, path, stat):
+    """Stream the GS object of |path|, and save it in the disk cache."""
+    _log('Downloading %s', path, level=logging.INFO)
+    content = self._cat(path, stat)
+    if self._should_disk_cache(stat):
+      content = self._disk_cache.cache(path, stat.generation, content)
+    return content
+
+  def _fetch_once(self, key, fetch_func):
+    """Call |fetch_func| to fetch content, collapsing concurrent fetches.
+
+    Args:
+      key: The key of the content. Concurrent requests of the same key share
+        one fetch if single flight is enabled.
+      fetch_func: A function returning an iterable of the content.
+
+    Returns:
+      An iterable of the content, which has method `wait` to wait for all
+      content being fetched if single flight is enabled.
+    """
+    if self._single_flight is None:
+      return fetch_func()
+
+    # Fetch in the context of current request, so logging works in the
+    # background thread.
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+
+    def fetch():
+      cherrypy.serving.load(request, response)
+      return fetch_func()
+
+    return self._single_flight.fetch(key, fetch)
+
+  @contextlib.contextmanager
+  def _admitted(self, rpc, priority):
+    """Admit a request of |rpc| in the context.
+
+    Args:
+      rpc: The name of the RPC.
+      priority: admission.INTERACTIVE or admission.BULK.
+
+    Yields:
+      A function wrapping the content of the response, which holds the
+      admission until the content is streamed.
+    """
+    if self._admission is None:
+      yield lambda content: content
+      return
+
+    _log('Admitting %s request (%s)', rpc, admission.PRIORITY_NAMES[priority])
+    try:
+      ticket = self._admission.admit(rpc, priority)
+    except admission.AdmissionTimeoutError as err:
+      _log('Rejected %s request: %s', rpc, err, level=logging.WARNING)
+      raise cherrypy.HTTPError(httplib.SERVICE_UNAVAILABLE, err.message)
+    with ticket:
+      yield ticket.stream
+
+  def _download_priority(self, stat):
+    """Get the admission priority of downloading an object of |stat|."""
+    if (cherrypy.request.headers.get('Range') or
+        stat.content_length <= self._interactive_max_bytes):
+      return admission.INTERACTIVE
+    return admission.BULK
+
   @cherrypy.expose
   @cherrypy.config(**{'response.stream': True})
+  @_traced
   @_to_cherrypy_error
   def download(self, *args):
     """Download a file from Google Storage.
@@ -347,14 +881,17 @@ class GsArchiveServer(object):
       The stream of downloaded file.
     """
     path = 'gs://%s' % _check_file_extension('/'.join(args))
-    content = None
+    stat = None
 
     try:
-      stat = self._gsutil.Stat(path)
-      if cherrypy.request.method == 'GET':
-        _log('Downloading %s', path, level=logging.INFO)
-        content = self._gsutil.StreamingCat(path)
+      stat = self._stat(path)
+      with self._admitted('download',
+                          self._download_priority(stat)) as admitted:
+        return admitted(self._download(path, stat))
     except gs.GSNoSuchKey as err:
+      if stat is not None and self._stat_cache:
+        # The cached generation was replaced or deleted.
+        self._stat_cache.invalidate(path)
       raise cherrypy.HTTPError(httplib.NOT_FOUND, err.message)
     except gs.GSCommandError as err:
       if "You aren't authorized to read" in err.result.error:
@@ -364,16 +901,46 @@ class GsArchiveServer(object):
       raise cherrypy.HTTPError(status, '%s: %s' % (err.message,
                                                    err.result.error))
 
+  def _download(self, path, stat):
+    """Serve the content of GS object |path| of metadata |stat|."""
+    content = None
+    cached = self._open_disk_cache(path, stat)
+    if cached:
+      _log('Serving %s from the disk cache', path, level=logging.INFO)
+      if stat.generation is not None:
+        cherrypy.response.headers['ETag'] = '"%s"' % stat.generation
+      # Range requests are served from the file too.
+      return static.serve_fileobj(cached, content_type=stat.content_type)
+
+    byte_range = self._cat_range(path, stat)
+    if byte_range is None and cherrypy.request.method == 'GET':
+      content = self._fetch_once(('download', path, stat.generation),
+                                 functools.partial(self._stream_object,
+                                                   path, stat))
+
     cherrypy.response.headers.update({
         'Content-Type': stat.content_type,
         'Accept-Ranges': 'bytes',
         'Content-Length': stat.content_length,
     })
-
+    # The generation identifies the content of the object, so it's used to
+    # tell if a seek index of the object is out of date.
+    if stat.generation is not None:
+      cherrypy.response.headers['ETag'] = '"%s"' % stat.generation
+
+    if byte_range is not None:
+      start, stop, content = byte_range
+      cherrypy.response.status = httplib.PARTIAL_CONTENT
+      cherrypy.response.headers.update({
+          'Content-Range': 'bytes %d-%d/%s' % (start, stop - 1,
+                                               stat.content_length),
+          'Content-Length': stop - start,
+      })
     return content
 
   @cherrypy.expose
   @cherrypy.config(**{'response.stream': True})
+  @_traced
   @_to_cherrypy_error
   def extract(self, *args, **kwargs):
     """Extract files from a compressed/uncompressed Tar archive.
@@ -391,6 +958,16 @@ class GsArchiveServer(object):
     The query can be encoded using 'percent-encoding', i.e. '/' -> '%2F',
     '*' -> '%2A', etc.
 
+    The optional query 'output=' specifies the format of the output:
+      json: (default) A JSON object of {filename: content, ...}.
+      tar: A tar archive of the extracted files, which consists of the original
+        records of them in the archive.
+      frames: A series of length-prefixed frames of files. See
+        range_response.FramesStreamer.
+      multipart: A multipart/mixed body, a part for each file.
+    Binary files are not escaped in formats other than JSON, so clients can
+    write them to disk directly from the socket.
+
     Examples:
       Extracting file 'path/to/file' from files.tgz:
       GET /extract/<bucket>/files.tgz?file=path%2Fto%2Ffile
@@ -398,27 +975,34 @@ class GsArchiveServer(object):
       Extracting all files in pattern of '*/control' or '*/control.*':
       GET /extract/<bucket>/files.tgz?file=*/control&file=*/control.*
 
+      Extracting all files in 'dir/' as a tar archive:
+      GET /extract/<bucket>/files.tgz?file=dir/*&output=tar
+
     Args:
       *args: All parts of the GS path of the archive, without gs:// prefix.
       kwargs: file: The path or pattern of file to be extracted.
+              output: The format of the output.
 
     Returns:
-      The JSON stream of extracted file, in details:
+      The stream of extracted file. In JSON format, in details:
         1. No file match the pattern, return empty json, i.e. '{}'.
         2. One or more files match the pattern, return
           '{filename: content, filename: content, ...}'.
     """
-    archive = _check_file_extension(
-        '/'.join(args),
-        ext_names=['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz'])
+    archive = _check_file_extension('/'.join(args),
+                                    ext_names=_TAR_EXT_NAMES)
     files = _safe_get_param(kwargs, 'file')
+    output = kwargs.get('output', 'json')
+    if output not in _EXTRACT_OUTPUTS:
+      raise cherrypy.HTTPError(
+          httplib.BAD_REQUEST, 'Output format must be one of %s, not "%s".' %
+          (', '.join(_EXTRACT_OUTPUTS), output))
     _log('Extracting "%s" from "%s".', files, archive)
-    archive_basename, archive_extname = os.path.splitext(archive)
 
     headers = cherrypy.request.headers.copy()
-    if archive_extname == '.tar':
-      decompressed_archive_name = archive
-    else:
+    decompressed_archive_name, archive_extname = _decompressed_tar_name(
+        archive)
+    if archive_extname:
       # Compressed tar archives: we don't decompress them here. Instead, we
       # suppose they have been decompressed, and continue the routine to extract
       # from the supposed decompressed archive name.
@@ -427,22 +1011,150 @@ class GsArchiveServer(object):
       # In `download`, we check this header. If it exists, then call
       # `decompress` RPC other than a normal `download` RPC.
       headers[_HTTP_HEADER_COMPRESSED_TAR_EXT] = archive_extname
-      # Get the name of decompressed archive, e.g. foo.tgz => foo.tar,
-      # bar.tar.xz => bar.tar, etc.
-      if archive_extname == '.tgz':
-        decompressed_archive_name = '%s.tar' % archive_basename
-      else:
-        decompressed_archive_name = archive_basename
 
-    return self._extract_files_from_tar(files, decompressed_archive_name,
-                                        headers)
+    with self._admitted('extract', admission.INTERACTIVE) as admitted:
+      return admitted(self._extract_files_from_tar(
+          files, decompressed_archive_name, headers, output))
 
-  def _extract_files_from_tar(self, files, archive, headers=None):
+  def _extract_files_from_tar(self, files, archive, headers=None,
+                              output='json'):
     """Extract files from |archive| with http headers |headers|."""
-    # Call `list_member` and search |filename| in it. If found, create another
-    # "Range Request" to download that range of bytes.
+    # Search |files| in the index of tar members first. If not indexed, call
+    # `list_member` and search |files| in it. If found, create another "Range
+    # Request" to download that range of bytes.
+    found_members = None
+    if self._member_index:
+      generation = self._get_archive_generation(archive, headers)
+      if generation is not None:
+        with _trace().span('member_index'):
+          found_members = self._member_index.search(
+              archive, generation, [urllib.unquote(f) for f in files])
+
+    if found_members is None:
+      found_members = self._list_and_search_members(files, archive, headers)
+
+    streamer = _new_streamer(output)
+    cherrypy.response.headers['Content-Type'] = streamer.content_type
+    if not found_members:
+      return ''.join(streamer.stream())
+
+    if output == 'tar':
+      # Fetch the whole records of members, including the headers.
+      found_members = [m._replace(content_start=m.record_start,
+                                  size=m.record_size) for m in found_members]
+
+    # Too many ranges may result in error of 'request header too long'. So we
+    # merge the ranges of files close to each other, split them into groups
+    # and request them concurrently. The files are sorted by their offsets to
+    # make the output deterministic.
+    groups = _split_into_range_requests(_coalesce_ranges(
+        sorted(found_members, key=lambda f: int(f.content_start)),
+        self._range_merge_gap))
+
+    for members, rsp in self._send_range_requests(archive, groups, headers):
+      streamer.queue_response(rsp, members)
+
+    return streamer.stream()
+
+  def _get_range_request_pool(self):
+    """Get the thread pool to send range requests, which is created lazily."""
+    with self._range_request_pool_lock:
+      if self._range_request_pool is None:
+        self._range_request_pool = pool.ThreadPool(
+            self._range_request_threads)
+      return self._range_request_pool
+
+  def _send_range_requests(self, archive, groups, headers):
+    """Send range requests of |groups| of files concurrently.
 
-    all_files = self._caching_server.list_member(archive, headers=headers)
+    A request has up to |range_request_workers| range requests in the shared
+    pool at a time, so a large extraction doesn't queue up other requests.
+
+    Args:
+      archive: The archive file these range requests against to.
+      groups: An iterable of lists of spans. A range request is sent for each
+        list, which has a range for each span. See _coalesce_ranges.
+      headers: Http headers of the request.
+
+    Returns:
+      A list of (members, response) tuples in the order of |groups|, where
+      members is a list of tarfile_utils.TarMemberInfo in the response. If any
+      range request fails, the responses already received are closed.
+    """
+    def send(group):
+      return list(itertools.chain(*group)), self._send_range_request(
+          archive, [_range_spec(s) for s in group], headers)
+
+    groups = list(groups)
+    workers = min(self._range_request_workers, len(groups))
+    results = []
+    try:
+      if workers <= 1:
+        for group in groups:
+          results.append(send(group))
+      else:
+        self._send_in_pool(send, groups, workers, results)
+    except Exception:
+      exc_type, exc_value, exc_traceback = sys.exc_info()
+      for _, rsp in results:
+        rsp.close()
+      raise exc_type, exc_value, exc_traceback
+    return results
+
+  def _send_in_pool(self, send, groups, workers, results):
+    """Call |send| of |groups| in the pool, |workers| at a time.
+
+    The results are appended to |results| in the order of |groups|, even if
+    some of them fail.
+
+    Raises:
+      The exception of the first failed group.
+    """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    semaphore = threading.BoundedSemaphore(workers)
+
+    def send_in_worker(group):
+      # Run in the context of current request, so logging and the update of
+      # response status work as in the request thread.
+      cherrypy.serving.load(request, response)
+      try:
+        return send(group)
+      finally:
+        cherrypy.serving.clear()
+        semaphore.release()
+
+    range_request_pool = self._get_range_request_pool()
+    pending = []
+    for group in groups:
+      semaphore.acquire()
+      pending.append(range_request_pool.apply_async(send_in_worker, (group,)))
+
+    error = None
+    for async_result in pending:
+      try:
+        results.append(async_result.get())
+      except Exception:  # pylint: disable=broad-except
+        error = error or sys.exc_info()
+    if error:
+      exc_type, exc_value, exc_traceback = error
+      raise exc_type, exc_value, exc_traceback
+
+  def _list_and_search_members(self, files, archive, headers):
+    """Call `list_member` RPC and search |files| in the result.
+
+    Args:
+      files: A list of file names or patterns to be searched.
+      archive: The archive to be searched.
+      headers: Http headers of the request.
+
+    Returns:
+      A list of tarfile_utils.TarMemberInfo of found files.
+    """
+    with _trace().span('list_member'):
+      all_files = self._caching_server.list_member(archive, headers=headers)
+      lines = list(all_files.iter_lines(
+          chunk_size=constants.READ_BUFFER_SIZE_BYTES))
 
     # The format of each line is '<filename>,<data1>,<data2>...'. And the
     # filename is encoded by URL percent encoding, so no ',' in it. Thus
@@ -451,29 +1163,10 @@ class GsArchiveServer(object):
 
     # Loading the file list into memory doesn't consume too much memory (usually
     # just a few MBs), but which is very helpful for us to search.
-    found_lines = _search_lines_by_pattern(
-        list(all_files.iter_lines(chunk_size=constants.READ_BUFFER_SIZE_BYTES)),
-        target_files
-    )
-    if not found_lines:
-      return '{}'
-
-    # Too many ranges may result in error of 'request header too long'. So we
-    # split the files into chunks and request one by one.
-    found_files = _split_into_chunks(
-        [tarfile_utils.TarMemberInfo._make(urllib.unquote(line).rsplit(
-            ',', len(tarfile_utils.TarMemberInfo._fields) - 1))
-         for line in found_lines],
-        _MAX_RANGES_PER_REQUEST)
-
-    streamer = range_response.JsonStreamer()
-    for part_of_found_files in found_files:
-      ranges = [(int(f.content_start), int(f.content_start) + int(f.size) - 1)
-                for f in part_of_found_files]
-      rsp = self._send_range_request(archive, ranges, headers)
-      streamer.queue_response(rsp, part_of_found_files)
-
-    return streamer.stream()
+    found_lines = _search_lines_by_pattern(lines, target_files)
+    return [tarfile_utils.TarMemberInfo._make(urllib.unquote(line).rsplit(
+        ',', len(tarfile_utils.TarMemberInfo._fields) - 1))
+            for line in found_lines]
 
   def _send_range_request(self, archive, ranges, headers):
     """Create and send a "Range Request" to caching server.
@@ -483,18 +1176,17 @@ class GsArchiveServer(object):
 
     Args:
       archive: The archive file this range request against to.
-      ranges: A list of ranges to be downloaded. Each range is a tuple of
-        (start, end).
+      ranges: A list of byte range specs to be downloaded, e.g. '0-99'.
       headers: Http headers of the request.
 
     Returns:
       An instance of requests.Response if the status code from caching server is
         httplib.PARTIAL_CONTENT.
     """
-    ranges = ['%d-%d' % r for r in ranges]
     headers = headers.copy()
     headers['Range'] = 'bytes=%s' % (','.join(ranges))
-    rsp = self._caching_server.download(archive, headers=headers)
+    with _trace().span('range_request'):
+      rsp = self._caching_server.download(archive, headers=headers)
 
     if rsp.status_code == httplib.PARTIAL_CONTENT:
       # Although this is a partial response, it has full content of
@@ -510,6 +1202,7 @@ class GsArchiveServer(object):
 
   @cherrypy.expose
   @cherrypy.config(**{'response.stream': True})
+  @_traced
   @_to_cherrypy_error
   def decompress(self, *args):
     """Decompress the compressed TAR archive.
@@ -525,37 +1218,74 @@ class GsArchiveServer(object):
         '/'.join(args), ext_names=['.tar.gz', '.tar.bz2', '.tar.xz', '.tgz'])
     _log('Decompressing "%s"', zarchive)
 
-    rsp = self._caching_server.download(zarchive,
-                                        headers=cherrypy.request.headers)
-    cherrypy.response.headers['Content-Type'] = 'application/x-tar'
-    cherrypy.response.headers['Accept-Ranges'] = 'bytes'
-
+    # Ranges of archives having seek indexes only decompress the data near
+    # them, so they are as cheap as interactive requests.
+    indexed_range = (self._seek_indexes is not None and
+                     cherrypy.request.headers.get('Range') and
+                     self._seek_indexes.get(zarchive))
+    priority = admission.INTERACTIVE if indexed_range else admission.BULK
+    with self._admitted('decompress', priority) as admitted:
+      return admitted(self._decompress(zarchive))
+
+  def _decompress(self, zarchive):
+    """Decompress |zarchive|, or the requested ranges of it."""
     basename = os.path.basename(zarchive)
     _, extname = os.path.splitext(basename)
 
-    # Command lines used to decompress file.
-    commands = {
-        '.gz': ['gzip', '-d', '-c'],
-        '.tgz': ['gzip', '-d', '-c'],
-        '.xz': ['xz', '-d', '-c'],
-        '.bz2': ['bzip2', '-d', '-c'],
-    }
-    decompressed_file = tempfile.SpooledTemporaryFile(
-        max_size=_SPOOL_FILE_SIZE_BYTES)
-    proc = subprocess.Popen(commands[extname], stdin=subprocess.PIPE,
-                            stdout=decompressed_file)
-    _log('Decompress process id: %s.', proc.pid)
-    for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
-      proc.stdin.write(chunk)
-    proc.stdin.close()
-    _log('Decompression done.')
-    proc.wait()
+    seekable = (self._seek_indexes is not None and
+                extname in seek_index.SEEKABLE_EXT_NAMES)
+    range_header = cherrypy.request.headers.get('Range')
+    if seekable and range_header:
+      index = self._seek_indexes.get(zarchive)
+      if index:
+        content = self._decompress_ranges(zarchive, index, range_header)
+        if content is not None:
+          return content
+
+    # A range of the decompressed archive doesn't map to the same range of the
+    # compressed one, so always download the whole compressed archive.
+    headers = cherrypy.request.headers.copy()
+    headers.pop('Range', None)
+
+    def decompressed_chunks():
+      rsp = self._caching_server.download(zarchive, headers=headers)
+      # Only gzip and multi-stream bzip2 archives are worth indexing, so other
+      # archives are decompressed by a pipeline of download and decompressor
+      # process.
+      if seekable and (extname != '.bz2' or
+                       self._seek_indexes.is_multi_stream(zarchive)):
+        return self._decompress_and_index(zarchive, extname, rsp)
+      scanner = seek_index.Bz2StreamScanner() if seekable else None
+      return self._decompress_by_pipeline(zarchive, extname, rsp, scanner)
+
+    content = self._fetch_once(('decompress', zarchive), decompressed_chunks)
+    cherrypy.response.headers['Content-Type'] = 'application/x-tar'
+    cherrypy.response.headers['Accept-Ranges'] = 'bytes'
+    if self._stream_decompression and not range_header:
+      # Serve the content while decompressing, without Content-Length.
+      _log('Streaming decompressed content of "%s" begin.', zarchive)
+      return content
 
     # The header of Content-Length is necessary for supporting range request.
     # So we have to decompress the file locally to get the size. This may cause
     # connection timeout issue if the decompression take too long time (e.g. 90
     # seconds). As a reference, it takes about 10 seconds to decompress a 400MB
     # tgz file.
+    if self._single_flight is not None:
+      # The content is spooled by the flight already.
+      try:
+        content_length = content.wait()
+      except Exception:
+        content.close()
+        raise
+      _log('Decompressed content length is %d bytes.', content_length)
+      cherrypy.response.headers['Content-Length'] = str(content_length)
+      return content
+
+    decompressed_file = tempfile.SpooledTemporaryFile(
+        max_size=_SPOOL_FILE_SIZE_BYTES)
+    for data in content:
+      decompressed_file.write(data)
     decompressed_file.seek(0, os.SEEK_END)
     content_length = decompressed_file.tell()
     _log('Decompressed content length is %d bytes.', content_length)
@@ -574,13 +1304,320 @@ class GsArchiveServer(object):
 
     return decompressed_content()
 
+  def _decompress_by_pipeline(self, zarchive, extname, rsp, scanner=None):
+    """Decompress the archive while downloading it.
+
+    Args:
+      zarchive: The path of the compressed archive.
+      extname: The extension name of the compressed archive.
+      rsp: The response of downloading the compressed archive.
+      scanner: An instance of seek_index.Bz2StreamScanner to scan the
+        compressed archive, or None.
+
+    Yields:
+      The decompressed content.
+    """
+    def compressed_chunks():
+      for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
+        if scanner:
+          scanner.feed(chunk)
+        yield chunk
+
+    pipeline = decompress_pipeline.DecompressPipeline(extname,
+                                                      compressed_chunks())
+    _log('Decompress process id: %s.', pipeline.pid)
+    with _trace().span('decompress'):
+      for data in pipeline:
+        yield data
+    _log('Decompression done with exit code %s.', pipeline.returncode)
+
+    if scanner and scanner.multi_stream:
+      _log('"%s" has multiple bzip2 streams, index it next time.', zarchive)
+      self._seek_indexes.add_multi_stream(zarchive)
+
+  def _decompress_and_index(self, zarchive, extname, rsp):
+    """Decompress the archive in process and build its seek index.
+
+    Args:
+      zarchive: The path of the compressed archive.
+      extname: The extension name of the compressed archive.
+      rsp: The response of downloading the compressed archive.
+
+    Yields:
+      The decompressed content.
+    """
+    builder = seek_index.SeekIndexBuilder(extname, self._seek_indexes.interval)
+    decompress = builder.decompress
+    if self._cpu_executor:
+      decompress = functools.partial(self._cpu_executor, builder.decompress)
+    with _trace().span('decompress'):
+      for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
+        yield decompress(chunk)
+      yield builder.flush()
+    _log('Decompression done.')
+
+    etag = rsp.headers.get('ETag')
+    if etag:
+      index = builder.build(etag)
+      self._seek_indexes.put(zarchive, index)
+      _log('Built seek index of "%s" with %d checkpoints.', zarchive,
+           len(index.checkpoints))
+    else:
+      _log('No ETag of "%s", skip indexing it.', zarchive)
+
+  def _decompress_ranges(self, zarchive, index, range_header):
+    """Serve a range request of the decompressed archive by its seek index.
+
+    Only the compressed data between the nearest checkpoint and the end of each
+    range is downloaded and decompressed.
+
+    Args:
+      zarchive: The path of the compressed archive.
+      index: An instance of seek_index.SeekIndex of |zarchive|.
+      range_header: The value of HTTP header 'Range'.
+
+    Returns:
+      The generator of the partial content, or None if the ranges are not
+      satisfiable or the index is out of date.
+    """
+    ranges = httputil.get_ranges(range_header, index.size)
+    if not ranges:
+      return None
+
+    headers = cherrypy.request.headers.copy()
+
+    def fetch(offset):
+      headers['Range'] = 'bytes=%d-' % offset
+      rsp = self._caching_server.download(zarchive, headers=headers)
+      if rsp.headers.get('ETag') != index.etag:
+        rsp.close()
+        raise seek_index.SeekIndexError('"%s" changed since indexed.' %
+                                        zarchive)
+
+      def compressed_data():
+        with contextlib.closing(rsp):
+          # Skip the leading data if the range request wasn't respected.
+          to_skip = (0 if rsp.status_code == httplib.PARTIAL_CONTENT else
+                     offset)
+          for chunk in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
+            if to_skip < len(chunk):
+              yield chunk[to_skip:]
+            to_skip = max(to_skip - len(chunk), 0)
+
+      return compressed_data()
+
+    reader = seek_index.RangeReader(index, fetch)
+    try:
+      reader.seek(ranges[0][0])
+    except seek_index.SeekIndexError as err:
+      _log('Drop the seek index: %s', err, level=logging.WARNING)
+      self._seek_indexes.drop(zarchive)
+      return None
+
+    _log('Decompressing ranges %s of "%s" by the seek index.', ranges,
+         zarchive)
+
+    def read_ranges(parts):
+      """Yield |parts| and the content of each range after its part header.
+
+      Once the status and headers are sent, a failure of reading by the index
+      can't be reported by the status code. Instead, the index is dropped and
+      the exception aborts the connection, so the client doesn't take the
+      truncated content as complete.
+      """
+      try:
+        for part_header, (start, stop) in zip(parts, ranges):
+          if part_header:
+            yield part_header
+          for data in reader.read(start, stop):
+            yield data
+      except seek_index.SeekIndexError as err:
+        _log('Abort the response and drop the seek index: %s', err,
+             level=logging.ERROR)
+        self._seek_indexes.drop(zarchive)
+        raise
+      finally:
+        reader.close()
+
+    cherrypy.response.status = httplib.PARTIAL_CONTENT
+    cherrypy.response.headers['Accept-Ranges'] = 'bytes'
+    if len(ranges) == 1:
+      start, stop = ranges[0]
+      cherrypy.response.headers.update({
+          'Content-Type': 'application/x-tar',
+          'Content-Range': 'bytes %d-%d/%d' % (start, stop - 1, index.size),
+          'Content-Length': str(stop - start),
+      })
+      return read_ranges([None])
+
+    boundary = uuid.uuid4().hex
+    cherrypy.response.headers['Content-Type'] = (
+        'multipart/byteranges; boundary=%s' % boundary)
+
+    def multipart_content():
+      for data in read_ranges([
+          '\r\n--%s\r\nContent-Type: application/x-tar\r\n'
+          'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+          (boundary, start, stop - 1, index.size) for start, stop in ranges]):
+        yield data
+      yield '\r\n--%s--\r\n' % boundary
+
+    return multipart_content()
+
+  def _warm(self, path, request, response):
+    """Warm the caches of the GS object |path| through the caching server.
+
+    The object is downloaded. A tar archive is decompressed if compressed, and
+    its members are listed, which are indexed if the member index is enabled.
+
+    Args:
+      path: The GS path of the object, without gs:// prefix.
+      request: The request submitting the path, for logging.
+      response: The response of the request.
+    """
+    # Run in the context of the submitting request, so logging works as in the
+    # request thread.
+    cherrypy.serving.load(request, response)
+    try:
+      _log('Prefetching %s', path, level=logging.INFO)
+      rsps = [self._caching_server.download(path, headers={})]
+      if path.endswith(_TAR_EXT_NAMES):
+        archive, ext_name = _decompressed_tar_name(path)
+        headers = ({_HTTP_HEADER_COMPRESSED_TAR_EXT: ext_name} if ext_name
+                   else {})
+        rsps.append(self._caching_server.list_member(archive, headers=headers))
+      for rsp in rsps:
+        with contextlib.closing(rsp):
+          for _ in rsp.iter_content(constants.READ_BUFFER_SIZE_BYTES):
+            pass
+      _log('Prefetched %s', path, level=logging.INFO)
+    finally:
+      cherrypy.serving.clear()
+
+  @cherrypy.expose
+  @cherrypy.config(**{'request.process_request_body': False})
+  @_to_cherrypy_error
+  def prefetch(self, *args):
+    """Prefetch GS objects in the background, to warm the caches of them.
+
+    Objects are downloaded through the caching server. Tar archives are
+    decompressed if compressed, and have their members indexed.
+
+    For example:
+      GET or POST /prefetch/bucket/path/to/file prefetches a single object.
+      POST /prefetch with a manifest as the body prefetches all objects in it.
+      The manifest has a GS path without gs:// prefix per line. Blank lines and
+      lines starting with '#' are ignored.
+
+    Args:
+      *args: All parts of the GS path of the object, without gs:// prefix.
+
+    Returns:
+      A JSON list of the prefetching states of the objects. See
+      `prefetch_status`.
+    """
+    if not self._prefetcher:
+      raise cherrypy.HTTPError(httplib.SERVICE_UNAVAILABLE,
+                               'Prefetching is disabled.')
+    if args:
+      paths = ['/'.join(args)]
+    elif cherrypy.request.method == 'POST':
+      lines = [l.strip() for l in _read_raw_body().splitlines()]
+      paths = [l for l in lines if l and not l.startswith('#')]
+    else:
+      raise cherrypy.HTTPError(httplib.BAD_REQUEST,
+                               'A path or a manifest is required.')
+
+    states = []
+    for path in paths:
+      try:
+        states.append(self._prefetcher.submit(_check_file_extension(path),
+                                              cherrypy.serving.request,
+                                              cherrypy.serving.response))
+      except prefetcher.QueueFullError as err:
+        raise cherrypy.HTTPError(httplib.SERVICE_UNAVAILABLE, err.message)
+
+    cherrypy.response.status = httplib.ACCEPTED
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(states)
+
+  @cherrypy.expose
+  @_to_cherrypy_error
+  def prefetch_status(self, *args):
+    """Get the states of prefetching GS objects.
+
+    For example:
+      GET /prefetch_status gets the states of all recently prefetched objects.
+      GET /prefetch_status/bucket/path/to/file gets the state of an object.
+
+    Each state is a JSON object of:
+      path: The GS path of the object, without gs:// prefix.
+      state: One of 'queued', 'running', 'done' and 'failed'.
+      queued, started, finished: The timestamps of the state changes.
+      error: The error message if failed.
+
+    Args:
+      *args: All parts of the GS path of the object, without gs:// prefix.
+
+    Returns:
+      A JSON object of the state, or a JSON list of all states.
+    """
+    if not self._prefetcher:
+      raise cherrypy.HTTPError(httplib.SERVICE_UNAVAILABLE,
+                               'Prefetching is disabled.')
+    if args:
+      status = self._prefetcher.status('/'.join(args))
+      if status is None:
+        raise cherrypy.HTTPError(httplib.NOT_FOUND,
+                                 '%s is not prefetched.' % '/'.join(args))
+    else:
+      status = self._prefetcher.status()
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(status)
+
+  @cherrypy.expose
+  @_to_cherrypy_error
+  def admission_status(self):
+    """Get the metrics of the admission control of RPCs.
+
+    For example: GET /admission_status.
+
+    Returns:
+      A JSON object of the metrics. See admission.AdmissionController.status.
+    """
+    if not self._admission:
+      raise cherrypy.HTTPError(httplib.SERVICE_UNAVAILABLE,
+                               'Admission control is disabled.')
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(self._admission.status())
+
+  @cherrypy.expose
+  @_to_cherrypy_error
+  def stats(self):
+    """Get the histograms of the timing of the phases of RPCs.
+
+    For example: GET /stats.
+
+    Returns:
+      A JSON object of the histograms. See tracing.Stats.to_dict.
+    """
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(self._stats.to_dict())
+
 
 def _url_type(input_string):
   """Ensure |input_string| is a valid URL and convert to target type.
 
-  The target type is a tuple of (scheme, netloc).
+  The target type is a tuple of (scheme, netloc). An Unix domain socket is
+  specified as 'unix:/path/to/socket', which is converted to ('unix',
+  '/path/to/socket').
   """
   split_result = urlparse.urlsplit(input_string)
+  if split_result.scheme == 'unix':
+    if not split_result.path:
+      raise argparse.ArgumentTypeError('Wrong URL format: %s' % input_string)
+    return split_result.scheme, split_result.path
+
   if not split_result.scheme:
     input_string = 'http://%s' % input_string
 
@@ -591,8 +1628,8 @@ def _url_type(input_string):
   return split_result.scheme, split_result.netloc
 
 
-def parse_args(argv):
-  """Parse arguments."""
+def create_parser():
+  """Create the parser of arguments."""
   parser = argparse.ArgumentParser(
       formatter_class=argparse.RawDescriptionHelpFormatter,
       description=__doc__)
@@ -605,14 +1642,163 @@ def parse_args(argv):
   socket_or_port.add_argument('-p', '--port', type=int,
                               help='Port number to listen.')
 
-  # TODO(guocb): support Unix domain socket
   parser.add_argument(
       '-c', '--caching-server', required=True, type=_url_type,
       help='URL of the proxy server. Valid format is '
-      '[http://]{<hostname>|<IP>}[:<port_number>]. When skipped, the default '
-      'scheme is http and port number is 80. Any other components in URL are '
-      'ignored.')
-  return parser.parse_args(argv)
+      '[http://]{<hostname>|<IP>}[:<port_number>] or unix:<socket_path>. When '
+      'skipped, the default scheme is http and port number is 80. Any other '
+      'components in URL are ignored.')
+  parser.add_argument(
+      '--caching-server-pool-size', metavar='N', type=int,
+      default=http_pool.DEFAULT_POOL_SIZE,
+      help='The max number of connections to the proxy server kept alive by '
+      'each thread. Default: %(default)s.')
+  parser.add_argument(
+      '--member-index', metavar='DB_FILE',
+      help='Path of the SQLite database file to save the index of tar '
+      'members. Each generation of a tar archive is listed only once when set. '
+      'Without --stat-cache, the generations of archives are still cached '
+      'in memory, for the default TTL of --stat-cache-ttl.')
+  parser.add_argument(
+      '--member-index-max-archives', metavar='N', type=int,
+      default=member_index.DEFAULT_MAX_ARCHIVES,
+      help='The max number of archives kept in the index of tar members. The '
+      'earliest indexed archives are dropped first. Default: %(default)s.')
+  parser.add_argument(
+      '--seek-index-interval', metavar='MB', type=int,
+      help='Build seek indexes of compressed archives with a checkpoint every '
+      'MB megabytes of decompressed content. Range requests of decompressed '
+      'archives only decompress the data near the ranges when set.')
+  parser.add_argument(
+      '--stream-decompression', action='store_true',
+      help='Serve decompressed archives while decompressing them, without '
+      'Content-Length. The caching server must cache the whole response before '
+      'serving ranges of it, e.g. Nginx with proxy_cache_lock on.')
+  parser.add_argument(
+      '--range-request-workers', metavar='N', type=int,
+      default=_DEFAULT_RANGE_REQUEST_WORKERS,
+      help='The max number of range requests sent concurrently to the proxy '
+      'server by each request extracting files. Default: %(default)s.')
+  parser.add_argument(
+      '--range-request-threads', metavar='N', type=int,
+      default=_DEFAULT_RANGE_REQUEST_THREADS,
+      help='The number of threads sending range requests to the proxy server, '
+      'shared by all requests extracting files. Default: %(default)s.')
+  parser.add_argument(
+      '--range-merge-gap', metavar='BYTES', type=int,
+      default=_DEFAULT_RANGE_MERGE_GAP_BYTES,
+      help='The max bytes between files extracted from a tar to be fetched by '
+      'one byte range. Negative value disables merging. Default: %(default)s.')
+  parser.add_argument(
+      '--disk-cache', metavar='DIR',
+      help='The directory to cache downloaded GS objects, keyed by the path '
+      'and the generation. It can be shared by several server processes. GS '
+      'objects are always downloaded from GS if not set.')
+  parser.add_argument(
+      '--disk-cache-max-mb', metavar='MB', type=int, default=10 * 1024,
+      help='The max total size of the disk cache. The least recently used '
+      'objects are evicted first. Default: %(default)s.')
+  parser.add_argument(
+      '--single-flight', action='store_true',
+      help='Collapse concurrent requests downloading or decompressing the same '
+      'object into one fetch, which is spooled to a temporary file and read '
+      'by all of them.')
+  parser.add_argument(
+      '--gcs-api', action='store_true',
+      help='Access GS by the JSON API in process instead of gsutil, which '
+      'falls back to gsutil on errors. The access token is got from the GCE '
+      'metadata server, unless --gcs-token-command is set.')
+  parser.add_argument(
+      '--gcs-token-command', metavar='COMMAND',
+      help='The command printing an access token of GS, e.g. "gcloud auth '
+      'print-access-token".')
+  parser.add_argument(
+      '--gcs-endpoint', metavar='URL', default=gcs_client.DEFAULT_ENDPOINT,
+      help='The URL of the GS JSON API. Default: %(default)s.')
+  parser.add_argument(
+      '--gcs-slice-mb', metavar='MB', type=int,
+      default=gcs_client.DEFAULT_SLICE_SIZE_BYTES // 1024 // 1024,
+      help='Download GS objects in slices of MB megabytes by parallel range '
+      'requests. Default: %(default)s.')
+  parser.add_argument(
+      '--gcs-download-workers', metavar='N', type=int,
+      default=gcs_client.DEFAULT_DOWNLOAD_WORKERS,
+      help='The max number of slices downloaded concurrently. Default: '
+      '%(default)s.')
+  parser.add_argument(
+      '--gcs-read-ahead-slices', metavar='N', type=int,
+      default=gcs_client.DEFAULT_READ_AHEAD_SLICES,
+      help='The max number of slices each download reads ahead. Default: '
+      '%(default)s.')
+  parser.add_argument(
+      '--gcs-read-ahead-mb', metavar='MB', type=int,
+      default=gcs_client.DEFAULT_READ_AHEAD_BYTES // 1024 // 1024,
+      help='The max megabytes of slices read ahead by all downloads. '
+      'Default: %(default)s.')
+  parser.add_argument(
+      '--stat-cache', action='store_true',
+      help='Cache the metadata of GS objects, so repeated downloads and HEAD '
+      'requests don\'t stat GS every time. Objects under versioned build '
+      'directories, e.g. R80-12739.0.0, are treated as immutable.')
+  parser.add_argument(
+      '--stat-cache-db', metavar='DB_FILE',
+      help='Path of the SQLite database file to save the metadata cache, '
+      'which is kept across restarts and can be shared by several server '
+      'processes. Metadata is cached in memory only if not set.')
+  parser.add_argument(
+      '--stat-cache-ttl', metavar='SECONDS', type=int,
+      default=stat_cache.DEFAULT_TTL_SECONDS,
+      help='The time to trust the cached metadata of mutable objects. A new '
+      'generation uploaded within the time isn\'t noticed until it expires. '
+      'Default: %(default)s.')
+  parser.add_argument(
+      '--stat-cache-negative-ttl', metavar='SECONDS', type=int,
+      default=stat_cache.DEFAULT_NEGATIVE_TTL_SECONDS,
+      help='The time to trust that an object doesn\'t exist. Default: '
+      '%(default)s.')
+  parser.add_argument(
+      '--prefetch-workers', metavar='N', type=int, default=0,
+      help='The number of workers prefetching GS objects requested by the '
+      '`prefetch` RPC. The RPC is disabled if 0. Default: %(default)s.')
+  parser.add_argument(
+      '--prefetch-max-queued', metavar='N', type=int,
+      default=prefetcher.DEFAULT_MAX_QUEUED,
+      help='The max number of GS objects waiting to be prefetched. Default: '
+      '%(default)s.')
+  parser.add_argument(
+      '--max-downloads', metavar='N', type=int, default=0,
+      help='The max number of concurrent `download` requests. Requests '
+      'beyond it wait, and small objects and ranges are admitted first. '
+      'Unlimited if 0. Default: %(default)s.')
+  parser.add_argument(
+      '--max-decompressions', metavar='N', type=int, default=0,
+      help='The max number of concurrent `decompress` requests. Unlimited if '
+      '0. Default: %(default)s.')
+  parser.add_argument(
+      '--max-extracts', metavar='N', type=int, default=0,
+      help='The max number of concurrent `extract` requests. Unlimited if 0. '
+      'Default: %(default)s.')
+  parser.add_argument(
+      '--egress-rate-mbps', metavar='MBPS', type=float,
+      help='Shape the egress of bulk transfers to MBPS megabits per second, '
+      'shared by all requests. Interactive requests are never throttled, but '
+      'count towards the rate.')
+  parser.add_argument(
+      '--admission-timeout', metavar='SECONDS', type=int,
+      default=admission.DEFAULT_TIMEOUT_SECONDS,
+      help='The max time of a request waiting to be admitted, after which it '
+      'fails with 503. Default: %(default)s.')
+  parser.add_argument(
+      '--interactive-max-bytes', metavar='BYTES', type=int,
+      default=_DEFAULT_INTERACTIVE_MAX_BYTES,
+      help='Downloads of objects up to this size are admitted before bulk '
+      'transfers. Default: %(default)s.')
+  return parser
+
+
+def parse_args(argv):
+  """Parse arguments."""
+  return create_parser().parse_args(argv)
 
 
 def setup_logger():
@@ -626,6 +1812,85 @@ def setup_logger():
   _logger.addHandler(handler)
 
 
+def create_server(args, shared_session=False, cpu_executor=None):
+  """Create the server from the parsed arguments.
+
+  Args:
+    args: The parsed arguments.
+    shared_session: Whether all threads share one session to the caching
+      server. See _CachingServer.
+    cpu_executor: The function to run CPU bound work. See GsArchiveServer.
+
+  Returns:
+    An instance of GsArchiveServer.
+  """
+  tar_member_index = None
+  if args.member_index:
+    tar_member_index = member_index.MemberIndex(
+        args.member_index, max_archives=args.member_index_max_archives)
+
+  seek_indexes = None
+  if args.seek_index_interval:
+    seek_indexes = seek_index.SeekIndexCache(
+        interval=args.seek_index_interval * 1024 * 1024)
+
+  object_cache = None
+  if args.disk_cache:
+    object_cache = disk_cache.DiskCache(
+        args.disk_cache, max_bytes=args.disk_cache_max_mb * 1024 * 1024)
+
+  gcs = None
+  if args.gcs_api:
+    if args.gcs_token_command:
+      credentials = gcs_client.CommandCredentials(args.gcs_token_command)
+    else:
+      credentials = gcs_client.MetadataServerCredentials()
+    gcs = gcs_client.GcsClient(
+        args.gcs_endpoint, credentials=credentials,
+        slice_size=args.gcs_slice_mb * 1024 * 1024,
+        download_workers=args.gcs_download_workers,
+        read_ahead_slices=args.gcs_read_ahead_slices,
+        read_ahead_bytes=args.gcs_read_ahead_mb * 1024 * 1024)
+
+  metadata_cache = None
+  if args.stat_cache:
+    metadata_cache = stat_cache.StatCache(
+        args.stat_cache_db, ttl=args.stat_cache_ttl,
+        negative_ttl=args.stat_cache_negative_ttl)
+
+  admission_controller = None
+  limits = {'download': args.max_downloads,
+            'decompress': args.max_decompressions,
+            'extract': args.max_extracts}
+  if any(limits.values()) or args.egress_rate_mbps:
+    egress_rate = None
+    if args.egress_rate_mbps:
+      egress_rate = args.egress_rate_mbps * 1000 * 1000 / 8
+    admission_controller = admission.AdmissionController(
+        limits, egress_rate=egress_rate, timeout=args.admission_timeout)
+
+  return GsArchiveServer(
+      _CachingServer(args.caching_server,
+                     pool_size=args.caching_server_pool_size,
+                     shared_session=shared_session),
+      tar_member_index=tar_member_index,
+      seek_indexes=seek_indexes,
+      stream_decompression=args.stream_decompression,
+      range_request_workers=args.range_request_workers,
+      range_request_threads=args.range_request_threads,
+      range_merge_gap=args.range_merge_gap,
+      object_cache=object_cache,
+      single_flight=(single_flight.SingleFlight() if args.single_flight
+                     else None),
+      gcs=gcs,
+      metadata_cache=metadata_cache,
+      prefetch_workers=args.prefetch_workers,
+      prefetch_max_queued=args.prefetch_max_queued,
+      admission_controller=admission_controller,
+      interactive_max_bytes=args.interactive_max_bytes,
+      cpu_executor=cpu_executor)
+
+
 def main(argv):
   """Main function."""
   args = parse_args(argv)
@@ -639,7 +1904,7 @@ def main(argv):
   cherrypy.server.socket_port = args.port
   cherrypy.server.socket_file = args.socket
 
-  cherrypy.quickstart(GsArchiveServer(_CachingServer(args.caching_server)))
+  cherrypy.quickstart(create_server(args))
 
 
 if __name__ == '__main__':
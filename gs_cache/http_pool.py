@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Pooled HTTP sessions over TCP or Unix domain sockets.
+
+A session keeps the connections alive and reuses them for later requests, so
+the calls to a local caching server don't pay the cost of connection setup.
+
+A session may be bound to a server listening on an Unix domain socket. The
+URLs of the server have the scheme of 'http+unix' and a placeholder host,
+e.g. http+unix://localhost/path/to/file. The socket path isn't encoded in the
+URL, since requests lowercases the host of URLs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import cookielib
+import numbers
+import socket
+
+import requests
+from requests import adapters
+from requests.packages.urllib3 import connection
+from requests.packages.urllib3 import connectionpool
+
+UNIX_SOCKET_SCHEME = 'http+unix'
+# The host of the URLs of the server bound to a session.
+UNIX_SOCKET_HOST = 'localhost'
+
+DEFAULT_POOL_SIZE = 10
+
+
+class _UnixSocketConnection(connection.HTTPConnection):
+  """A HTTP connection over an Unix domain socket."""
+
+  def __init__(self, socket_path, **kwargs):
+    super(_UnixSocketConnection, self).__init__('localhost', **kwargs)
+    self._socket_path = socket_path
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if isinstance(self.timeout, numbers.Number):
+      sock.settimeout(self.timeout)
+    sock.connect(self._socket_path)
+    self.sock = sock
+
+
+class _UnixSocketConnectionPool(connectionpool.HTTPConnectionPool):
+  """A pool of HTTP connections over an Unix domain socket."""
+
+  def __init__(self, socket_path, **kwargs):
+    super(_UnixSocketConnectionPool, self).__init__('localhost', **kwargs)
+    self._socket_path = socket_path
+
+  def _new_conn(self):
+    self.num_connections += 1
+    return _UnixSocketConnection(self._socket_path,
+                                 timeout=self.timeout.connect_timeout)
+
+
+class UnixSocketAdapter(adapters.HTTPAdapter):
+  """The transport adapter of requests to an Unix domain socket."""
+
+  def __init__(self, socket_path, pool_maxsize=DEFAULT_POOL_SIZE):
+    super(UnixSocketAdapter, self).__init__(pool_maxsize=pool_maxsize)
+    self._pool = _UnixSocketConnectionPool(socket_path, maxsize=pool_maxsize)
+
+  def get_connection(self, url, proxies=None):
+    return self._pool
+
+  def request_url(self, request, proxies):
+    return request.path_url
+
+  def close(self):
+    self._pool.close()
+    super(UnixSocketAdapter, self).close()
+
+
+def new_session(pool_size=DEFAULT_POOL_SIZE, unix_socket=None):
+  """Create a session which keeps up to |pool_size| connections per host.
+
+  Cookies are never saved, so requests of different clients sharing the
+  session don't affect each other.
+
+  Args:
+    pool_size: The max number of connections kept alive per host.
+    unix_socket: The path of an Unix domain socket, to which the requests of
+      'http+unix' URLs are sent regardless of their hosts.
+  """
+  session = requests.Session()
+  session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+  for scheme in ('http://', 'https://'):
+    session.mount(scheme, adapters.HTTPAdapter(pool_maxsize=pool_size))
+  if unix_socket:
+    session.mount('%s://' % UNIX_SOCKET_SCHEME,
+                  UnixSocketAdapter(unix_socket, pool_size))
+  return session
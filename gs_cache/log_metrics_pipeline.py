@@ -0,0 +1 @@
+../log_metrics_pipeline.py
\ No newline at end of file
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A persistent index of tar archive members.
+
+Listing the members of a tar archive needs a scan of the whole archive, which
+is slow for multi-GB tars. This module saves the result of the scan into a
+SQLite database (a sidecar file of gs_archive_server) and keys it by the GS
+path and the generation of the archive. So each generation of an archive is
+scanned only once, and all later lookups are served by the database.
+
+Only the most recently indexed |max_archives| archives are kept, so the
+database doesn't grow without limit on a long running server.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import fnmatch
+import re
+import sqlite3
+
+import tarfile_utils
+
+# The timeout of acquiring the database lock. The database may be shared by
+# several server processes.
+_DB_LOCK_TIMEOUT_SECONDS = 60
+
+# Characters with special meaning in shell-style glob patterns.
+_GLOB_MAGIC_CHARS = re.compile('[*?[]')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+  id INTEGER PRIMARY KEY,
+  path TEXT NOT NULL,
+  generation TEXT NOT NULL,
+  UNIQUE (path, generation)
+);
+CREATE TABLE IF NOT EXISTS members (
+  archive_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  filename TEXT NOT NULL,
+  record_start INTEGER NOT NULL,
+  record_size INTEGER NOT NULL,
+  content_start INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  PRIMARY KEY (archive_id, seq)
+);
+CREATE INDEX IF NOT EXISTS members_by_name ON members (archive_id, filename);
+"""
+
+_MEMBER_COLUMNS = 'filename, record_start, record_size, content_start, size'
+
+# The default max number of archives kept in the index. A build usually has a
+# few tar archives of thousands of members each, i.e. some KBs per archive.
+DEFAULT_MAX_ARCHIVES = 1000
+
+
+class MemberIndex(object):
+  """The persistent index of tar members, keyed by GS path and generation."""
+
+  def __init__(self, db_path, max_archives=DEFAULT_MAX_ARCHIVES):
+    """Constructor.
+
+    Args:
+      db_path: The path of SQLite database file. It's created if not exist.
+      max_archives: The max number of archives to keep. The archives indexed
+        earliest are dropped first.
+    """
+    self._db_path = db_path
+    self._max_archives = max_archives
+    with self._transaction() as conn:
+      conn.executescript(_SCHEMA)
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    """Open a new connection to the database and run a transaction on it.
+
+    A connection is opened for every operation since connections can't be
+    shared among CherryPy threads.
+    """
+    with contextlib.closing(sqlite3.connect(
+        self._db_path, timeout=_DB_LOCK_TIMEOUT_SECONDS)) as conn:
+      conn.text_factory = str
+      with conn:
+        yield conn
+
+  @staticmethod
+  def _get_archive_id(conn, path, generation):
+    row = conn.execute(
+        'SELECT id FROM archives WHERE path = ? AND generation = ?',
+        (path, str(generation))).fetchone()
+    return row[0] if row else None
+
+  def get(self, path, generation):
+    """Get all members of an indexed archive.
+
+    Args:
+      path: The path of the archive.
+      generation: The generation of the archive object on GS.
+
+    Returns:
+      A list of tarfile_utils.TarMemberInfo in the order of the archive, or None
+      if the archive isn't indexed.
+    """
+    with self._transaction() as conn:
+      archive_id = self._get_archive_id(conn, path, generation)
+      if archive_id is None:
+        return None
+      rows = conn.execute(
+          'SELECT %s FROM members WHERE archive_id = ? ORDER BY seq' %
+          _MEMBER_COLUMNS, (archive_id,))
+      return [tarfile_utils.TarMemberInfo._make(row) for row in rows]
+
+  def search(self, path, generation, patterns):
+    """Search members of an indexed archive by names or glob patterns.
+
+    Plain file names are looked up by the database index directly, so no scan
+    of all members is needed unless there are shell-style glob patterns.
+
+    Args:
+      path: The path of the archive.
+      generation: The generation of the archive object on GS.
+      patterns: An iterable of file names or shell-style glob patterns.
+
+    Returns:
+      A set of tarfile_utils.TarMemberInfo which matches one of |patterns|, or
+      None if the archive isn't indexed.
+    """
+    with self._transaction() as conn:
+      archive_id = self._get_archive_id(conn, path, generation)
+      if archive_id is None:
+        return None
+
+      found = set()
+      for pattern in patterns:
+        if _GLOB_MAGIC_CHARS.search(pattern):
+          rows = conn.execute(
+              'SELECT %s FROM members WHERE archive_id = ?' % _MEMBER_COLUMNS,
+              (archive_id,))
+          found |= {tarfile_utils.TarMemberInfo._make(row) for row in rows
+                    if fnmatch.fnmatch(row[0], pattern)}
+        else:
+          rows = conn.execute(
+              'SELECT %s FROM members WHERE archive_id = ? AND filename = ?' %
+              _MEMBER_COLUMNS, (archive_id, pattern))
+          found |= {tarfile_utils.TarMemberInfo._make(row) for row in rows}
+      return found
+
+  def put(self, path, generation, members):
+    """Save all members of an archive.
+
+    Index of other generations of the same |path| is dropped, and so are the
+    earliest indexed archives beyond the limit of max archives.
+
+    Args:
+      path: The path of the archive.
+      generation: The generation of the archive object on GS.
+      members: An iterable of tarfile_utils.TarMemberInfo.
+    """
+    with self._transaction() as conn:
+      for (archive_id,) in conn.execute(
+          'SELECT id FROM archives WHERE path = ?', (path,)).fetchall():
+        conn.execute('DELETE FROM members WHERE archive_id = ?', (archive_id,))
+        conn.execute('DELETE FROM archives WHERE id = ?', (archive_id,))
+
+      archive_id = conn.execute(
+          'INSERT INTO archives (path, generation) VALUES (?, ?)',
+          (path, str(generation))).lastrowid
+      conn.executemany(
+          'INSERT INTO members (archive_id, seq, %s) VALUES (?, ?, ?, ?, ?, ?, '
+          '?)' % _MEMBER_COLUMNS,
+          ((archive_id, seq, m.filename, int(m.record_start),
+            int(m.record_size), int(m.content_start), int(m.size))
+           for seq, m in enumerate(members)))
+
+      # The IDs are increasing, so archives of smaller IDs are indexed earlier.
+      expired = 'SELECT id FROM archives ORDER BY id DESC LIMIT -1 OFFSET ?'
+      conn.execute('DELETE FROM members WHERE archive_id IN (%s)' % expired,
+                   (self._max_archives,))
+      conn.execute('DELETE FROM archives WHERE id IN (%s)' % expired,
+                   (self._max_archives,))
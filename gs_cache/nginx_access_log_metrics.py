@@ -8,6 +8,10 @@
 It parses the Nginx access log file of Gs Cache, e.g.
 /var/log/nginx/gs-cache-server.access.log, and generate monarch metrics for Gs
 Cache performance.
+
+Each line is split into fields by one pass of string operations. The sizes of
+responses are summed up in memory by log_metrics_pipeline, and the sums are
+emitted every --flush-interval seconds.
 """
 
 from __future__ import absolute_import
@@ -15,12 +19,11 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
-import re
 import sys
 from logging import handlers
 
+import log_metrics_pipeline
 from chromite.lib import cros_logging as logging
-from chromite.lib import metrics
 from chromite.lib import ts_mon_config
 
 _LOG_ROTATION_TIME = 'H'
@@ -29,64 +32,93 @@ _LOG_ROTATION_BACKUP = 14  # Keep for 14 days.
 
 _METRIC_NAME = 'chromeos/gs_cache/nginx/response'
 
-# An example Nginx access log line is:
-# <ip> 2018-07-26T18:13:49-07:00 "GET URL HTTP/1.1" 200 <size> "<agent>" HIT
-_SUCCESS_RESPONSE_MATCHER = re.compile(
-    r'^(?P<ip_addr>\d+\.\d+\.\d+\.\d+) '
-    r'(?P<timestamp>\d+\-\d+\-\d+T\d+:\d+:\d+[+\-]\d+:\d+) '
-    r'"GET (?P<url_path>\S*)[^"]*" '
-    r'2\d\d (?P<size>\S+) "[^"]+" (?P<cache_status>\S+)')
+# The fields of the metric, in the order of the values parsed from a line.
+_METRIC_FIELDS = ('cache', 'action', 'bucket', 'build', 'milestone', 'version',
+                  'endpoint')
+
+_DEFAULT_FLUSH_INTERVAL_SECONDS = (
+    log_metrics_pipeline.DEFAULT_FLUSH_INTERVAL_SECONDS)
+
 
-# The format of URL is like:
-#   /$ACTION/$BUCKET/$BUILD/$MILESTONE-$VERSION/$FILENAME?params
-# We want ACTION, BUCKET, BUILD, MILESTONE, and FILENAME.
-_URL_PATH_MATCHER = re.compile(
-    r'^/(?P<action>[^/]+)/(?P<bucket>[^/]+)/(?P<build>[^/]+)/'
-    r'(?P<milestone>\S+)\-(?P<version>[^/]+)/(?P<filename>[^\?]+)'
-)
+def parse_line(line):
+  """Parse a line of the Nginx access log of a successful response.
 
+  An example Nginx access log line is:
+  <ip> 2018-07-26T18:13:49-07:00 "GET URL HTTP/1.1" 200 <size> "<agent>" HIT
 
-def emit_successful_response_metric(m):
-  """Emit a Counter metric for a successful response.
+  The format of URL is like:
+    /$ACTION/$BUCKET/$BUILD/$MILESTONE-$VERSION/$FILENAME?params
+  We want ACTION, BUCKET, BUILD, MILESTONE, VERSION and FILENAME. They are
+  empty if the URL is in other formats.
 
-  We parse the response line and uploads the size of response to a cumulative
-  metric. Especially, the metric has a designate field of 'cache' which
-  indicates the upstream cache status, e.g. HIT/MISS etc. For all list of cache
-  status, see
-  http://nginx.org/en/docs/http/ngx_http_upstream_module.html#var_upstream_cache_status
+  Examples:
+    >>> parse_line('1.2.3.4 2018-08-01T09:11:27-07:00 "GET '
+    ...            '/extract/bucket/build/R1-2.3/archive?file=a HTTP/1.1" '
+    ...            '200 12345 "agent/1.2.3" HIT')
+    (('HIT', 'extract', 'bucket', 'build', 'R1', '2.3', 'archive'), 12345)
+    >>> parse_line('1.2.3.4 2018-08-01T09:11:27-07:00 "GET /a_url HTTP/1.1" '
+    ...            '200 12345 "agent/1.2.3" MISS')
+    (('MISS', '', '', '', '', '', ''), 12345)
 
   Args:
-    m: A regex match object or None.
-  """
-  if not m:
-    return
+    line: A line of the log.
 
+  Returns:
+    A tuple of (a tuple of the values of _METRIC_FIELDS, the size of the
+    response), or None if the line isn't of a successful GET response, or is
+    of a loopback call between gs_archive_server and Nginx.
+  """
+  # The agent is quoted and Nginx escapes quotes in it, so splitting by quotes
+  # gets: '<ip> <timestamp> ', 'GET URL HTTP/1.1', ' 200 <size> ', '<agent>',
+  # ' <cache status>'.
+  parts = line.split('"')
+  if len(parts) != 5:
+    return None
+  head = parts[0].split()
+  request = parts[1].split()
+  status_size = parts[2].split()
+  cache_status = parts[4].split()
+  if (len(head) != 2 or len(request) < 2 or request[0] != 'GET' or
+      len(status_size) != 2 or not status_size[0].startswith('2') or
+      len(status_size[0]) != 3 or len(cache_status) != 1):
+    return None
   # Ignore all loopback calls between gs_archive_server and Nginx.
-  if m.group('ip_addr') == '127.0.0.1':
-    return
-
-  logging.debug('Emitting successful response metric.')
-  metric_fields = {
-      'cache': m.group('cache_status'),
-      'action': '',
-      'bucket': '',
-      'build': '',
-      'milestone': '',
-      'version': '',
-      'endpoint': '',
-  }
-  requested_file_info = _URL_PATH_MATCHER.match(m.group('url_path'))
-  if requested_file_info:
-    metric_fields.update({
-        'action': requested_file_info.group('action'),
-        'bucket': requested_file_info.group('bucket'),
-        'build': requested_file_info.group('build'),
-        'milestone': requested_file_info.group('milestone'),
-        'version': requested_file_info.group('version'),
-        'endpoint': requested_file_info.group('filename'),
-    })
-  metrics.Counter(_METRIC_NAME).increment_by(int(m.group('size')),
-                                             fields=metric_fields)
+  if head[0] == '127.0.0.1':
+    return None
+  try:
+    size = int(status_size[1])
+  except ValueError:
+    return None
+
+  url_fields = ('', '', '', '', '', '')
+  url = request[1].split('?', 1)[0]
+  segments = url.split('/', 5)
+  if len(segments) == 6 and not segments[0] and all(segments[1:]):
+    milestone, _, version = segments[4].rpartition('-')
+    if milestone and version:
+      url_fields = tuple(segments[1:4]) + (milestone, version, segments[5])
+  return (cache_status[0],) + url_fields, size
+
+
+def _classify_line(line):
+  """Get the metric updates of a line of the log for the aggregator."""
+  parsed = parse_line(line)
+  if not parsed:
+    return []
+  fields, size = parsed
+  return [(_METRIC_NAME, tuple(zip(_METRIC_FIELDS, fields)), size)]
+
+
+def process_log(input_file, flush_interval=_DEFAULT_FLUSH_INTERVAL_SECONDS):
+  """Emit the metrics of the Nginx access log from |input_file|.
+
+  Args:
+    input_file: The file object of the log.
+    flush_interval: The seconds between emitting the metrics.
+  """
+  log_metrics_pipeline.run(input_file,
+                           log_metrics_pipeline.Aggregator(_classify_line),
+                           flush_interval=flush_interval)
 
 
 def input_log_file_type(filename):
@@ -113,6 +145,11 @@ def parse_args(argv):
       "-l", "--log-file", default=sys.stdout,
       help="Log file of this script (default is sys.stdout)."
   )
+  parser.add_argument(
+      "--flush-interval", metavar='SECONDS', type=int,
+      default=_DEFAULT_FLUSH_INTERVAL_SECONDS,
+      help="Seconds between emitting the metrics (default is %(default)s)."
+  )
   return parser.parse_args(argv)
 
 
@@ -132,9 +169,7 @@ def main(argv):
 
   with ts_mon_config.SetupTsMonGlobalState('gs_cache_nginx_log_metrics',
                                            indirect=True):
-    for line in iter(args.input_fd.readline, b''):
-      logging.debug('Parsing line: %s', line.strip())
-      emit_successful_response_metric(_SUCCESS_RESPONSE_MATCHER.match(line))
+    process_log(args.input_fd, flush_interval=args.flush_interval)
 
 
 if __name__ == "__main__":
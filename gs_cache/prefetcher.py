@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Warm up the cache of GS objects in the background.
+
+GS objects are fetched on demand, so the first request of a newly published
+build pays the whole latency of downloading and decompressing. A prefetcher
+takes paths of objects, e.g. from a scheduler once a build is published, and
+warms them by a bounded pool of worker threads.
+
+The state of recently prefetched paths are kept for querying. A path being
+prefetched isn't queued again.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import Queue
+import threading
+import time
+
+from chromite.lib import cros_logging as logging
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_MAX_HISTORY = 1000
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+  """Exception raised when too many paths are waiting to be prefetched."""
+
+
+class Prefetcher(object):
+  """A pool of workers warming GS objects."""
+
+  def __init__(self, warm_func, workers=DEFAULT_WORKERS,
+               max_queued=DEFAULT_MAX_QUEUED,
+               max_history=DEFAULT_MAX_HISTORY):
+    """Constructor.
+
+    Args:
+      warm_func: A function to warm a path, which is called in a worker thread
+        with the path and the extra arguments of submitting it.
+      workers: The number of worker threads.
+      max_queued: The max number of paths waiting for a worker.
+      max_history: The max number of paths whose states are kept. The earliest
+        finished ones are dropped first.
+    """
+    self._warm_func = warm_func
+    self._workers = workers
+    self._max_history = max_history
+    self._queue = Queue.Queue(max_queued)
+    self._threads = []
+    # Path => state dict, in the order of submitting.
+    self._states = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def _start_workers(self):
+    """Start the worker threads if not started. Called with the lock held."""
+    if self._threads:
+      return
+    for _ in range(self._workers):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, path, *args):
+    """Queue |path| to be prefetched.
+
+    Args:
+      path: The path to prefetch.
+      *args: The extra arguments of the warm function.
+
+    Returns:
+      A dict of the state of |path|.
+
+    Raises:
+      QueueFullError if too many paths are waiting.
+    """
+    with self._lock:
+      state = self._states.get(path)
+      if state and state['state'] in (QUEUED, RUNNING):
+        return dict(state)
+
+      self._start_workers()
+      try:
+        self._queue.put_nowait((path, args))
+      except Queue.Full:
+        raise QueueFullError('Too many paths (%d) are waiting to be '
+                             'prefetched.' % self._queue.qsize())
+      state = {'path': path, 'state': QUEUED, 'queued': time.time()}
+      self._states.pop(path, None)
+      self._states[path] = state
+      self._drop_history()
+      return dict(state)
+
+  def _drop_history(self):
+    """Drop the earliest finished states beyond the limit."""
+    excess = len(self._states) - self._max_history
+    for path, state in self._states.items():
+      if excess <= 0:
+        break
+      if state['state'] in (DONE, FAILED):
+        del self._states[path]
+        excess -= 1
+
+  def status(self, path=None):
+    """Get the states of prefetching.
+
+    Args:
+      path: The path to query. Default to all kept paths.
+
+    Returns:
+      A dict of the state of |path|, or None if unknown. A list of states of
+      all kept paths if |path| is None.
+    """
+    with self._lock:
+      if path is None:
+        return [dict(s) for s in self._states.itervalues()]
+      state = self._states.get(path)
+      return dict(state) if state else None
+
+  def _set_state(self, path, **kwargs):
+    with self._lock:
+      self._states[path].update(kwargs)
+
+  def _work(self):
+    """The main loop of a worker thread."""
+    while True:
+      path, args = self._queue.get()
+      self._set_state(path, state=RUNNING, started=time.time())
+      try:
+        self._warm_func(path, *args)
+      except Exception as err:  # pylint: disable=broad-except
+        _logger.warning('Failed to prefetch %s: %s', path, err)
+        self._set_state(path, state=FAILED, finished=time.time(),
+                        error=str(err))
+      else:
+        self._set_state(path, state=DONE, finished=time.time())
+      finally:
+        self._queue.task_done()
@@ -8,15 +8,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+import codecs
 import collections
 import itertools
 import json
 import re
+import struct
+import urllib
+import uuid
 
 import constants
 
 _RANGE_HEADER_SEPARATORS = re.compile('[-/ ]')
-_ONE_LINE = object()  # Special object to indicate data reader to read one line.
+# A tar archive ends with two zero blocks.
+_TAR_END_OF_ARCHIVE_SIZE = 1024
 
 _ContentRangeHeader = collections.namedtuple('_ContentRangeHeader',
                                              ('bytes', 'start', 'end', 'total'))
@@ -34,20 +40,58 @@ class ResponseQueueError(Exception):
   """Exception raised when trying to queue responses not allowed."""
 
 
-def _get_file_by_range_header(range_header_str, file_name_map):
-  """Get file name and size by the Content-Range header.
+class _FileMap(object):
+  """A map to look up files by the byte range of a part of response."""
+
+  def __init__(self, file_info_list):
+    """Constructor.
+
+    Args:
+      file_info_list: A list of tarfile_utils.TarMemberInfo.
+    """
+    self._files = sorted((int(f.content_start), int(f.size), f.filename)
+                         for f in file_info_list)
+    self._starts = [start for start, _, _ in self._files]
+
+  def files_in_range(self, start, size):
+    """Get files whose content is in the range.
+
+    A range may contain more than one file when the ranges of adjacent files
+    are merged into one.
+
+    Args:
+      start: The start offset of the range.
+      size: The size of the range.
+
+    Returns:
+      A list of (filename, offset, size) tuples, where offset is the offset of
+      the file content relative to |start|.
+    """
+    files = []
+    for i in xrange(bisect.bisect_left(self._starts, start), len(self._files)):
+      file_start, file_size, filename = self._files[i]
+      if file_start >= start + size:
+        break
+      if file_start + file_size <= start + size:
+        files.append((filename, file_start - start, file_size))
+    return files
+
+
+def _get_files_by_range_header(range_header_str, file_map):
+  """Get files in the range of the Content-Range header.
 
   The format of Content-Range header is like:
     Content-Range: bytes <start>-<end>/<total>
-  We get the <start> and <end> from it and retrieve the file name from
-  |file_name_map|.
+  We get the <start> and <end> from it and retrieve the files in the range from
+  |file_map|.
 
   Args:
     range_header_str: A string of range header.
-    file_name_map: A dict of {(<start:str>, <size:int>): filename, ...}.
+    file_map: An instance of _FileMap.
 
   Returns:
-    A tuple of (filename, size).
+    A tuple of (size, files), where size is the size of the range and files is
+    a list of (filename, offset, size) tuples of files in the range.
 
   Raises:
     FormatError: Raised when response content interrupted.
@@ -61,34 +105,58 @@ def _get_file_by_range_header(range_header_str, file_name_map):
     range_header = _ContentRangeHeader._make(
         _RANGE_HEADER_SEPARATORS.split(range_header_str)
     )
-    size = int(range_header.end) - int(range_header.start) + 1
+    start = int(range_header.start)
+    size = int(range_header.end) - start + 1
   except (IndexError, ValueError):
     raise FormatError('Wrong format of content range header: %s' %
                       range_header_str)
 
-  try:
-    filename = file_name_map[(range_header.start, size)]
-  except KeyError:
+  files = file_map.files_in_range(start, size)
+  if not files:
     raise NoFileFoundError('Cannot find a file matches the range %s' %
                            range_header_str)
 
-  return filename, size
+  return size, files
 
 
-class JsonStreamer(object):
-  """A class to stream the responses for range requests.
+def _encode_json_string(chunks):
+  """Encode the chunks of a UTF-8 string as a JSON string incrementally.
 
-  The class accepts responses and format the file content in all of them as a
-  JSON stream. The format:
-    '{"<filename>": "<content>", "<filename>": "<content>", ...}'
+  Examples:
+    >>> ''.join(_encode_json_string(['a"', '\\xe4\\xb8', '\\xad\\n']))
+    '"a\\\\"\\\\u4e2d\\\\n"'
+
+  Args:
+    chunks: An iterable of the chunks of the string. A multi-byte character may
+      be split into two chunks.
+
+  Yields:
+    The JSON string in pieces, no larger than about 6 times of the chunks.
   """
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  yield '"'
+  for chunk in chunks:
+    yield json.encoder.encode_basestring_ascii(decoder.decode(chunk))[1:-1]
+  yield json.encoder.encode_basestring_ascii(decoder.decode('', True))[1:-1]
+  yield '"'
+
+
+class FileStreamer(object):
+  """The base class to stream the files in the responses for range requests.
+
+  The class accepts responses, and subclasses format the file content in all of
+  them as a stream.
+  """
+
+  # The Content-Type of the stream.
+  content_type = 'application/octet-stream'
 
   def __init__(self):
     self._files_iter_list = []
     self._can_add_more_response = True
 
   def queue_response(self, response, file_info_list):
-    """Add a reponse to the queue to be streamed as JSON.
+    """Add a reponse to the queue to be streamed.
 
     We can add either:
       1. one and only one response for single-part range requests, or
@@ -98,7 +166,7 @@ class JsonStreamer(object):
       response: An instance of requests.Response, which may be the response of a
         single range request, or a multi-part range request.
       file_info_list: A list of tarfile_utils.TarMemberInfo. We use it to look
-        up file name by content start offset and size.
+        up files by the ranges in the response.
 
     Raises:
       FormatError: Raised when response to be queued isn't for a range request.
@@ -111,8 +179,7 @@ class JsonStreamer(object):
           'No more reponses can be added when there was a response for '
           'single-part range request in the queue!')
 
-    file_name_map = {(f.content_start, int(f.size)): f.filename
-                     for f in file_info_list}
+    file_map = _FileMap(file_info_list)
 
     # Check if the response is for single range, or multi-part range. For a
     # single range request, the response must have header 'Content-Range'. For a
@@ -126,112 +193,320 @@ class JsonStreamer(object):
         raise ResponseQueueError(
             'Cannot queue more than one responses for single-part range '
             'request, or mix responses for single-part and multi-part.')
-      filename, _ = _get_file_by_range_header(content_range, file_name_map)
-      self._files_iter_list = [iter([(filename, response.content)])]
+      size, files = _get_files_by_range_header(content_range, file_map)
+      self._files_iter_list = [_single_range_file_iterator(response, size,
+                                                            files)]
       self._can_add_more_response = False
 
     elif content_type.startswith('multipart/byteranges;'):
       self._files_iter_list.append(
-          _file_iterator(response, file_name_map))
+          _file_iterator(response, file_map))
 
     else:
       raise FormatError('The response is not for a range request.')
 
+  def _iter_files(self):
+    """Iterate files in the queued responses.
+
+    Returns:
+      An iterator of (filename, size, content) tuples, where content is an
+      iterator of the chunks of the file.
+    """
+    return itertools.chain(*self._files_iter_list)
+
+  def stream(self):
+    """Yield the files in the queued responses as a stream.
+
+    The content of files is streamed while it's being downloaded, so the memory
+    usage doesn't depend on the size of files.
+    """
+    raise NotImplementedError()
+
+
+class JsonStreamer(FileStreamer):
+  """A class to stream the files as a JSON object.
+
+  The format:
+    '{"<filename>": "<content>", "<filename>": "<content>", ...}'
+  """
+
+  content_type = 'application/json'
+
   def stream(self):
     """Yield the series of responses content as a JSON stream.
 
     Yields:
       A JSON stream in format described above.
     """
-    files_iter = itertools.chain(*self._files_iter_list)
-
     json_encoder = json.JSONEncoder()
-    filename, content = next(files_iter)
-    yield '{%s: %s' % (json_encoder.encode(filename),
-                       json_encoder.encode(content))
-    for filename, content in files_iter:
-      yield ', %s: %s' % (json_encoder.encode(filename),
-                          json_encoder.encode(content))
-    yield '}'
+    separator = '{'
+    for filename, _, content in self._iter_files():
+      yield '%s%s: ' % (separator, json_encoder.encode(filename))
+      for data in _encode_json_string(content):
+        yield data
+      separator = ', '
+    yield '{}' if separator == '{' else '}'
 
 
-def _data_reader(data_iter):
-  """A coroutine to read data from |data_iter|.
+class TarStreamer(FileStreamer):
+  """A class to stream the records of tar members as a tar archive.
 
-  It accepts two type of parameter:
-    1. _ONE_LINE: Read one CRLF ended line if possible.
-    2. An integer N: Read at most N bytes.
+  The file info queued with responses must describe the whole records, i.e.
+  content_start and size are the offset and size of the record. The records are
+  streamed as is, followed by the two zero blocks marking the end of archive.
+  """
 
-  Args:
-    data_iter: An iterator of data source.
+  content_type = 'application/x-tar'
 
-  Yields:
-    The data read.
+  def stream(self):
+    """Yield the tar archive."""
+    for _, _, content in self._iter_files():
+      for data in content:
+        yield data
+    yield '\0' * _TAR_END_OF_ARCHIVE_SIZE
+
+
+class FramesStreamer(FileStreamer):
+  """A class to stream the files as length-prefixed frames.
+
+  Each file is a frame in format of:
+    <filename length><filename><content length><content>
+  where <filename length> is a big-endian unsigned 32-bit integer and <content
+  length> is a big-endian unsigned 64-bit integer.
   """
-  buffered = next(data_iter)
 
-  # Get what to be read in runtime by passing value into the generator. See
-  # https://docs.python.org/2.5/whatsnew/pep-342.html for syntax details.
-  to_be_read = yield
+  def stream(self):
+    """Yield the frames of files."""
+    for filename, size, content in self._iter_files():
+      yield '%s%s%s' % (struct.pack('>I', len(filename)), filename,
+                        struct.pack('>Q', size))
+      for data in content:
+        yield data
 
-  while True:
-    if to_be_read is _ONE_LINE:
-      parts = buffered.split('\r\n', 1)
-      if len(parts) == 2:
-        line, buffered = parts
-        to_be_read = (yield line)
-        continue
-
-    else:  # Read at most |to_be_read| bytes of data.
-      bytes_remaining = to_be_read - len(buffered)
-      if bytes_remaining < 0:
-        read_bytes = buffered[:bytes_remaining]
-        buffered = buffered[bytes_remaining:]
-        to_be_read = (yield read_bytes)
-        continue
-
-    try:
-      buffered += next(data_iter)
-    except StopIteration:
-      break
 
-  if buffered:
-    yield buffered
+class MultipartStreamer(FileStreamer):
+  """A class to stream the files as a multipart/mixed body.
 
+  Each file is a part with headers Content-Disposition, which has the file name
+  in percent-encoding, and Content-Length.
+  """
 
-def _read_line(reader):
-  """Read one CRLF ended line from the response.
+  def __init__(self):
+    super(MultipartStreamer, self).__init__()
+    self._boundary = uuid.uuid4().hex
+    self.content_type = 'multipart/mixed; boundary=%s' % self._boundary
 
-  Returns:
-    The line read. Return None if nothing to read.
+  def stream(self):
+    """Yield the multipart body."""
+    for filename, size, content in self._iter_files():
+      yield ('--%s\r\n'
+             'Content-Type: application/octet-stream\r\n'
+             "Content-Disposition: attachment; filename*=UTF-8''%s\r\n"
+             'Content-Length: %d\r\n\r\n' %
+             (self._boundary, urllib.quote(filename, safe=''), size))
+      for data in content:
+        yield data
+      yield '\r\n'
+    yield '--%s--\r\n' % self._boundary
+
+
+class _ChunkReader(object):
+  """A file-like reader of the data from an iterator of chunks.
+
+  The reader keeps the current chunk and the offset of unread data in it.
+  Reading bytes returns or copies the data out of the chunk directly. Only a
+  line split into chunks is copied into a bytearray to join the next chunk.
+  And the chunk is scanned for the line separator only once, so the cost of
+  reading is linear to the size of data.
   """
-  return reader.send(_ONE_LINE)
+
+  def __init__(self, data_iter):
+    """Constructor.
+
+    Args:
+      data_iter: An iterator of data source.
+    """
+    self._data_iter = data_iter
+    self._data = ''
+    self._pos = 0  # The offset of unread data in |_data|.
+    self._scanned = 0  # No CRLF before this offset in |_data|.
+
+  def _fill(self):
+    """Read the next chunk of data after the unread data.
+
+    Returns:
+      False if there is no more data.
+    """
+    chunk = next(self._data_iter, None)
+    if chunk is None:
+      return False
+
+    if self._pos < len(self._data):
+      # Only part of a line is left unread, which is short.
+      data = bytearray(memoryview(self._data)[self._pos:])
+      data += chunk
+      self._data = data
+      self._scanned -= self._pos
+    else:
+      self._data = chunk
+      self._scanned = 0
+    self._pos = 0
+    return True
+
+  def _buffered(self):
+    """Get the size of unread data. Read a new chunk if nothing is unread."""
+    while self._pos == len(self._data):
+      if not self._fill():
+        return 0
+    return len(self._data) - self._pos
+
+  def readline(self):
+    """Read one CRLF ended line.
+
+    Returns:
+      The line without CRLF. The unread data if there is no CRLF before EOF.
+      None if nothing to read.
+    """
+    while True:
+      index = self._data.find('\r\n', max(self._pos, self._scanned))
+      if index >= 0:
+        line = str(self._data[self._pos:index])
+        self._pos = self._scanned = index + 2
+        return line
+
+      # The last byte may be the CR of a CRLF split into two chunks.
+      self._scanned = max(self._pos, len(self._data) - 1)
+      if not self._fill():
+        break
+
+    if self._pos == len(self._data):
+      return None
+    line = str(self._data[self._pos:])
+    self._pos = len(self._data)
+    return line
+
+  def read(self, size):
+    """Read at most |size| bytes.
+
+    It only waits for more data when nothing is buffered, so the data is read
+    in chunks of bounded size, and a whole chunk is returned without copy.
+
+    Returns:
+      The data read. An empty string on EOF.
+    """
+    buffered = self._buffered()
+    if not buffered:
+      return ''
+    if self._pos == 0 and size >= buffered and isinstance(self._data, str):
+      data = self._data
+    else:
+      size = min(size, buffered)
+      data = memoryview(self._data)[self._pos:self._pos + size].tobytes()
+    self._pos += len(data)
+    return data
+
+  def readinto(self, buf):
+    """Read at most len(|buf|) bytes into the writable buffer |buf|.
+
+    Returns:
+      The number of bytes read. 0 on EOF.
+    """
+    size = min(len(buf), self._buffered())
+    memoryview(buf)[:size] = memoryview(self._data)[self._pos:self._pos + size]
+    self._pos += size
+    return size
+
+  def skip(self, size):
+    """Skip at most |size| bytes without copying them.
+
+    Returns:
+      The number of bytes skipped. 0 on EOF.
+    """
+    size = min(size, self._buffered())
+    self._pos += size
+    return size
 
 
 def _read_empty_line(reader):
   """Read one line and assert it is empty."""
-  try:
-    line = _read_line(reader)
-  except StopIteration:
+  line = reader.readline()
+  if line is None:
     raise FormatError('Expect an empty line, but got EOF.')
   if line:
     raise FormatError('Expect an empty line, but got "%s".' % line)
 
 
-def _read_bytes(reader, max_bytes):
-  """Read at most |max_bytes| bytes from the reader.
+def _iter_bytes(reader, size):
+  """Read |size| bytes from the reader in chunks.
+
+  Raises:
+    FormatError: Raised when there are less than |size| bytes to read.
+  """
+  while size > 0:
+    data = reader.read(size)
+    if not data:
+      raise FormatError('Expect %d more bytes, but got EOF.' % size)
+    size -= len(data)
+    yield data
+
+
+def _skip_bytes(reader, size):
+  """Skip |size| bytes of the reader.
+
+  Raises:
+    FormatError: Raised when there are less than |size| bytes to skip.
+  """
+  while size > 0:
+    skipped = reader.skip(size)
+    if not skipped:
+      raise FormatError('Expect %d more bytes, but got EOF.' % size)
+    size -= skipped
+
+
+def _iter_files_in_part(reader, size, files):
+  """The iterator of files in a part of response.
 
   Args:
-    reader:
-    max_bytes: An integer of maximum bytes of bytes to read.
+    reader: The _ChunkReader positioned at the start of the part.
+    size: The size of the part.
+    files: A list of (filename, offset, size) tuples of files in the part,
+      sorted by the offset.
 
-  Returns:
-    The bytes read. Return None if nothing to read.
+  Yields:
+    A tuple of (name, size, content) of the file, where content is an iterator
+    of the chunks of the file. It's skipped if not consumed before the next
+    file.
   """
-  return reader.send(max_bytes)
+  pos = 0
+  for filename, offset, file_size in files:
+    _skip_bytes(reader, offset - pos)
+    content = _iter_bytes(reader, file_size)
+    yield filename, file_size, content
+    for _ in content:
+      pass
+    pos = offset + file_size
+  _skip_bytes(reader, size - pos)
 
 
-def _file_iterator(response, file_name_map):
+def _single_range_file_iterator(response, size, files):
+  """The iterator of files in a response of single range request.
+
+  Args:
+    response: An instance of requests.response.
+    size: The size of the range.
+    files: A list of (filename, offset, size) tuples of files in the range.
+
+  Yields:
+    A tuple of (name, size, content) of the file, where content is an iterator
+    of the chunks of the file.
+  """
+  reader = _ChunkReader(
+      response.iter_content(constants.READ_BUFFER_SIZE_BYTES))
+  for file_info in _iter_files_in_part(reader, size, files):
+    yield file_info
+
+
+def _file_iterator(response, file_map):
   """The iterator of files in a response of multi-part range request.
 
   An example response is like:
@@ -252,43 +527,34 @@ def _file_iterator(response, file_name_map):
     <data>
     --magic_string--
 
-  In our application, each part is the content of a file. This class iterates
-  the files.
+  In our application, each part is the content of one file, or several files
+  close to each other. This class iterates the files.
 
   Args:
     response: An instance of requests.response.
-    file_name_map: A dict of {(<start:str>, <size:int>): filename, ...}.
+    file_map: An instance of _FileMap.
 
   Yields:
-    A pair of (name, content) of the file.
+    A tuple of (name, size, content) of the file, where content is an iterator
+    of the chunks of the file.
 
   Raises:
     FormatError: Raised when response content interrupted.
   """
-  reader = _data_reader(
+  reader = _ChunkReader(
       response.iter_content(constants.READ_BUFFER_SIZE_BYTES))
-  reader.next()  # initialize the coroutine
 
   _read_empty_line(reader)  # The first line is empty.
   while True:
-    _read_line(reader)  # The second line is the boundary.
-    _read_line(reader)  # The line sub content type.
-    sub_range_header = _read_line(reader)  # The line of sub content range.
+    reader.readline()  # The second line is the boundary.
+    reader.readline()  # The line sub content type.
+    sub_range_header = reader.readline()  # The line of sub content range.
     if sub_range_header is None:
       break
     _read_empty_line(reader)  # Another empty line.
 
-    filename, size = _get_file_by_range_header(sub_range_header,
-                                               file_name_map)
-    content = _read_bytes(reader, size)
+    size, files = _get_files_by_range_header(sub_range_header, file_map)
+    for file_info in _iter_files_in_part(reader, size, files):
+      yield file_info
 
     _read_empty_line(reader)  # Every content has a trailing '\r\n'.
-
-    bytes_read = 0 if content is None else len(content)
-    if bytes_read != size:
-      raise FormatError(
-          '%s: Error in reading content (read %d B, expect %d B)' %
-          (filename, bytes_read, size)
-      )
-
-    yield filename, content
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Random access to the decompressed content of compressed archives.
+
+A compressed archive can only be decompressed from its beginning, so reading a
+range of the decompressed content requires decompressing everything before it.
+This module records restart points (checkpoints) of the decompressor when an
+archive is decompressed for the first time. Later, a range is read by fetching
+the compressed data from the nearest checkpoint before the range, and only the
+data between them is decompressed.
+
+Supported formats:
+  gzip: The state of zlib decompressor is copied every |interval| bytes of
+    decompressed content. Multi-member gzip files are supported.
+  bzip2: The beginning of each bzip2 stream is a restart point, so only
+    archives of multiple streams (e.g. compressed by pbzip2) benefit from it.
+  xz isn't supported because Python 2 has no lzma module.
+
+The state of zlib decompressor can't be saved to disk, so the index is only
+kept in memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import bz2
+import collections
+import re
+import threading
+import zlib
+
+# The extension names of archives which can be indexed.
+SEEKABLE_EXT_NAMES = ('.gz', '.tgz', '.bz2')
+
+DEFAULT_CHECKPOINT_INTERVAL_BYTES = 16 * 1024 * 1024  # 16 MB
+
+# The default max number of indexes kept in memory. The checkpoints of gzip
+# files take about 40 KB each, i.e. about 3 MB for a 1 GB archive.
+_DEFAULT_MAX_INDEXES = 64
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_GZIP_MAGIC = b'\x1f\x8b'
+_BZ2_MAGIC = b'BZh'
+
+# The beginning of a bzip2 stream: 'BZh', the block size and the magic number
+# of the first block.
+_BZ2_STREAM_START_RE = re.compile(b'BZh[1-9]1AY&SY')
+_BZ2_STREAM_START_SIZE = 10
+
+# A restart point of decompression.
+# Fields:
+#   compressed_offset: The offset of the compressed data to restart from.
+#   decompressed_offset: The offset of the decompressed content at that point.
+#   state: The state of the decompressor, or None for a fresh one.
+Checkpoint = collections.namedtuple(
+    'Checkpoint', ('compressed_offset', 'decompressed_offset', 'state'))
+
+
+class SeekIndexError(Exception):
+  """Exception raised when failed to read a range by the index."""
+
+
+class _GzipDecompressor(object):
+  """A gzip decompressor which can be copied at any point.
+
+  Like `gzip -d`, the data which doesn't start with a gzip header after the
+  last member, e.g. zero padding, is ignored.
+  """
+
+  def __init__(self, state=None):
+    """Constructor.
+
+    Args:
+      state: A zlib decompress object to restart from, or None to start from
+        the beginning of a gzip file.
+    """
+    self._decompressor = (state.copy() if state else
+                          zlib.decompressobj(_GZIP_WBITS))
+    self._consumed = 0
+    self._produced = 0
+    # The data after the end of a member, which is not long enough to tell if
+    # it's the header of the next member.
+    self._trailing = b''
+    self._ignore_trailing = False
+
+  def decompress(self, data):
+    """Decompress |data| and return the decompressed content."""
+    self._consumed += len(data)
+    output = []
+    while data and not self._ignore_trailing:
+      output.append(self._decompressor.decompress(data))
+      data = self._trailing + self._decompressor.unused_data
+      self._trailing = b''
+      if len(data) < len(_GZIP_MAGIC):
+        self._trailing = data
+        break
+      if data.startswith(_GZIP_MAGIC):
+        # Multi-member gzip: a new member follows the end of the previous one.
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+      else:
+        self._ignore_trailing = True
+    output = b''.join(output)
+    self._produced += len(output)
+    return output
+
+  def flush(self):
+    return self._decompressor.flush()
+
+  def restart_points(self):
+    """Get the (compressed, decompressed) offsets which can be restarted from.
+
+    Each call returns the points since the last call. The gzip decompressor
+    can restart from where it is now, excluding the trailing data which is
+    not fed to it yet.
+    """
+    return [(self._consumed - len(self._trailing), self._produced)]
+
+  def state(self):
+    """Get the state to restart from the last point of restart_points()."""
+    return self._decompressor.copy()
+
+
+class _Bz2Decompressor(object):
+  """A bzip2 decompressor which can restart from the beginning of streams.
+
+  Like `bzip2 -d`, the data which doesn't start with a bzip2 header after the
+  last stream is ignored.
+  """
+
+  def __init__(self, state=None):
+    """Constructor.
+
+    Args:
+      state: Always None, since bzip2 restarts from a new stream.
+    """
+    assert state is None
+    self._decompressor = bz2.BZ2Decompressor()
+    self._consumed = 0
+    self._produced = 0
+    self._stream_starts = []
+    self._trailing = b''
+    self._ignore_trailing = False
+
+  def _new_stream(self, data):
+    """Start a new stream if |data| begins with one.
+
+    Returns:
+      The data to be decompressed by the new stream, or an empty string if no
+      more data to be decompressed for now.
+    """
+    data = self._trailing + data
+    self._trailing = b''
+    if len(data) < len(_BZ2_MAGIC):
+      self._trailing = data
+      return b''
+    if not data.startswith(_BZ2_MAGIC):
+      self._ignore_trailing = True
+      return b''
+
+    self._decompressor = bz2.BZ2Decompressor()
+    self._stream_starts.append((self._consumed, self._produced))
+    return data
+
+  def decompress(self, data):
+    """Decompress |data| and return the decompressed content."""
+    output = []
+    if self._trailing:
+      data = self._new_stream(data)
+    while data and not self._ignore_trailing:
+      try:
+        decompressed = self._decompressor.decompress(data)
+      except EOFError:
+        # The previous stream ended at the end of the previous data.
+        data = self._new_stream(data)
+        continue
+
+      output.append(decompressed)
+      self._produced += len(decompressed)
+      unused_data = self._decompressor.unused_data
+      self._consumed += len(data) - len(unused_data)
+      data = self._new_stream(unused_data) if unused_data else b''
+    return b''.join(output)
+
+  def flush(self):
+    return b''
+
+  def restart_points(self):
+    """Get the (compressed, decompressed) offsets which can be restarted from.
+
+    Each call returns the points since the last call, i.e. the beginning of
+    new bzip2 streams.
+    """
+    points, self._stream_starts = self._stream_starts, []
+    return points
+
+  def state(self):
+    return None
+
+
+class Bz2StreamScanner(object):
+  """Tell if a bzip2 file has more than one stream.
+
+  Only the archives of multiple streams can be indexed. The scanner searches
+  the compressed data for the beginning of a stream, which is much cheaper than
+  decompressing it.
+  """
+
+  def __init__(self):
+    self.multi_stream = False
+    self._tail = b''
+    self._tail_offset = 0  # The offset of self._tail in the whole file.
+
+  def feed(self, data):
+    """Scan the next chunk of the bzip2 file."""
+    if self.multi_stream:
+      return
+    data = self._tail + data
+    # Skip the beginning of the first stream at offset 0.
+    if _BZ2_STREAM_START_RE.search(data, max(1 - self._tail_offset, 0)):
+      self.multi_stream = True
+      return
+    self._tail = data[-(_BZ2_STREAM_START_SIZE - 1):]
+    self._tail_offset += len(data) - len(self._tail)
+
+
+def _new_decompressor(ext_name, state=None):
+  """Create a decompressor of the format indicated by |ext_name|."""
+  if ext_name == '.bz2':
+    return _Bz2Decompressor(state)
+  return _GzipDecompressor(state)
+
+
+class SeekIndex(object):
+  """The index of checkpoints of a compressed archive."""
+
+  def __init__(self, ext_name, etag, size, checkpoints):
+    """Constructor.
+
+    Args:
+      ext_name: The extension name of the compressed archive.
+      etag: The ETag of the compressed archive when the index built.
+      size: The size of the decompressed content.
+      checkpoints: A list of Checkpoint sorted by offsets.
+    """
+    self.ext_name = ext_name
+    self.etag = etag
+    self.size = size
+    self.checkpoints = checkpoints
+    self._offsets = [c.decompressed_offset for c in checkpoints]
+
+  def find_checkpoint(self, offset):
+    """Find the nearest checkpoint before the decompressed |offset|."""
+    return self.checkpoints[bisect.bisect_right(self._offsets, offset) - 1]
+
+
+class SeekIndexBuilder(object):
+  """Decompress an archive and build its SeekIndex at the same time."""
+
+  def __init__(self, ext_name, interval=DEFAULT_CHECKPOINT_INTERVAL_BYTES):
+    """Constructor.
+
+    Args:
+      ext_name: The extension name of the compressed archive.
+      interval: The minimum bytes of decompressed content between checkpoints.
+    """
+    self._ext_name = ext_name
+    self._interval = interval
+    self._decompressor = _new_decompressor(ext_name)
+    self._checkpoints = [Checkpoint(0, 0, None)]
+    self._size = 0
+
+  def decompress(self, data):
+    """Decompress the next chunk of the archive.
+
+    Args:
+      data: A chunk of the compressed archive.
+
+    Returns:
+      The decompressed content.
+    """
+    output = self._decompressor.decompress(data)
+    self._size += len(output)
+    for compressed_offset, decompressed_offset in (
+        self._decompressor.restart_points()):
+      if (decompressed_offset - self._checkpoints[-1].decompressed_offset >=
+          self._interval):
+        self._checkpoints.append(Checkpoint(
+            compressed_offset, decompressed_offset, self._decompressor.state()))
+    return output
+
+  def flush(self):
+    """Get the remaining decompressed content."""
+    output = self._decompressor.flush()
+    self._size += len(output)
+    return output
+
+  def build(self, etag):
+    """Build the index after all data decompressed.
+
+    Args:
+      etag: The ETag of the compressed archive.
+
+    Returns:
+      An instance of SeekIndex.
+    """
+    return SeekIndex(self._ext_name, etag, self._size, self._checkpoints)
+
+
+class RangeReader(object):
+  """Read ranges of the decompressed content by a SeekIndex.
+
+  Reading ranges in ascending order reuses the decompression of the previous
+  range if no checkpoint is closer to the next range.
+  """
+
+  def __init__(self, index, fetch):
+    """Constructor.
+
+    Args:
+      index: An instance of SeekIndex.
+      fetch: A function which accepts an offset of compressed archive and
+        returns an iterable of the compressed data from that offset.
+    """
+    self._index = index
+    self._fetch = fetch
+    self._chunks = None
+    self._decompressor = None
+    self._pos = None  # The decompressed offset of self._pending.
+    self._pending = b''
+
+  def seek(self, offset):
+    """Restart decompression from the nearest checkpoint before |offset|.
+
+    Raises:
+      SeekIndexError: Raised when failed to fetch the compressed data.
+    """
+    self.close()
+    checkpoint = self._index.find_checkpoint(offset)
+    self._chunks = iter(self._fetch(checkpoint.compressed_offset))
+    self._decompressor = _new_decompressor(self._index.ext_name,
+                                           checkpoint.state)
+    self._pos = checkpoint.decompressed_offset
+    self._pending = b''
+
+  def read(self, start, stop):
+    """Yield the decompressed content in range [start, stop).
+
+    Raises:
+      SeekIndexError: Raised when the compressed data ends before |stop| or is
+        corrupted.
+    """
+    if (self._pos is None or start < self._pos or
+        self._index.find_checkpoint(start).decompressed_offset >
+        self._pos + len(self._pending)):
+      self.seek(start)
+
+    while self._pos < stop:
+      if not self._pending:
+        try:
+          self._pending = self._decompressor.decompress(next(self._chunks))
+        except StopIteration:
+          self._pending = self._decompressor.flush()
+          if not self._pending:
+            raise SeekIndexError('Unexpected EOF at offset %d.' % self._pos)
+        except (zlib.error, IOError) as err:
+          raise SeekIndexError('Failed to decompress at offset %d: %s' %
+                               (self._pos, err))
+        continue
+
+      begin = min(max(start - self._pos, 0), len(self._pending))
+      end = min(max(stop - self._pos, begin), len(self._pending))
+      if begin < end:
+        yield self._pending[begin:end]
+      self._pending = self._pending[end:]
+      self._pos += end
+
+  def close(self):
+    """Close the fetched compressed data."""
+    if hasattr(self._chunks, 'close'):
+      self._chunks.close()
+    self._chunks = None
+
+
+class SeekIndexCache(object):
+  """A thread-safe LRU cache of SeekIndex of archives."""
+
+  def __init__(self, interval=DEFAULT_CHECKPOINT_INTERVAL_BYTES,
+               max_indexes=_DEFAULT_MAX_INDEXES):
+    """Constructor.
+
+    Args:
+      interval: The minimum bytes of decompressed content between checkpoints.
+      max_indexes: The max number of indexes to keep.
+    """
+    self.interval = interval
+    self._max_indexes = max_indexes
+    self._indexes = collections.OrderedDict()
+    # The bzip2 archives known to have multiple streams, which are worth
+    # indexing.
+    self._multi_stream_archives = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, path):
+    """Get the index of archive |path|, or None if not indexed."""
+    with self._lock:
+      index = self._indexes.pop(path, None)
+      if index:
+        self._indexes[path] = index
+      return index
+
+  def put(self, path, index):
+    """Save the |index| of archive |path|."""
+    with self._lock:
+      self._indexes.pop(path, None)
+      self._indexes[path] = index
+      while len(self._indexes) > self._max_indexes:
+        self._indexes.popitem(last=False)
+
+  def drop(self, path):
+    """Drop the index of archive |path|."""
+    with self._lock:
+      self._indexes.pop(path, None)
+
+  def add_multi_stream(self, path):
+    """Remember |path| is a bzip2 archive of multiple streams."""
+    with self._lock:
+      self._multi_stream_archives.pop(path, None)
+      self._multi_stream_archives[path] = True
+      while len(self._multi_stream_archives) > self._max_indexes:
+        self._multi_stream_archives.popitem(last=False)
+
+  def is_multi_stream(self, path):
+    """Tell if |path| is known as a bzip2 archive of multiple streams."""
+    with self._lock:
+      return path in self._multi_stream_archives
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Collapse concurrent fetches of the same content into one.
+
+When many requests of the same content arrive at the same time, e.g. DUTs
+provisioned with a newly published build, only the first one fetches the
+content. A background thread writes the content to a spool file, and every
+request, including the first one, reads the spool file at its own pace. So a
+slow client doesn't slow down the others.
+
+A flight is forgotten once the content is completely fetched, and later
+requests fetch the content again (usually from a cache). The fetch is canceled
+if all requests attached to it are gone.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import threading
+
+import constants
+from chromite.lib import cros_logging as logging
+
+_logger = logging.getLogger(__name__)
+
+
+class CanceledError(Exception):
+  """Exception raised when the fetch was canceled."""
+
+
+class _Flight(object):
+  """A fetch in progress, which is spooled to a file."""
+
+  def __init__(self, key, lock, spool_dir):
+    self.key = key
+    self.readers = 0
+    self._cond = threading.Condition(lock)
+    fd, self._path = tempfile.mkstemp(prefix='flight', dir=spool_dir)
+    self._file = os.fdopen(fd, 'wb')
+    self._size = 0
+    self._done = False
+    self._error = None
+
+  def open(self):
+    """Open the spool file for a reader.
+
+    It must be called with the lock acquired.
+    """
+    fd = os.open(self._path, os.O_RDONLY)
+    self.readers += 1
+    return _Reader(self, fd)
+
+  def close_reader(self):
+    """Detach a reader."""
+    with self._cond:
+      self.readers -= 1
+
+  def run(self, chunks, forget):
+    """Write the fetched |chunks| to the spool file.
+
+    Args:
+      chunks: An iterable of the fetched content.
+      forget: A function to remove the flight from the registry if it has no
+        readers, or unconditionally if called with force=True. It's called
+        with the lock acquired and returns True if removed.
+    """
+    error = None
+    try:
+      for chunk in chunks:
+        self._file.write(chunk)
+        self._file.flush()
+        with self._cond:
+          self._size += len(chunk)
+          self._cond.notify_all()
+          if forget(force=False):
+            error = (CanceledError, CanceledError('No one is waiting.'), None)
+            break
+    except Exception:  # pylint: disable=broad-except
+      error = sys.exc_info()
+    finally:
+      with self._cond:
+        forget(force=True)
+      self._file.close()
+      # Readers have opened the spool file, and no more reader after forgotten.
+      # It's removed before readers are notified of the end, so nothing is
+      # left once they are done.
+      os.unlink(self._path)
+      with self._cond:
+        self._done = True
+        self._error = error
+        self._cond.notify_all()
+      close = getattr(chunks, 'close', None)
+      if close:
+        close()
+
+  def wait(self):
+    """Wait until all content is fetched.
+
+    Returns:
+      The size of content.
+
+    Raises:
+      Any exception raised when fetching the content.
+    """
+    with self._cond:
+      while not self._done:
+        self._cond.wait()
+      if self._error:
+        exc_type, exc_value, exc_traceback = self._error
+        raise exc_type, exc_value, exc_traceback
+      return self._size
+
+  def read(self, fd):
+    """Yield the content in the spool file, waiting for it to be fetched."""
+    pos = 0
+    while True:
+      with self._cond:
+        while pos == self._size and not self._done:
+          self._cond.wait()
+        size, error = self._size, self._error
+      if pos < size:
+        data = os.read(fd, min(size - pos, constants.READ_BUFFER_SIZE_BYTES))
+        pos += len(data)
+        yield data
+      elif error:
+        exc_type, exc_value, exc_traceback = error
+        raise exc_type, exc_value, exc_traceback
+      else:
+        break
+
+
+class _Reader(object):
+  """A reader of the content of a flight."""
+
+  def __init__(self, flight, fd):
+    self._flight = flight
+    self._fd = fd
+
+  def wait(self):
+    """Wait until all content is fetched. See _Flight.wait."""
+    return self._flight.wait()
+
+  def __iter__(self):
+    """Yield the content at the pace of the caller."""
+    try:
+      for data in self._flight.read(self._fd):
+        yield data
+    finally:
+      self.close()
+
+  def close(self):
+    """Detach from the flight. It's canceled if no other reader."""
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+      self._flight.close_reader()
+
+
+class SingleFlight(object):
+  """The registry of flights, keyed by what is fetched."""
+
+  def __init__(self, spool_dir=None):
+    """Constructor.
+
+    Args:
+      spool_dir: The directory of spool files. Default to the system temporary
+        directory.
+    """
+    self._spool_dir = spool_dir
+    self._lock = threading.Lock()
+    self._flights = {}
+
+  def fetch(self, key, fetch_func):
+    """Fetch the content of |key|, or attach to the flight fetching it.
+
+    Args:
+      key: The key of content.
+      fetch_func: A function returning an iterable of the content. It's called
+        in a background thread, only if there isn't a flight of |key|.
+
+    Returns:
+      A reader of the content, which is iterable. It must be iterated or closed
+      to detach from the flight.
+    """
+    with self._lock:
+      flight = self._flights.get(key)
+      if flight:
+        _logger.info('Attached to the fetching of %s.', key)
+        return flight.open()
+
+      flight = _Flight(key, self._lock, self._spool_dir)
+      self._flights[key] = flight
+      reader = flight.open()
+
+    def forget(force):
+      if force or not flight.readers:
+        if self._flights.get(key) is flight:
+          del self._flights[key]
+        return True
+      return False
+
+    def run():
+      try:
+        chunks = fetch_func()
+      except Exception:  # pylint: disable=broad-except
+        chunks = _raise(sys.exc_info())
+      flight.run(chunks, forget)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return reader
+
+
+def _raise(exc_info):
+  """A generator raising the exception of |exc_info|."""
+  exc_type, exc_value, exc_traceback = exc_info
+  raise exc_type, exc_value, exc_traceback
+  yield  # pylint: disable=unreachable
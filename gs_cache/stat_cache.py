@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A cache of the metadata of GS objects.
+
+Every download needs the content type, length and generation of the object,
+which costs a round trip to GS. This module caches them in memory, and
+optionally in a SQLite database shared by server processes and kept across
+restarts.
+
+Cached metadata expires after a TTL, except objects under a versioned build
+path, e.g. gs://bucket/eve-release/R80-12739.0.0/image.zip, which are never
+changed once uploaded. Objects not found are cached too, but for a shorter
+TTL since they may be uploaded later.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import contextlib
+import re
+import sqlite3
+import threading
+import time
+
+import gcs_client
+from chromite.lib import cros_logging as logging
+from chromite.lib import gs
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_NEGATIVE_TTL_SECONDS = 60
+DEFAULT_MAX_ENTRIES = 10000
+
+# A directory of a build, e.g. R80-12739.0.0 or R80-12739.0.0-rc2.
+_IMMUTABLE_PATH_RE = re.compile(r'/R\d+-\d+\.\d+\.\d+(-rc\d+)?/')
+
+# The timeout of acquiring the database lock. The database may be shared by
+# several server processes.
+_DB_LOCK_TIMEOUT_SECONDS = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats (
+  path TEXT PRIMARY KEY,
+  content_length INTEGER,
+  content_type TEXT,
+  generation INTEGER,
+  expiration REAL
+);
+"""
+
+_NEVER = float('inf')
+
+
+class StatCache(object):
+  """The cache of metadata of GS objects, keyed by GS path."""
+
+  def __init__(self, db_path=None, ttl=DEFAULT_TTL_SECONDS,
+               negative_ttl=DEFAULT_NEGATIVE_TTL_SECONDS,
+               max_entries=DEFAULT_MAX_ENTRIES,
+               immutable_pattern=_IMMUTABLE_PATH_RE):
+    """Constructor.
+
+    Args:
+      db_path: The path of SQLite database file, which is created if not exist.
+        Metadata is cached in memory only if it's None.
+      ttl: The seconds to trust the cached metadata of an object.
+      negative_ttl: The seconds to trust that an object doesn't exist.
+      max_entries: The max number of objects cached in memory and in the
+        database respectively. The least recently used ones are dropped first
+        from memory, and the earliest saved ones from the database.
+      immutable_pattern: A compiled regular expression. Metadata of objects
+        whose paths match it never expire.
+    """
+    self._db_path = db_path
+    self._ttl = ttl
+    self._negative_ttl = negative_ttl
+    self._max_entries = max_entries
+    self._immutable_pattern = immutable_pattern
+    # GS path => (stat or None if not exist, expiration time).
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    if db_path:
+      with self._transaction() as conn:
+        conn.executescript(_SCHEMA)
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    """Open a new connection to the database and run a transaction on it."""
+    with contextlib.closing(sqlite3.connect(
+        self._db_path, timeout=_DB_LOCK_TIMEOUT_SECONDS)) as conn:
+      conn.text_factory = str
+      with conn:
+        yield conn
+
+  def _expiration(self, path, stat):
+    """Get the expiration time of the metadata of |path|."""
+    if stat is None:
+      return time.time() + self._negative_ttl
+    if self._immutable_pattern.search(path):
+      return _NEVER
+    return time.time() + self._ttl
+
+  def _get_from_memory(self, path):
+    with self._lock:
+      entry = self._entries.pop(path, None)
+      if entry is None or entry[1] <= time.time():
+        return None
+      self._entries[path] = entry
+      return entry
+
+  def _get_from_db(self, path):
+    if not self._db_path:
+      return None
+    try:
+      with self._transaction() as conn:
+        row = conn.execute(
+            'SELECT content_length, content_type, generation, expiration FROM '
+            'stats WHERE path = ?', (path,)).fetchone()
+    except sqlite3.Error as err:
+      _logger.warning('Failed to get the metadata of %s: %s', path, err)
+      return None
+    if row is None:
+      return None
+    content_length, content_type, generation, expiration = row
+    expiration = _NEVER if expiration is None else expiration
+    if expiration <= time.time():
+      return None
+    stat = None
+    if content_length is not None:
+      stat = gcs_client.StatResult(content_length=content_length,
+                                   content_type=content_type,
+                                   generation=generation)
+    return stat, expiration
+
+  def _put(self, path, entry, to_db=True):
+    with self._lock:
+      self._entries.pop(path, None)
+      self._entries[path] = entry
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+    if not to_db or not self._db_path:
+      return
+    stat, expiration = entry
+    try:
+      with self._transaction() as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?)',
+            (path,
+             None if stat is None else int(stat.content_length),
+             None if stat is None else stat.content_type,
+             None if stat is None else stat.generation,
+             None if expiration == _NEVER else expiration))
+        # Rows are replaced when saved, so rows of smaller IDs are saved
+        # earlier.
+        conn.execute(
+            'DELETE FROM stats WHERE rowid IN (SELECT rowid FROM stats ORDER '
+            'BY rowid DESC LIMIT -1 OFFSET ?)', (self._max_entries,))
+    except sqlite3.Error as err:
+      _logger.warning('Failed to save the metadata of %s: %s', path, err)
+
+  def stat(self, path, stat_func):
+    """Get the metadata of the object |path|.
+
+    Args:
+      path: The GS path of the object.
+      stat_func: A function to get the metadata from GS if not cached, which is
+        called with |path|.
+
+    Returns:
+      The metadata returned by |stat_func|, or an instance of
+      gcs_client.StatResult if it's cached in the database.
+
+    Raises:
+      gs.GSNoSuchKey if the object doesn't exist.
+    """
+    entry = self._get_from_memory(path)
+    if entry is None:
+      entry = self._get_from_db(path)
+      if entry is not None:
+        self._put(path, entry, to_db=False)
+
+    if entry is None:
+      try:
+        stat = stat_func(path)
+      except gs.GSNoSuchKey:
+        self._put(path, (None, self._expiration(path, None)))
+        raise
+      entry = (stat, self._expiration(path, stat))
+      self._put(path, entry)
+
+    stat = entry[0]
+    if stat is None:
+      raise gs.GSNoSuchKey('%s: No such object (cached).' % path)
+    return stat
+
+  def invalidate(self, path):
+    """Drop the cached metadata of |path|, e.g. it's found out of date."""
+    with self._lock:
+      self._entries.pop(path, None)
+    if not self._db_path:
+      return
+    try:
+      with self._transaction() as conn:
+        conn.execute('DELETE FROM stats WHERE path = ?', (path,))
+    except sqlite3.Error as err:
+      _logger.warning('Failed to drop the metadata of %s: %s', path, err)
@@ -4,8 +4,9 @@
 
 """Utils for manipulating tar format archives.
 
-We use tar command to manipulate tar file other than using Python tarfile module
-because that module is very slow in the case of large file.
+We parse tar headers by ourselves other than using Python tarfile module because
+that module is very slow in the case of large file. The parser works on chunks
+of the archive, so members are listed while the archive is still downloading.
 """
 
 from __future__ import absolute_import
@@ -13,12 +14,39 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import re
+import struct
 
 from chromite.lib import cros_logging as logging
 
 _logger = logging.getLogger(__name__)
 
+_BLOCK_SIZE = 512
+
+# Type flags of tar headers which describe the next member other than being a
+# member themselves.
+_GNU_LONGNAME = b'L'
+_GNU_LONGLINK = b'K'
+_PAX_HEADER = b'x'
+_PAX_GLOBAL_HEADER = b'g'
+_EXTENDED_HEADER_TYPES = (_GNU_LONGNAME, _GNU_LONGLINK, _PAX_HEADER,
+                          _PAX_GLOBAL_HEADER)
+
+_HARD_LINK = b'1'
+_SYMBOLIC_LINK = b'2'
+_DIRECTORY = b'5'
+_GNU_SPARSE = b'S'
+
+_POSIX_MAGIC = b'ustar\x00'
+
+# The offset of 'isextended' flag in a GNU sparse header and in a sparse
+# extension block respectively.
+_GNU_SPARSE_IS_EXTENDED_OFFSET = 482
+_GNU_SPARSE_EXT_IS_EXTENDED_OFFSET = 504
+
+
+class FormatError(Exception):
+  """Exception raised when the archive isn't in a valid tar format."""
+
 
 def _round_up_to_512(number):
   """Up round the given |number| to smallest multiple of 512.
@@ -40,33 +68,92 @@ def _round_up_to_512(number):
   return (number + 511) & -512
 
 
-def _get_command_result_from_tar_tvR(an_output_line):
-  """Get an object of _TarListCommandResult from one line of `tar tvR` output.
+def _null_terminated(field):
+  """Get the string before the first NUL of a header field.
 
-  Args:
-    an_output_line: One line of `tar tvR` output. Trailing '\n' is acceptable.
-      The last line of `tar tvR` is acceptable.
+  Examples:
+    >>> _null_terminated(b'foo\\x00bar\\x00')
+    'foo'
+  """
+  return field.split(b'\x00', 1)[0]
 
-  Returns:
-    An object of _TarListCommandResult.
+
+def _parse_number(field):
+  """Parse a numeric field of a tar header.
+
+  The field is either an octal number, or a base-256 number (GNU extension for
+  large numbers) whose first byte has the highest bit set.
+
+  Examples:
+    >>> _parse_number(b'00000000144\\x00')
+    100
+    >>> _parse_number(b'\\x80' + b'\\x00' * 6 + b'\\x02\\x00\\x00\\x00\\x00')
+    8589934592
+
+  Raises:
+    FormatError: Raised when the field isn't a valid number.
   """
-  separators = re.compile('[ \t:]+')
-  fields_num = len(_TarListCommandResult._fields)
-  fields = re.split(separators, an_output_line.rstrip('\n'),
-                    maxsplit=fields_num - 1)
+  if ord(field[0:1]) & 0x80:
+    if field[0:1] != b'\x80':
+      raise FormatError('Negative number in tar header: %r' % field)
+    value = bytearray(field)
+    value[0] &= 0x7f
+    return sum(b << (8 * i) for i, b in enumerate(reversed(value)))
+
   try:
-    return _TarListCommandResult._make(fields)
-  except TypeError:
-    # The last line of `tar tvR` hasn't enough fields. Fill with fake data.
-    _logger.debug('This should be the last line of `tar tvR`: %s',
-                  an_output_line)
-    fields.extend(_TarListCommandResult._fields[len(fields):])
-    return _TarListCommandResult._make(fields)
+    return int(_null_terminated(field).strip() or '0', 8)
+  except ValueError:
+    raise FormatError('Bad number in tar header: %r' % field)
+
+
+def _verify_checksum(header):
+  """Verify the checksum of a tar header.
+
+  The checksum is the sum of all bytes in the header when the checksum field
+  is filled with spaces. Some old tar implementations sum signed bytes.
+
+  Raises:
+    FormatError: Raised when the checksum mismatched.
+  """
+  checksum = _parse_number(header[148:156])
+  if checksum == 256 + sum(struct.unpack_from('148B8x356B', header)):
+    return
+  if checksum == 256 + sum(struct.unpack_from('148b8x356b', header)):
+    return
+  raise FormatError('Bad checksum of tar header.')
 
 
-def _block_to_bytes(block_num):
-  """Get offset of the block |block_num| in bytes, i.e. times 512"""
-  return block_num << 9  # * 512
+def _parse_pax_records(data):
+  """Parse the records in a PAX extended header.
+
+  Each record is in format of '<length> <key>=<value>\\n', and <length> is the
+  length of the whole record in decimal.
+
+  Examples:
+    >>> _parse_pax_records(b'12 path=foo\\n18 path=a\\nb=c:d\\te\\n')
+    {'path': 'a\\nb=c:d\\te'}
+
+  Returns:
+    A dict of {key: value}.
+
+  Raises:
+    FormatError: Raised when the records are malformed.
+  """
+  records = {}
+  pos = 0
+  while pos < len(data) and data[pos:pos + 1] != b'\x00':
+    try:
+      length_str, _ = data[pos:pos + 20].split(b' ', 1)
+      length = int(length_str)
+      key, value = data[pos + len(length_str) + 1:pos + length - 1].split(
+          b'=', 1)
+    except ValueError:
+      raise FormatError('Bad PAX extended header record at %d.' % pos)
+    if length <= 0:
+      raise FormatError('Bad PAX extended header record at %d.' % pos)
+    records[key] = value
+    pos += length
+  return records
 
 
 # The tuple of tar member information to be returned to caller.
@@ -81,82 +168,231 @@ TarMemberInfo = collections.namedtuple(
                       'content_start', 'size'))
 
 
-class _TarListCommandResult(collections.namedtuple(
-    '_TarListCommandResult', ('block', 'block_num', 'mode', 'ownership',
-                              'size_str', 'date', 'hour', 'min', 'filename'))):
-  """Information of each member in a Tar archive.
-
-  This class using the output of command `tar tvR` to compute more information
-  we need, e.g. file content start offset, etc.
-
-  The output of `tar tvR` is like:
-  block 0: -rw-r--r-- user/group <size> <date> <time> <file name>
-  ...
-  block 7: ** Block of NULs **
-  """
-
-  @property
-  def record_start(self):
-    """Start offset of the file record, in bytes."""
-    return _block_to_bytes(int(self.block_num))
-
-  @property
-  def size(self):
-    return int(self.size_str)
-
-
-def _get_prev_content_start(cur_record_start, prev_file):
-  """Deduct prev file content information from current file record information.
+class _TarMemberParser(object):
+  """An incremental parser of tar headers.
 
-  In tar format, each file record has a header and followed by file content.
-  Both header and file content are rounded up to 512 Bytes. The header length is
-  variable, but we can get the current file content starting offset by
-  subtracting up rounded file size from next file header starting offset, i.e.
+  Chunks of a tar archive are fed to the parser in order, and it returns the
+  information of members as soon as their headers are parsed. Only the headers
+  are buffered; file content is skipped by offset without being copied.
 
-  current_offset = block(next_file) * 512 - round_up_to_512(current_size)
+  A file record consists of all headers of a member (e.g. GNU longname and PAX
+  extended headers) and the file content, padded to 512 bytes:
 
-  |********|************************.......|********|****
-  | header |         content               | header |
-  |        |<----- prev_size ----->|
-  |        |<- prev_size round up to 512 ->|
-           ^prev_content_start             ^cur_record_start
+  |********|********|*************************.....|********|****
+  |  PAX   | header |         content               | header |
+  ^record_start     ^content_start                  ^next record_start
+  |<---------------- record_size ----------------->|
 
-  Args:
-    cur_record_start: The zero-based start position of current file record, in
-        bytes.
-    prev_file: An instance of _TarListCommandResult which has size of the
-        previous file.
+  The file name of directories ends with '/'. Same as the output of `tar tv`,
+  the file name of symbolic links is like '<name> -> <link name>', and the file
+  name of hard links is like '<name> link to <link name>'.
 
-  Returns:
-    The zero-based start position of previous file content, in bytes.
+  For sparse files, the content is the data stored in the archive, i.e. the
+  data without holes.
   """
-  return cur_record_start - _round_up_to_512(prev_file.size)
-
 
-def list_tar_members(tar_tvR_output):
+  def __init__(self):
+    self._offset = 0  # The offset of the next byte to be fed.
+    self._buffer = bytearray()
+    self._buffer_start = 0  # The offset of the first byte in |_buffer|.
+    self._wanted = _BLOCK_SIZE  # Bytes to buffer before calling |_handler|.
+    self._handler = self._on_header
+    self._skip = 0  # Bytes to skip before buffering again.
+    self._end_of_archive = False
+    self._members = []
+
+    # States of the member being parsed.
+    self._record_start = None
+    self._extended = {}
+    self._global_extended = {}
+    self._sparse_member = None
+    self._sparse_map = bytearray()
+
+  def feed(self, data):
+    """Feed the next chunk of the archive.
+
+    Args:
+      data: A chunk of the archive.
+
+    Returns:
+      A list of TarMemberInfo of which header is in the fed data.
+
+    Raises:
+      FormatError: Raised when the archive isn't in a valid tar format.
+    """
+    view = memoryview(data)
+    pos = 0
+    end = len(view)
+    while pos < end and not self._end_of_archive:
+      if self._skip:
+        skipped = min(self._skip, end - pos)
+        self._skip -= skipped
+        pos += skipped
+        self._offset += skipped
+        continue
+
+      if not self._buffer:
+        self._buffer_start = self._offset
+      size = min(self._wanted - len(self._buffer), end - pos)
+      self._buffer += view[pos:pos + size]
+      pos += size
+      self._offset += size
+
+      if len(self._buffer) == self._wanted:
+        buffered = bytes(self._buffer)
+        del self._buffer[:]
+        handler = self._handler
+        self._wanted, self._handler = _BLOCK_SIZE, self._on_header
+        handler(buffered)
+
+    members, self._members = self._members, []
+    return members
+
+  def close(self):
+    """Finish the parsing.
+
+    Raises:
+      FormatError: Raised when the archive is truncated.
+    """
+    if (self._buffer or self._skip or self._record_start is not None or
+        self._handler != self._on_header):
+      raise FormatError('Unexpected EOF of the tar archive at offset %d.' %
+                        self._offset)
+
+  def _buffer_data(self, size, handler):
+    """Buffer |size| bytes of data and call |handler| with them."""
+    if size:
+      self._wanted, self._handler = size, handler
+    else:
+      handler(b'')
+
+  def _add_member(self, name, content_start, size):
+    """Add a member which content starts at |content_start|."""
+    padded_size = _round_up_to_512(size)
+    self._members.append(TarMemberInfo(
+        name, self._record_start,
+        content_start + padded_size - self._record_start, content_start, size))
+    self._record_start = None
+    self._skip = padded_size
+
+  def _on_header(self, header):
+    """Handle a tar header."""
+    if not header.strip(b'\x00'):
+      # A block of NULs marks the end of the archive.
+      _logger.debug('End of tar archive at offset %d.', self._buffer_start)
+      self._end_of_archive = True
+      return
+
+    _verify_checksum(header)
+    if self._record_start is None:
+      self._record_start = self._buffer_start
+
+    type_flag = header[156:157]
+    size = _parse_number(header[124:136])
+    if type_flag in _EXTENDED_HEADER_TYPES:
+      self._buffer_data(size, lambda data: self._on_extended_data(type_flag,
+                                                                  data))
+      return
+
+    name = _null_terminated(header[0:100])
+    if header[257:263] == _POSIX_MAGIC:
+      prefix = _null_terminated(header[345:500])
+      if prefix:
+        name = b'%s/%s' % (prefix, name)
+    link_name = _null_terminated(header[157:257])
+
+    extended = dict(self._global_extended)
+    extended.update(self._extended)
+    self._extended = {}
+    name = extended.get(b'GNU.sparse.name', extended.get(b'path', name))
+    link_name = extended.get(b'linkpath', link_name)
+    if b'size' in extended:
+      size = int(extended[b'size'])
+
+    if type_flag == _DIRECTORY and not name.endswith(b'/'):
+      name += b'/'
+    elif type_flag == _SYMBOLIC_LINK:
+      name = b'%s -> %s' % (name, link_name)
+    elif type_flag == _HARD_LINK:
+      name = b'%s link to %s' % (name, link_name)
+
+    if (type_flag == _GNU_SPARSE and
+        ord(header[_GNU_SPARSE_IS_EXTENDED_OFFSET:
+                   _GNU_SPARSE_IS_EXTENDED_OFFSET + 1])):
+      # The sparse map continues in extension blocks following the header.
+      self._sparse_member = (name, size)
+      self._handler = self._on_gnu_sparse_extension
+    elif extended.get(b'GNU.sparse.major') == b'1':
+      # The sparse map of PAX format 1.0 is at the beginning of the content.
+      self._sparse_member = (name, size)
+      self._handler = self._on_pax_sparse_map
+    else:
+      self._add_member(name, self._offset, size)
+
+  def _on_extended_data(self, type_flag, data):
+    """Handle the data of a GNU longname/longlink or PAX extended header."""
+    if type_flag == _GNU_LONGNAME:
+      self._extended[b'path'] = _null_terminated(data)
+    elif type_flag == _GNU_LONGLINK:
+      self._extended[b'linkpath'] = _null_terminated(data)
+    elif type_flag == _PAX_HEADER:
+      self._extended.update(_parse_pax_records(data))
+    else:
+      self._global_extended.update(_parse_pax_records(data))
+    self._skip = _round_up_to_512(len(data)) - len(data)
+
+  def _on_gnu_sparse_extension(self, block):
+    """Handle an extension block of the sparse map of GNU format."""
+    if ord(block[_GNU_SPARSE_EXT_IS_EXTENDED_OFFSET:
+                 _GNU_SPARSE_EXT_IS_EXTENDED_OFFSET + 1]):
+      self._handler = self._on_gnu_sparse_extension
+    else:
+      name, size = self._sparse_member
+      self._sparse_member = None
+      self._add_member(name, self._offset, size)
+
+  def _on_pax_sparse_map(self, block):
+    """Handle a block of the sparse map of PAX format 1.0.
+
+    The map is a series of decimal numbers, each followed by a '\\n'. The first
+    number is the count of sparse regions, followed by the offset and size of
+    each region. The map is padded to 512 bytes.
+    """
+    self._sparse_map += block
+    numbers = bytes(self._sparse_map).split(b'\n')[:-1]
+    try:
+      complete = numbers and len(numbers) >= 1 + 2 * int(numbers[0])
+    except ValueError:
+      raise FormatError('Bad sparse map of PAX format 1.0.')
+
+    if not complete:
+      self._handler = self._on_pax_sparse_map
+      return
+
+    name, size = self._sparse_member
+    map_size = len(self._sparse_map)
+    self._sparse_member = None
+    self._sparse_map = bytearray()
+    self._add_member(name, self._offset, size - map_size)
+
+
+def list_tar_members(tar_chunks):
   """List the members of a tar with information.
 
   Yield each member of the tar archive with information of record start/size,
   content start/size, etc.
 
   Args:
-    tar_tvR_output: The output of command 'tar tvR'. Option 'R' print out the
-        starting block number of the file record.
+    tar_chunks: An iterable of chunks of the tar archive, in order.
 
   Yields:
-    A tuple of data described above in the same order.
-  """
-  prev_file = _get_command_result_from_tar_tvR(tar_tvR_output.readline())
-
-  for line in tar_tvR_output:
-    cur_file = _get_command_result_from_tar_tvR(line)
-
-    prev_content_start = _get_prev_content_start(cur_file.record_start,
-                                                 prev_file)
-    prev_record_size = cur_file.record_start - prev_file.record_start
+    An instance of TarMemberInfo for each member.
 
-    yield TarMemberInfo(prev_file.filename,
-                        prev_file.record_start, prev_record_size,
-                        prev_content_start, prev_file.size)
-
-    prev_file = cur_file
+  Raises:
+    FormatError: Raised when the archive isn't in a valid tar format.
+  """
+  parser = _TarMemberParser()
+  for chunk in tar_chunks:
+    for info in parser.feed(chunk):
+      yield info
+  parser.close()
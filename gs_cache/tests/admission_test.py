@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for admission."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import mock
+
+import admission
+
+
+class TokenBucketTest(unittest.TestCase):
+  """Tests of TokenBucket."""
+
+  @mock.patch.object(admission.time, 'sleep')
+  @mock.patch.object(admission.time, 'time')
+  def test_consume(self, mock_time, mock_sleep):
+    """Test consumers wait for the debt to be paid back."""
+    mock_time.return_value = 100
+    bucket = admission.TokenBucket(10, burst=20)
+    bucket.consume(20)
+    self.assertFalse(mock_sleep.called)
+    bucket.consume(5)
+    mock_sleep.assert_called_once_with(0.5)
+
+    # Not waiting, but still in debt.
+    mock_sleep.reset_mock()
+    bucket.consume(5, wait=False)
+    self.assertFalse(mock_sleep.called)
+    mock_time.return_value = 101
+    bucket.consume(5)
+    mock_sleep.assert_called_once_with(0.5)
+
+    # The bucket is refilled up to the burst.
+    mock_sleep.reset_mock()
+    mock_time.return_value = 200
+    bucket.consume(20)
+    self.assertFalse(mock_sleep.called)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+  """Tests of AdmissionController."""
+
+  def _admit_later(self, controller, rpc, priority, admitted):
+    """Admit a request in a thread, which appends to |admitted| once done."""
+    def admit():
+      ticket = controller.admit(rpc, priority)
+      admitted.append(priority)
+      ticket.release()
+    thread = threading.Thread(target=admit)
+    thread.start()
+    return thread
+
+  def _wait_queued(self, controller, depth):
+    for _ in range(1000):
+      if controller.status()['queue_depth'] == depth:
+        return
+      time.sleep(0.01)
+    self.fail('Queue depth is never %d' % depth)
+
+  def test_priority(self):
+    """Test interactive requests are admitted before bulk ones."""
+    controller = admission.AdmissionController({'download': 1})
+    ticket = controller.admit('download')
+    admitted = []
+    threads = [self._admit_later(controller, 'download', admission.BULK,
+                                 admitted)]
+    self._wait_queued(controller, 1)
+    threads.append(self._admit_later(controller, 'download',
+                                     admission.INTERACTIVE, admitted))
+    self._wait_queued(controller, 2)
+    self.assertEqual(controller.status()['waiting'],
+                     {'download': {'bulk': 1, 'interactive': 1}})
+
+    # Other RPCs are not blocked.
+    controller.admit('extract').release()
+
+    ticket.release()
+    for thread in threads:
+      thread.join(10)
+    self.assertEqual(admitted, [admission.INTERACTIVE, admission.BULK])
+    status = controller.status()
+    self.assertEqual(status['queue_depth'], 0)
+    self.assertEqual(status['max_queue_depth'], 2)
+    self.assertEqual(status['running'], {})
+    self.assertEqual(status['admitted'], {'download': 3, 'extract': 1})
+
+  def test_timeout(self):
+    """Test a request waiting too long is rejected."""
+    controller = admission.AdmissionController({'decompress': 1}, timeout=0)
+    ticket = controller.admit('decompress')
+    with self.assertRaises(admission.AdmissionTimeoutError):
+      controller.admit('decompress')
+    self.assertEqual(controller.status()['rejected'], {'decompress': 1})
+    ticket.release()
+    controller.admit('decompress').release()
+
+  def test_stream(self):
+    """Test the ticket is released once the content is streamed or closed."""
+    controller = admission.AdmissionController({'download': 1}, timeout=0)
+    with controller.admit('download') as ticket:
+      content = ticket.stream(iter(['foo', 'bar']))
+    self.assertEqual(controller.status()['running'], {'download': 1})
+    self.assertEqual(''.join(content), 'foobar')
+    self.assertEqual(controller.status()['running'], {})
+
+    with controller.admit('download') as ticket:
+      content = ticket.stream(iter(['foo', 'bar']))
+    content.close()
+    self.assertEqual(controller.status()['running'], {})
+
+    # Strings are sent at once.
+    with controller.admit('download') as ticket:
+      self.assertEqual(ticket.stream('foo'), 'foo')
+    self.assertEqual(controller.status()['running'], {})
+
+  def test_release_on_error(self):
+    """Test the ticket is released if the request fails before streaming."""
+    controller = admission.AdmissionController({'download': 1})
+    with self.assertRaises(IOError):
+      with controller.admit('download'):
+        raise IOError('Not found')
+    self.assertEqual(controller.status()['running'], {})
+
+  def test_throttle(self):
+    """Test only bulk responses wait for the egress bandwidth."""
+    controller = admission.AdmissionController(egress_rate=10)
+    with mock.patch.object(controller, '_bucket') as bucket:
+      with controller.admit('download', admission.INTERACTIVE) as ticket:
+        list(ticket.stream(['foo']))
+      bucket.consume.assert_called_once_with(3, wait=False)
+      bucket.reset_mock()
+      with controller.admit('download', admission.BULK) as ticket:
+        list(ticket.stream(['foo']))
+      bucket.consume.assert_called_once_with(3, wait=True)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for closing_content."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import mock
+
+import closing_content
+
+
+class ClosingContentTest(unittest.TestCase):
+  """Tests of ClosingContent."""
+
+  def test_exhausted(self):
+    """Test the callback once the content is exhausted."""
+    on_close = mock.MagicMock()
+    on_chunk = mock.MagicMock()
+    content = closing_content.ClosingContent(iter(['foo', 'bar']), on_close,
+                                             on_chunk=on_chunk)
+    self.assertEqual(list(content), ['foo', 'bar'])
+    self.assertEqual(on_chunk.call_args_list,
+                     [mock.call('foo'), mock.call('bar')])
+    on_close.assert_called_once_with()
+    content.close()
+    on_close.assert_called_once_with()
+
+  def test_closed_before_started(self):
+    """Test the content is closed and called back if not iterated."""
+    upstream = mock.MagicMock()
+    on_close = mock.MagicMock()
+    closing_content.ClosingContent(upstream, on_close).close()
+    upstream.close.assert_called_once_with()
+    on_close.assert_called_once_with()
+
+  def test_error(self):
+    """Test the callback when the content fails."""
+    def chunks():
+      yield 'foo'
+      raise IOError('Connection reset')
+
+    on_close = mock.MagicMock()
+    content = closing_content.ClosingContent(chunks(), on_close)
+    self.assertEqual(next(content), 'foo')
+    with self.assertRaises(IOError):
+      next(content)
+    on_close.assert_called_once_with()
+
+
+if __name__ == '__main__':
+  unittest.main()
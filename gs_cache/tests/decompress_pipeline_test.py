@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for decompress_pipeline."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bz2
+import gzip
+import os
+import StringIO
+import subprocess
+import threading
+import unittest
+
+import mock
+
+import decompress_pipeline
+
+_CONTENT = ''.join(str(i) for i in xrange(100000))
+
+
+def _compress(ext_name, data):
+  """Compress |data| in the format of |ext_name|."""
+  if ext_name == '.bz2':
+    return bz2.compress(data)
+  if ext_name == '.xz':
+    proc = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    return proc.communicate(data)[0]
+  compressed = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=compressed, mode='w') as f:
+    f.write(data)
+  return compressed.getvalue()
+
+
+def _in_chunks(data, size=1000):
+  """Split |data| into chunks of |size|."""
+  return (data[i:i + size] for i in xrange(0, len(data), size))
+
+
+class DecompressPipelineTest(unittest.TestCase):
+  """Tests of DecompressPipeline."""
+
+  def test_decompress(self):
+    """Test decompressing all supported formats."""
+    for ext_name in ('.gz', '.tgz', '.bz2', '.xz'):
+      pipeline = decompress_pipeline.DecompressPipeline(
+          ext_name, _in_chunks(_compress(ext_name, _CONTENT)), buffer_chunks=2)
+      self.assertEqual(''.join(pipeline), _CONTENT)
+      self.assertEqual(pipeline.returncode, 0)
+
+  def test_decompress_multi_stream(self):
+    """Test decompressing a file of multiple streams."""
+    compressed = ''.join(bz2.compress(_CONTENT[i:i + 9000])
+                         for i in xrange(0, len(_CONTENT), 9000))
+    pipeline = decompress_pipeline.DecompressPipeline('.bz2',
+                                                      _in_chunks(compressed))
+    self.assertEqual(''.join(pipeline), _CONTENT)
+
+  def test_download_error(self):
+    """Test the error of downloading is raised to the caller."""
+    def chunks():
+      yield _compress('.gz', _CONTENT)[:1000]
+      raise IOError('Connection reset')
+
+    pipeline = decompress_pipeline.DecompressPipeline('.gz', chunks())
+    with self.assertRaises(IOError):
+      list(pipeline)
+
+  def test_close(self):
+    """Test closing the pipeline before the end stops the decompressor."""
+    pipeline = decompress_pipeline.DecompressPipeline(
+        '.gz', _in_chunks(_compress('.gz', os.urandom(1000000))))
+    content = iter(pipeline)
+    next(content)
+    content.close()
+    self.assertIsNotNone(pipeline.returncode)
+
+  def test_close_chunks(self):
+    """Test the compressed chunks are closed when the pipeline stops."""
+    closed = threading.Event()
+
+    def chunks():
+      try:
+        while True:
+          yield os.urandom(1000)
+      finally:
+        closed.set()
+
+    pipeline = decompress_pipeline.DecompressPipeline('.gz', chunks())
+    pipeline.close()
+    self.assertTrue(closed.wait(10))
+
+  def test_decompress_command(self):
+    """Test parallel decompressors are preferred if installed."""
+    with mock.patch.object(decompress_pipeline, '_commands', {}), \
+        mock.patch('distutils.spawn.find_executable') as find_executable:
+      find_executable.side_effect = lambda cmd: cmd in ('pbzip2', 'bzip2')
+      self.assertEqual(decompress_pipeline.decompress_command('.bz2'),
+                       ['pbzip2', '-d', '-c'])
+      find_executable.side_effect = lambda cmd: False
+      self.assertEqual(decompress_pipeline.decompress_command('.tgz'),
+                       ['gzip', '-d', '-c'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for disk_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import disk_cache
+
+
+class DiskCacheTest(unittest.TestCase):
+  """Tests of DiskCache."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.cache = disk_cache.DiskCache(os.path.join(self.tempdir, 'cache'),
+                                      max_bytes=100)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _cache(self, path, generation, content):
+    chunks = [content[i:i + 10] for i in xrange(0, len(content), 10)]
+    self.assertEqual(list(self.cache.cache(path, generation, chunks)), chunks)
+
+  def test_cache(self):
+    """Test caching an object by path and generation."""
+    self.assertIsNone(self.cache.open('gs://foo', 1))
+    self._cache('gs://foo', 1, 'x' * 50)
+    with self.cache.open('gs://foo', 1) as f:
+      self.assertEqual(f.read(), 'x' * 50)
+    self.assertIsNone(self.cache.open('gs://foo', 2))
+    self.assertIsNone(self.cache.open('gs://bar', 1))
+
+  def test_incomplete(self):
+    """Test an object isn't cached if the iteration isn't completed."""
+    content = self.cache.cache('gs://foo', 1, iter(['x' * 10] * 5))
+    next(content)
+    content.close()
+    self.assertIsNone(self.cache.open('gs://foo', 1))
+    self.assertEqual(os.listdir(os.path.join(self.tempdir, 'cache')), [])
+
+  def test_evict(self):
+    """Test the least recently used objects are evicted."""
+    self._cache('gs://foo', 1, 'x' * 40)
+    self._cache('gs://bar', 1, 'x' * 40)
+    # Make foo recently used.
+    for path, generation in (('gs://bar', 1), ('gs://foo', 1)):
+      self.cache.open(path, generation).close()
+      time.sleep(0.01)
+    self._cache('gs://baz', 1, 'x' * 40)
+
+    self.assertIsNone(self.cache.open('gs://bar', 1))
+    self.assertIsNotNone(self.cache.open('gs://foo', 1))
+    self.assertIsNotNone(self.cache.open('gs://baz', 1))
+
+  def test_commit_error(self):
+    """Test an error of saving the object doesn't fail the iteration."""
+    with mock.patch.object(os, 'rename', side_effect=OSError('rename')):
+      self._cache('gs://foo', 1, 'x' * 50)
+    self.assertIsNone(self.cache.open('gs://foo', 1))
+    # The temporary file is removed.
+    self.assertEqual(
+        [f for f in os.listdir(os.path.join(self.tempdir, 'cache'))
+         if os.path.isfile(os.path.join(self.tempdir, 'cache', f))], [])
+
+  def test_evict_error(self):
+    """Test an error of evicting doesn't fail the iteration."""
+    with mock.patch.object(self.cache, 'evict', side_effect=IOError('lock')):
+      self._cache('gs://foo', 1, 'x' * 50)
+    with self.cache.open('gs://foo', 1) as f:
+      self.assertEqual(f.read(), 'x' * 50)
+
+  def test_throttle_evict(self):
+    """Test eviction waits for enough bytes cached or the interval."""
+    start = time.time()
+    with mock.patch.object(self.cache, 'evict') as evict, \
+        mock.patch.object(time, 'time', return_value=start) as now:
+      # A tenth of the max size is cached by the second object.
+      self._cache('gs://foo', 1, 'x' * 5)
+      self.assertFalse(evict.called)
+      self._cache('gs://bar', 1, 'x' * 5)
+      self.assertEqual(evict.call_count, 1)
+
+      self._cache('gs://baz', 1, 'x' * 5)
+      self.assertEqual(evict.call_count, 1)
+      # pylint: disable=protected-access
+      now.return_value = start + disk_cache._EVICT_INTERVAL_SECONDS
+      self._cache('gs://qux', 1, 'x' * 5)
+      self.assertEqual(evict.call_count, 2)
+
+  def test_evict_stale_temp_files(self):
+    """Test temporary files left by dead processes are removed."""
+    stale = os.path.join(self.tempdir, 'cache', '.tmpstale')
+    open(stale, 'w').close()
+    os.utime(stale, (0, 0))
+    self.cache.evict()
+    self.assertFalse(os.path.exists(stale))
+
+
+if __name__ == '__main__':
+  unittest.main()
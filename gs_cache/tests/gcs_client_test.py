@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for gcs_client."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import BaseHTTPServer
+import json
+import re
+import SocketServer
+import threading
+import unittest
+import urllib
+import urlparse
+
+import gcs_client
+from chromite.lib import gs
+
+_OBJECT_PATH_RE = re.compile(r'^/storage/v1/b/([^/]+)/o/([^/]+)$')
+
+
+class _FakeGcsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A handler of a fake GCS JSON API, serving objects of the server."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    url = urlparse.urlsplit(self.path)
+    params = dict(urlparse.parse_qsl(url.query))
+    self.server.requests.append((url.path, params, self.headers.get('Range'),
+                                 self.headers.get('Authorization')))
+    if url.path == '/token':
+      self._respond(200, json.dumps({'access_token': 'TOKEN',
+                                     'expires_in': 3600}))
+      return
+
+    if self.server.block and 'generation' in params:
+      # Block the slices until the test unblocks them.
+      self.server.slice_requested.set()
+      self.server.block.wait()
+
+    match = _OBJECT_PATH_RE.match(url.path)
+    key = match and '%s/%s' % (match.group(1), urllib.unquote(match.group(2)))
+    if self.server.error:
+      self._respond(self.server.error, 'error')
+      return
+    if key not in self.server.objects:
+      self._respond(404, 'not found')
+      return
+
+    generation, content = self.server.objects[key]
+    if params.get('alt') != 'media':
+      self._respond(200, json.dumps({
+          'size': str(len(content)),
+          'contentType': 'application/octet-stream',
+          'generation': str(generation),
+      }))
+      return
+
+    if params.get('generation', str(generation)) != str(generation):
+      self._respond(404, 'no such generation')
+      return
+    headers = {'x-goog-generation': str(generation)}
+    byte_range = self.headers.get('Range')
+    if not byte_range:
+      self._respond(200, content, headers)
+      return
+    first, last = [int(x) for x in byte_range.split('=')[1].split('-')]
+    last = min(last, len(content) - 1)
+    headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(content))
+    self._respond(206, content[first:last + 1], headers)
+
+  def _respond(self, status, body, headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+class _FakeGcsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class GcsClientTest(unittest.TestCase):
+  """Tests of GcsClient against a fake GCS server."""
+
+  def setUp(self):
+    self.server = _FakeGcsServer(('127.0.0.1', 0), _FakeGcsHandler)
+    self.server.objects = {}
+    self.server.requests = []
+    self.server.error = None
+    self.server.block = None
+    self.server.slice_requested = threading.Event()
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.endpoint = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self.client = gcs_client.GcsClient(self.endpoint, slice_size=10,
+                                       download_workers=2)
+
+  def test_stat(self):
+    """Test getting the metadata of an object."""
+    self.server.objects['bucket/path/to/file'] = (123, 'x' * 5)
+    self.assertEqual(self.client.stat('gs://bucket/path/to/file'),
+                     gcs_client.StatResult(content_length=5,
+                                           content_type='application/'
+                                           'octet-stream',
+                                           generation=123))
+
+  def test_no_such_object(self):
+    """Test the error of an object which doesn't exist."""
+    with self.assertRaises(gs.GSNoSuchKey):
+      self.client.stat('gs://bucket/file')
+    with self.assertRaises(gs.GSNoSuchKey):
+      self.client.cat('gs://bucket/file')
+
+  def test_server_error(self):
+    """Test the error of a server error."""
+    self.server.error = 503
+    with self.assertRaises(gcs_client.Error):
+      self.client.stat('gs://bucket/file')
+    with self.assertRaises(gcs_client.Error):
+      self.client.cat('gs://bucket/file')
+
+  def test_cat(self):
+    """Test downloading an object in slices."""
+    content = ''.join(chr(i) for i in xrange(95))
+    self.server.objects['bucket/file'] = (123, content)
+    self.assertEqual(''.join(self.client.cat('gs://bucket/file')), content)
+    ranges = sorted(r[2] for r in self.server.requests)
+    self.assertEqual(ranges, ['bytes=%d-%d' % (i, min(i + 9, 94))
+                              for i in xrange(0, 95, 10)])
+    # All slices are of the generation of the first one.
+    self.assertEqual([r[1].get('generation') for r in self.server.requests],
+                     [None] + ['123'] * 9)
+
+  def test_cat_range(self):
+    """Test downloading a range of an object."""
+    content = ''.join(chr(i) for i in xrange(95))
+    self.server.objects['bucket/file'] = (123, content)
+    self.assertEqual(
+        ''.join(self.client.cat('gs://bucket/file', generation=123, start=5,
+                                stop=28)),
+        content[5:28])
+    self.assertEqual(
+        ''.join(self.client.cat('gs://bucket/file', start=90, stop=200)),
+        content[90:])
+    self.assertEqual(
+        ''.join(self.client.cat('gs://bucket/file', start=5, stop=5)), '')
+
+  def test_read_ahead_budget(self):
+    """Test slices read ahead by all downloads are bounded by the budget."""
+    content = ''.join(chr(i) for i in xrange(95))
+    self.server.objects['bucket/file'] = (123, content)
+    client = gcs_client.GcsClient(self.endpoint, slice_size=10,
+                                  read_ahead_slices=4, read_ahead_bytes=15)
+    # pylint: disable=protected-access
+    budget = client._read_ahead_budget
+
+    first = client.cat('gs://bucket/file')
+    self.assertEqual(next(first), content[:10])
+    # A free slice, and one more slice within the budget.
+    self.assertEqual(budget._available, 5)
+    second = client.cat('gs://bucket/file')
+    self.assertEqual(next(second), content[:10])
+    # The budget is used up, so only the free slice is in flight.
+    self.assertEqual(budget._available, 5)
+
+    self.assertEqual(''.join(second), content[10:])
+    first.close()
+    client._download_pool.close()
+    client._download_pool.join()
+    self.assertEqual(budget._available, 15)
+
+  def test_abort_read_ahead(self):
+    """Test the budget of an aborted download is released when it's done."""
+    content = ''.join(chr(i) for i in xrange(95))
+    self.server.objects['bucket/file'] = (123, content)
+    self.server.block = threading.Event()
+    client = gcs_client.GcsClient(self.endpoint, slice_size=10,
+                                  download_workers=1, read_ahead_slices=3,
+                                  read_ahead_bytes=100)
+    # pylint: disable=protected-access
+    budget = client._read_ahead_budget
+
+    download = client.cat('gs://bucket/file')
+    self.assertEqual(next(download), content[:10])
+    # The free slice is downloading, and two slices are queued.
+    self.server.slice_requested.wait()
+    self.assertEqual(budget._available, 80)
+    download.close()
+    # The budget is still held by the slices until they are done.
+    self.assertEqual(budget._available, 80)
+
+    self.server.block.set()
+    client._download_pool.close()
+    client._download_pool.join()
+    self.assertEqual(budget._available, 100)
+    # The queued slices aren't downloaded after the download is aborted.
+    self.assertEqual(
+        len([r for r in self.server.requests if 'generation' in r[1]]), 1)
+
+  def test_credentials(self):
+    """Test requests are authorized by the token of the metadata server."""
+    self.server.objects['bucket/file'] = (123, 'abc')
+    client = gcs_client.GcsClient(
+        self.endpoint, credentials=gcs_client.MetadataServerCredentials(
+            self.endpoint + '/token'))
+    client.stat('gs://bucket/file')
+    client.stat('gs://bucket/file')
+    self.assertEqual([r[3] for r in self.server.requests],
+                     [None, 'Bearer TOKEN', 'Bearer TOKEN'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests of serving under gevent.
+
+gevent_server monkey patches the standard library, which would affect all
+other tests, so the code under test runs in a child process.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import unittest
+
+_GS_CACHE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Decompress by the pipeline and by the decompress RPC. The first compressed
+# chunk is delayed, so the decompressed content is read before it's ready.
+_SCRIPT = r'''
+from gevent import monkey
+monkey.patch_all()
+
+import gzip
+import StringIO
+
+import cherrypy
+import gevent
+import mock
+
+import decompress_pipeline
+import gs_archive_server
+
+content = ''.join(str(i) for i in xrange(100000))
+compressed = StringIO.StringIO()
+with gzip.GzipFile(fileobj=compressed, mode='w') as f:
+  f.write(content)
+compressed = compressed.getvalue()
+
+def chunks(*_):
+  gevent.sleep(0.1)
+  for i in xrange(0, len(compressed), 1000):
+    yield compressed[i:i + 1000]
+
+pipeline = decompress_pipeline.DecompressPipeline('.gz', chunks())
+assert ''.join(pipeline) == content, 'Wrong content of the pipeline.'
+assert pipeline.returncode == 0, 'Bad exit code %s' % pipeline.returncode
+
+server = gs_archive_server.GsArchiveServer('', stream_decompression=True)
+with mock.patch.object(server, '_caching_server') as caching_server, \
+    mock.patch.object(cherrypy.request, 'headers', {}):
+  caching_server.download.return_value.iter_content.side_effect = chunks
+  rsp = server.decompress('baz.tar.gz')
+  assert ''.join(rsp) == content, 'Wrong content of the decompress RPC.'
+'''
+
+
+class GeventServerTest(unittest.TestCase):
+  """Tests of the code paths served by gevent."""
+
+  def test_decompress(self):
+    """Test decompressing while the standard library is monkey patched."""
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([_GS_CACHE_DIR] + sys.path))
+    proc = subprocess.Popen([sys.executable, '-c', _SCRIPT], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    self.assertEqual(proc.returncode, 0, output)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -15,7 +15,12 @@ import httplib
 import json
 import md5
 import os
+import shutil
+import sqlite3
 import StringIO
+import tempfile
+import threading
+import time
 import unittest
 import urllib
 
@@ -25,7 +30,14 @@ import pytest
 import requests
 from cherrypy.test import helper
 
+import admission
+import disk_cache
+import gcs_client
 import gs_archive_server
+import member_index
+import seek_index
+import single_flight
+import stat_cache
 import tarfile_utils
 from chromite.lib import cros_logging as logging
 
@@ -139,12 +151,252 @@ class UnmockedGSArchiveServerTest(helper.CPWebCase):
     self.assertStatus(httplib.UNAUTHORIZED)
 
 
+class DiskCachedGSArchiveServerTest(helper.CPWebCase):
+  """Tests of serving GS objects from the disk cache."""
+
+  @staticmethod
+  def setup_server():
+    """An API used by cherrypy to setup test environment."""
+    tempdir = tempfile.mkdtemp()
+    cache = disk_cache.DiskCache(tempdir, 1024 * 1024)
+    server = gs_archive_server.GsArchiveServer('', object_cache=cache)
+    # pylint: disable=protected-access
+    server._gsutil = mock.MagicMock()
+    DiskCachedGSArchiveServerTest.tempdir = tempdir
+    DiskCachedGSArchiveServerTest.cache = cache
+    DiskCachedGSArchiveServerTest.gsutil = server._gsutil
+    cherrypy.tree.mount(server)
+
+  @classmethod
+  def teardown_class(cls):
+    super(DiskCachedGSArchiveServerTest, cls).teardown_class()
+    shutil.rmtree(cls.tempdir)
+
+  def test_download(self):
+    """Test downloading an object the second time is served by the cache."""
+    stat = self.gsutil.Stat.return_value
+    stat.content_type = 'application/octet-stream'
+    stat.content_length = 10
+    stat.generation = 123
+    self.gsutil.StreamingCat.return_value = iter(['01234', '56789'])
+
+    self.getPage('/download/bucket/file')
+    self.assertStatus(httplib.OK)
+    self.assertBody('0123456789')
+    # The object is saved after the response is sent.
+    deadline = time.time() + 10
+    while (not self.cache.open('gs://bucket/file', 123) and
+           time.time() < deadline):
+      time.sleep(0.01)
+
+    self.getPage('/download/bucket/file', headers=[('Range', 'bytes=2-4')])
+    self.assertStatus(httplib.PARTIAL_CONTENT)
+    self.assertBody('234')
+    self.assertHeader('Content-Type', 'application/octet-stream')
+    self.assertHeader('ETag', '"123"')
+    self.assertEqual(self.gsutil.StreamingCat.call_count, 1)
+
+    # A new generation isn't served by the cache.
+    stat.generation = 124
+    stat.content_length = 3
+    self.gsutil.StreamingCat.return_value = iter(['abc'])
+    self.getPage('/download/bucket/file')
+    self.assertBody('abc')
+
+
+class GcsGSArchiveServerTest(helper.CPWebCase):
+  """Tests of accessing GS by the GCS client."""
+
+  @staticmethod
+  def setup_server():
+    """An API used by cherrypy to setup test environment."""
+    gcs = mock.MagicMock()
+    server = gs_archive_server.GsArchiveServer('', gcs=gcs)
+    # pylint: disable=protected-access
+    server._gsutil = mock.MagicMock()
+    GcsGSArchiveServerTest.gcs = gcs
+    GcsGSArchiveServerTest.gsutil = server._gsutil
+    cherrypy.tree.mount(server)
+
+  def setUp(self):
+    self.gcs.reset_mock()
+    self.gsutil.reset_mock()
+    self.gcs.stat.side_effect = None
+    self.gcs.stat.return_value = gcs_client.StatResult(
+        content_length=10, content_type='application/octet-stream',
+        generation=123)
+    self.gcs.cat.side_effect = lambda path, **kwargs: iter(
+        ['0123456789'[kwargs.get('start', 0):kwargs['stop']]])
+
+  def test_download(self):
+    """Test downloading an object by the GCS client."""
+    self.getPage('/download/bucket/file')
+    self.assertStatus(httplib.OK)
+    self.assertBody('0123456789')
+    self.assertHeader('ETag', '"123"')
+    self.gcs.cat.assert_called_with('gs://bucket/file', generation=123,
+                                    stop=10)
+    self.assertFalse(self.gsutil.StreamingCat.called)
+
+  def test_download_range(self):
+    """Test downloading a range of an object by the GCS client."""
+    self.getPage('/download/bucket/file', headers=[('Range', 'bytes=2-4')])
+    self.assertStatus(httplib.PARTIAL_CONTENT)
+    self.assertBody('234')
+    self.assertHeader('Content-Range', 'bytes 2-4/10')
+
+    self.getPage('/download/bucket/file', headers=[('Range', 'bytes=20-')])
+    self.assertStatus(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+
+  def test_fallback_to_gsutil(self):
+    """Test gsutil is used if the GCS client fails."""
+    self.gcs.stat.side_effect = gcs_client.Error('error')
+    self.gsutil.Stat.return_value = self.gcs.stat.return_value
+    self.gsutil.StreamingCat.return_value = iter(['abcdefghij'])
+    self.getPage('/download/bucket/file')
+    self.assertStatus(httplib.OK)
+    self.assertBody('0123456789')
+    self.gsutil.Stat.assert_called_with('gs://bucket/file')
+
+    self.gcs.cat.side_effect = gcs_client.Error('error')
+    self.getPage('/download/bucket/file')
+    self.assertBody('abcdefghij')
+
+  def test_no_such_object(self):
+    """Test downloading an object which doesn't exist."""
+    self.gcs.stat.side_effect = gs_archive_server.gs.GSNoSuchKey('error')
+    self.getPage('/download/bucket/file')
+    self.assertStatus(httplib.NOT_FOUND)
+    self.assertFalse(self.gsutil.Stat.called)
+
+
+class StatCachedGSArchiveServerTest(helper.CPWebCase):
+  """Tests of serving with the metadata cache."""
+
+  @staticmethod
+  def setup_server():
+    """An API used by cherrypy to setup test environment."""
+    server = gs_archive_server.GsArchiveServer(
+        '', metadata_cache=stat_cache.StatCache())
+    # pylint: disable=protected-access
+    server._gsutil = mock.MagicMock()
+    StatCachedGSArchiveServerTest.gsutil = server._gsutil
+    cherrypy.tree.mount(server)
+
+  def test_download(self):
+    """Test repeated requests of an object stat it only once."""
+    self.gsutil.Stat.return_value = gcs_client.StatResult(
+        content_length=3, content_type='application/octet-stream',
+        generation=123)
+    self.gsutil.StreamingCat.side_effect = lambda _: iter(['abc'])
+    path = '/download/bucket/R80-12739.0.0/file'
+    self.getPage(path, method='HEAD')
+    self.assertStatus(httplib.OK)
+    self.assertHeader('Content-Length', '3')
+    self.getPage(path)
+    self.assertBody('abc')
+    self.assertEqual(self.gsutil.Stat.call_count, 1)
+
+    self.gsutil.Stat.side_effect = gs_archive_server.gs.GSNoSuchKey('error')
+    for _ in range(2):
+      self.getPage('/download/bucket/R80-12739.0.0/missing')
+      self.assertStatus(httplib.NOT_FOUND)
+    self.assertEqual(self.gsutil.Stat.call_count, 2)
+
+  def test_timing(self):
+    """Test the timing of phases is reported by the header and /stats."""
+    self.gsutil.Stat.side_effect = None
+    self.gsutil.Stat.return_value = gcs_client.StatResult(
+        content_length=3, content_type='application/octet-stream',
+        generation=123)
+    self.gsutil.StreamingCat.side_effect = lambda _: iter(['abc'])
+    self.getPage('/download/bucket/R80-12739.0.0/timed')
+    self.assertBody('abc')
+    self.assertIn('stat;dur=', dict(self.headers)['Server-Timing'])
+
+    self.getPage('/stats')
+    self.assertStatus(httplib.OK)
+    download = json.loads(self.body)['download']
+    self.assertGreaterEqual(download['statuses']['200'], 1)
+    for span in ('stat', 'gs_first_byte', 'stream', 'total'):
+      self.assertGreaterEqual(download['spans'][span]['count'], 1)
+
+
+class PrefetchGSArchiveServerTest(helper.CPWebCase):
+  """Tests of prefetching GS objects."""
+
+  @staticmethod
+  def setup_server():
+    """An API used by cherrypy to setup test environment."""
+    server = gs_archive_server.GsArchiveServer('', prefetch_workers=1)
+    PrefetchGSArchiveServerTest.server = server
+    cherrypy.tree.mount(server)
+
+  def setUp(self):
+    # A new mock for each test, since reset_mock() keeps side effects.
+    self.caching_server = mock.MagicMock()
+    # pylint: disable=protected-access
+    self.server._caching_server = self.caching_server
+
+  def _wait(self):
+    """Wait until all queued objects are prefetched."""
+    self.server._prefetcher._queue.join()  # pylint: disable=protected-access
+
+  def test_prefetch(self):
+    """Test prefetching a compressed tar downloads and lists its members."""
+    self.getPage('/prefetch/bucket/build/autotest_packages.tgz', method='POST')
+    self.assertStatus(httplib.ACCEPTED)
+    self.assertEqual(json.loads(self.body)[0]['state'], 'queued')
+    self._wait()
+    self.caching_server.download.assert_called_once_with(
+        'bucket/build/autotest_packages.tgz', headers={})
+    self.caching_server.list_member.assert_called_once_with(
+        'bucket/build/autotest_packages.tar',
+        headers={gs_archive_server._HTTP_HEADER_COMPRESSED_TAR_EXT: '.tgz'})
+
+    self.getPage('/prefetch_status/bucket/build/autotest_packages.tgz')
+    self.assertStatus(httplib.OK)
+    self.assertEqual(json.loads(self.body)['state'], 'done')
+    self.getPage('/prefetch_status/bucket/build/missing.tgz')
+    self.assertStatus(httplib.NOT_FOUND)
+
+  def test_prefetch_manifest(self):
+    """Test prefetching all objects in a manifest."""
+    manifest = '# build\nbucket/build/payload.bin\n\nbucket/build/a.tar\n'
+    self.getPage('/prefetch', method='POST', body=manifest,
+                 headers=[('Content-Type', 'text/plain'),
+                          ('Content-Length', str(len(manifest)))])
+    self.assertStatus(httplib.ACCEPTED)
+    self.assertEqual([s['path'] for s in json.loads(self.body)],
+                     ['bucket/build/payload.bin', 'bucket/build/a.tar'])
+    self._wait()
+    self.assertEqual(self.caching_server.download.call_count, 2)
+    self.caching_server.list_member.assert_called_once_with(
+        'bucket/build/a.tar', headers={})
+
+    self.getPage('/prefetch_status')
+    self.assertStatus(httplib.OK)
+    self.assertTrue({'bucket/build/payload.bin', 'bucket/build/a.tar'} <=
+                    {s['path'] for s in json.loads(self.body)})
+
+  def test_prefetch_failure(self):
+    """Test the error of prefetching is reported by the status."""
+    self.caching_server.download.side_effect = IOError('Connection reset')
+    self.getPage('/prefetch/bucket/build/broken.bin', method='POST')
+    self.assertStatus(httplib.ACCEPTED)
+    self._wait()
+    self.getPage('/prefetch_status/bucket/build/broken.bin')
+    status = json.loads(self.body)
+    self.assertEqual(status['state'], 'failed')
+    self.assertEqual(status['error'], 'Connection reset')
+
+
 class MockedGSArchiveServerTest(unittest.TestCase):
   """Unit test of GsArchiveServer using mock objects."""
 
   def setUp(self):
     """Setup method."""
-    self.server = gs_archive_server.GsArchiveServer('')
+    self.server = gs_archive_server.GsArchiveServer('', range_merge_gap=-1)
     self.list_member_mock = mock.MagicMock()
     self.list_member_mock.return_value.iter_lines.return_value = [
         'foo,,,0,3', 'bar,,,3,10', 'baz,,,13,5', 'foo%2Cbar,,,20,10']
@@ -191,6 +443,33 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       # Extract an non-exist file. Should return '{}'
       self.assertEqual('{}', self.server.extract('bar.tar', file='footar'))
 
+  def test_extract_server_timing(self):
+    """Test extracting a file keeps the response of the request thread."""
+    # pylint: disable=protected-access
+    response = cherrypy._cprequest.Response()
+    cherrypy.serving.load(cherrypy.serving.request, response)
+    self.addCleanup(cherrypy.serving.clear)
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member = self.list_member_mock
+      cache_server.download.return_value.status_code = httplib.PARTIAL_CONTENT
+      with mock.patch('range_response.JsonStreamer'):
+        self.server.extract('bar.tar', file='bar')
+    self.assertIs(cherrypy.serving.response, response)
+    self.assertIn('range_request', response.headers['Server-Timing'])
+
+  def test_extract_range_request_error(self):
+    """Test responses received are closed if a range request fails."""
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member = self.list_member_mock
+      received = mock.MagicMock(status_code=httplib.PARTIAL_CONTENT)
+      cache_server.download.side_effect = [received, IOError('reset')]
+      # pylint: disable=protected-access
+      with mock.patch.object(gs_archive_server, '_MAX_RANGES_PER_REQUEST', 1), \
+          mock.patch('range_response.JsonStreamer'), \
+          self.assertRaises(IOError):
+        self.server.extract('bar.tar', file=['bar', 'foo'])
+      received.close.assert_called_once_with()
+
   def test_extract_two_files_from_tar(self):
     """Test extracting two files from a TAR archive."""
     with mock.patch.object(self.server, '_caching_server') as cache_server:
@@ -199,14 +478,31 @@ class MockedGSArchiveServerTest(unittest.TestCase):
           'Content-Type': 'multipart/byteranges; boundary=xxx'}
       cache_server.download.return_value.status_code = httplib.PARTIAL_CONTENT
       # pylint: disable=protected-access
-      gs_archive_server._MAX_RANGES_PER_REQUEST = 100
-
-      with mock.patch('range_response.JsonStreamer'):
+      with mock.patch.object(gs_archive_server, '_MAX_RANGES_PER_REQUEST',
+                             100), mock.patch('range_response.JsonStreamer'):
         self.server.extract('bar.tar', file=['bar', 'foo'])
 
       cache_server.download.assert_called_with(
           'bar.tar', headers={'Range': 'bytes=0-2,3-12'})
 
+  def test_extract_adjacent_files_from_tar(self):
+    """Test extracting files next to each other by one range."""
+    self.server = gs_archive_server.GsArchiveServer('')
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member = self.list_member_mock
+      cache_server.download.return_value.headers = {
+          'Content-Range': 'bytes 0-17/*'}
+      cache_server.download.return_value.status_code = httplib.PARTIAL_CONTENT
+      cache_server.download.return_value.iter_content.return_value = iter(
+          ['FOO' + '_' * 10, 'BAZ__'])
+
+      rsp = self.server.extract('bar.tar', file=['foo', 'baz'])
+
+      cache_server.download.assert_called_once_with(
+          'bar.tar', headers={'Range': 'bytes=0-17'})
+      self.assertEqual(json.loads(''.join(rsp)),
+                       {'foo': 'FOO', 'baz': 'BAZ__'})
+
   def test_extract_many_files_from_tar(self):
     """Test extracting many files which result in a series of range requests."""
     with mock.patch.object(self.server, '_caching_server') as cache_server:
@@ -216,8 +512,8 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       cache_server.download.return_value.status_code = httplib.PARTIAL_CONTENT
 
       # pylint: disable=protected-access
-      gs_archive_server._MAX_RANGES_PER_REQUEST = 1
-      with mock.patch('range_response.JsonStreamer'):
+      with mock.patch.object(gs_archive_server, '_MAX_RANGES_PER_REQUEST', 1), \
+          mock.patch('range_response.JsonStreamer'):
         self.server.extract('bar.tar', file=['bar', 'foo'])
 
       cache_server.download.assert_any_call(
@@ -225,6 +521,112 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       cache_server.download.assert_any_call(
           'bar.tar', headers={'Range': 'bytes=3-12'})
 
+  def test_extract_as_tar(self):
+    """Test extracting files as a tar archive of their records."""
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member.return_value.iter_lines.return_value = [
+          'foo,0,1024,512,3', 'bar,1024,1024,1536,10']
+      cache_server.download.return_value.headers = {
+          'Content-Range': 'bytes 1024-2047/*'}
+      cache_server.download.return_value.status_code = httplib.PARTIAL_CONTENT
+      cache_server.download.return_value.iter_content.return_value = iter(
+          ['R' * 1024])
+
+      rsp = ''.join(self.server.extract('bar.tar', file='bar', output='tar'))
+
+      cache_server.download.assert_called_with(
+          'bar.tar', headers={'Range': 'bytes=1024-2047'})
+      self.assertEqual(rsp, 'R' * 1024 + '\0' * 1024)
+      self.assertEqual(cherrypy.response.headers['Content-Type'],
+                       'application/x-tar')
+
+  def test_extract_bad_output(self):
+    """Test extracting files in an unknown format."""
+    with self.assertRaises(cherrypy.HTTPError):
+      self.server.extract('bar.tar', file='bar', output='zip')
+
+  def test_extract_files_concurrently(self):
+    """Test range requests are sent concurrently and queued in order."""
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member = self.list_member_mock
+      started = threading.Event()
+
+      def download(_, headers):
+        # The request of the first file waits until the second one is sent.
+        if headers['Range'] == 'bytes=0-2':
+          self.assertTrue(started.wait(10))
+        else:
+          started.set()
+        rsp = mock.MagicMock()
+        rsp.status_code = httplib.PARTIAL_CONTENT
+        rsp.range = headers['Range']
+        return rsp
+
+      cache_server.download.side_effect = download
+      # pylint: disable=protected-access
+      with mock.patch.object(gs_archive_server, '_MAX_RANGES_PER_REQUEST', 1), \
+          mock.patch('range_response.JsonStreamer') as streamer:
+        self.server.extract('bar.tar', file=['bar', 'foo'])
+
+      self.assertEqual(
+          [(c[0][0].range, [m.filename for m in c[0][1]])
+           for c in streamer.return_value.queue_response.call_args_list],
+          [('bytes=0-2', ['foo']), ('bytes=3-12', ['bar'])])
+
+  def test_extract_range_requests_per_request(self):
+    """Test range requests of a request don't wait for other requests."""
+    self.server = gs_archive_server.GsArchiveServer(
+        '', range_request_workers=2, range_merge_gap=-1)
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.list_member = self.list_member_mock
+      blocked_ranges = []
+      all_blocked = threading.Event()
+      release = threading.Event()
+
+      def download(archive, headers):
+        # Range requests of the first request block all of its workers.
+        if archive == 'blocked.tar':
+          blocked_ranges.append(headers['Range'])
+          if len(blocked_ranges) == 2:
+            all_blocked.set()
+          self.assertTrue(release.wait(10))
+        rsp = mock.MagicMock()
+        rsp.status_code = httplib.PARTIAL_CONTENT
+        return rsp
+
+      cache_server.download.side_effect = download
+      with mock.patch.object(gs_archive_server, '_MAX_RANGES_PER_REQUEST', 1), \
+          mock.patch('range_response.JsonStreamer'):
+        blocked = threading.Thread(
+            target=self.server.extract, args=('blocked.tar',),
+            kwargs={'file': ['bar', 'foo']})
+        blocked.start()
+        self.assertTrue(all_blocked.wait(10))
+        other = threading.Thread(
+            target=self.server.extract, args=('bar.tar',),
+            kwargs={'file': ['bar', 'foo']})
+        other.start()
+        other.join(5)
+        finished = not other.is_alive()
+        release.set()
+        blocked.join()
+        other.join()
+        self.assertTrue(finished)
+
+  def test_split_into_range_requests(self):
+    """Test the Range header of a request isn't too long."""
+    spans = [[tarfile_utils.TarMemberInfo('', 0, 0, i * 10000, 100)]
+             for i in xrange(2000)]
+    # pylint: disable=protected-access
+    groups = list(gs_archive_server._split_into_range_requests(spans))
+    self.assertEqual(sum(groups, []), spans)
+    for group in groups:
+      header = 'bytes=' + ','.join(gs_archive_server._range_spec(m)
+                                   for m in group)
+      self.assertLessEqual(len(header),
+                           gs_archive_server._MAX_RANGE_HEADER_BYTES)
+    self.assertLess(len(groups), 10)
+
   def test_decompress_tgz(self):
     """Test decompress a tgz file."""
     with mock.patch.object(self.server, '_caching_server') as cache_server:
@@ -232,6 +634,17 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       rsp = self.server.decompress('baz.tgz')
       self.assertEqual(''.join(rsp), _A_TAR_FILE)
 
+  def test_decompress_single_flight(self):
+    """Test decompress a file by a single flight."""
+    self.server = gs_archive_server.GsArchiveServer(
+        '', single_flight=single_flight.SingleFlight())
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.download.return_value.iter_content.return_value = _A_TGZ_FILE
+      rsp = self.server.decompress('baz.tgz')
+      self.assertEqual(cherrypy.response.headers['Content-Length'],
+                       str(len(_A_TAR_FILE)))
+      self.assertEqual(''.join(rsp), _A_TAR_FILE)
+
   def test_decompress_bz2(self):
     """Test decompress a bz2 file."""
     with mock.patch.object(self.server, '_caching_server') as cache_server:
@@ -246,6 +659,183 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       rsp = self.server.decompress('baz.tar.xz')
       self.assertEqual(''.join(rsp), _A_TAR_FILE)
 
+  def test_decompress_streaming(self):
+    """Test decompress without Content-Length while decompressing."""
+    self.server = gs_archive_server.GsArchiveServer(
+        '', stream_decompression=True)
+    with mock.patch.object(self.server, '_caching_server') as cache_server, \
+        mock.patch.object(cherrypy.response, 'headers', {}):
+      cache_server.download.return_value.iter_content.return_value = [
+          _A_BZ2_FILE]
+      rsp = self.server.decompress('baz.tar.bz2')
+      self.assertNotIn('Content-Length', cherrypy.response.headers)
+      self.assertEqual(''.join(rsp), _A_TAR_FILE)
+
+  def test_decompress_admission(self):
+    """Test decompressions beyond the limit are rejected until one is done."""
+    controller = admission.AdmissionController({'decompress': 1}, timeout=0)
+    self.server = gs_archive_server.GsArchiveServer(
+        '', stream_decompression=True, admission_controller=controller)
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.download.return_value.iter_content.return_value = [
+          _A_BZ2_FILE]
+      rsp = self.server.decompress('baz.tar.bz2')
+      with self.assertRaises(cherrypy.HTTPError) as ctx:
+        self.server.decompress('baz.tar.bz2')
+      self.assertEqual(ctx.exception.status, httplib.SERVICE_UNAVAILABLE)
+      self.assertEqual(''.join(rsp), _A_TAR_FILE)
+      self.assertEqual(controller.status()['running'], {})
+      self.assertEqual(''.join(self.server.decompress('baz.tar.bz2')),
+                       _A_TAR_FILE)
+
+  def _mock_seekable_server(self, content, etag='"1"'):
+    """Setup a server with seek indexes which downloads compressed |content|.
+
+    Returns:
+      The mock of caching server.
+    """
+    compressed = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=compressed, mode='w') as f:
+      f.write(content)
+    compressed = compressed.getvalue()
+
+    def download(_, headers):
+      rsp = mock.MagicMock()
+      rsp.headers = {'ETag': self.etag} if self.etag else {}
+      offset = int(headers.get('Range', 'bytes=0-')[len('bytes='):-1])
+      rsp.status_code = httplib.PARTIAL_CONTENT if offset else httplib.OK
+      rsp.iter_content.return_value = [compressed[i:i + 1000] for i in
+                                       xrange(offset, len(compressed), 1000)]
+      return rsp
+
+    self.etag = etag
+    self.server = gs_archive_server.GsArchiveServer(
+        '', seek_indexes=seek_index.SeekIndexCache(interval=10000))
+    patcher = mock.patch.object(self.server, '_caching_server')
+    cache_server = patcher.start()
+    self.addCleanup(patcher.stop)
+    cache_server.download.side_effect = download
+    return cache_server
+
+  def _decompress_with_range(self, path, range_header):
+    """Call decompress RPC with HTTP header Range."""
+    with mock.patch.object(cherrypy.request, 'headers',
+                           {'Range': range_header}):
+      cherrypy.response.status = None
+      return ''.join(self.server.decompress(path))
+
+  def test_decompress_range_by_seek_index(self):
+    """Test decompress a range of tgz by the seek index."""
+    content = ''.join(str(i) for i in xrange(30000))
+    cache_server = self._mock_seekable_server(content)
+    self.assertEqual(''.join(self.server.decompress('baz.tgz')), content)
+
+    rsp = self._decompress_with_range('baz.tgz', 'bytes=100000-100099')
+    self.assertEqual(rsp, content[100000:100100])
+    self.assertEqual(cherrypy.response.status, httplib.PARTIAL_CONTENT)
+    self.assertEqual(cherrypy.response.headers['Content-Range'],
+                     'bytes 100000-100099/%d' % len(content))
+    self.assertEqual(cherrypy.response.headers['Content-Length'], '100')
+    # Only download the compressed data from a checkpoint near the range.
+    range_header = cache_server.download.call_args[1]['headers']['Range']
+    self.assertNotEqual(range_header, 'bytes=0-')
+
+  def test_decompress_by_cpu_executor(self):
+    """Test decompressing in process runs by the CPU executor."""
+    content = ''.join(str(i) for i in xrange(30000))
+    self._mock_seekable_server(content)
+    executor = mock.MagicMock(side_effect=lambda func, *args: func(*args))
+    self.server._cpu_executor = executor  # pylint: disable=protected-access
+    self.assertEqual(''.join(self.server.decompress('baz.tgz')), content)
+    self.assertTrue(executor.called)
+
+  def test_decompress_multiple_ranges_by_seek_index(self):
+    """Test decompress multiple ranges of tgz by the seek index."""
+    content = ''.join(str(i) for i in xrange(30000))
+    self._mock_seekable_server(content)
+    list(self.server.decompress('baz.tgz'))
+
+    rsp = self._decompress_with_range('baz.tgz', 'bytes=10-19,100000-100009')
+    self.assertEqual(cherrypy.response.status, httplib.PARTIAL_CONTENT)
+    content_type = cherrypy.response.headers['Content-Type']
+    self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+    boundary = content_type.split('boundary=')[1]
+    self.assertEqual(rsp, ''.join([
+        '\r\n--%s\r\nContent-Type: application/x-tar\r\n'
+        'Content-Range: bytes 10-19/%d\r\n\r\n' % (boundary, len(content)),
+        content[10:20],
+        '\r\n--%s\r\nContent-Type: application/x-tar\r\n'
+        'Content-Range: bytes 100000-100009/%d\r\n\r\n' % (boundary,
+                                                          len(content)),
+        content[100000:100010],
+        '\r\n--%s--\r\n' % boundary]))
+
+  def test_decompress_range_with_changed_etag(self):
+    """Test the seek index is rebuilt if the archive changed."""
+    content = ''.join(str(i) for i in xrange(30000))
+    self._mock_seekable_server(content)
+    list(self.server.decompress('baz.tgz'))
+
+    self.etag = '"2"'
+    rsp = self._decompress_with_range('baz.tgz', 'bytes=100000-100099')
+    # Fallback to decompress the whole archive.
+    self.assertEqual(rsp, content)
+    self.assertIsNone(cherrypy.response.status)
+    # pylint: disable=protected-access
+    self.assertEqual(self.server._seek_indexes.get('baz.tgz').etag, '"2"')
+
+  def test_decompress_range_changed_while_streaming(self):
+    """Test the response is aborted if the archive changed while streaming."""
+    content = ''.join(str(i) for i in xrange(30000))
+    self._mock_seekable_server(content)
+    list(self.server.decompress('baz.tgz'))
+
+    with mock.patch.object(cherrypy.request, 'headers',
+                           {'Range': 'bytes=100000-100009,10-19'}):
+      rsp = self.server.decompress('baz.tgz')
+      self.etag = '"2"'
+      with self.assertRaises(seek_index.SeekIndexError):
+        list(rsp)
+    # pylint: disable=protected-access
+    self.assertIsNone(self.server._seek_indexes.get('baz.tgz'))
+
+  def test_decompress_multi_stream_bz2(self):
+    """Test only bz2 archives of multiple streams are indexed."""
+    self.server = gs_archive_server.GsArchiveServer(
+        '', seek_indexes=seek_index.SeekIndexCache())
+    seek_indexes = self.server._seek_indexes  # pylint: disable=protected-access
+    with mock.patch.object(self.server, '_caching_server') as cache_server:
+      cache_server.download.return_value.headers = {'ETag': '"1"'}
+      cache_server.download.return_value.iter_content.return_value = [
+          _A_BZ2_FILE]
+      self.assertEqual(''.join(self.server.decompress('baz.tar.bz2')),
+                       _A_TAR_FILE)
+      self.assertFalse(seek_indexes.is_multi_stream('baz.tar.bz2'))
+
+      cache_server.download.return_value.iter_content.return_value = [
+          _A_BZ2_FILE, _A_BZ2_FILE]
+      self.assertEqual(''.join(self.server.decompress('baz.tar.bz2')),
+                       _A_TAR_FILE * 2)
+      self.assertTrue(seek_indexes.is_multi_stream('baz.tar.bz2'))
+      self.assertIsNone(seek_indexes.get('baz.tar.bz2'))
+
+      # The archive is indexed when decompressed again.
+      self.assertEqual(''.join(self.server.decompress('baz.tar.bz2')),
+                       _A_TAR_FILE * 2)
+      self.assertIsNotNone(seek_indexes.get('baz.tar.bz2'))
+
+  def test_decompress_range_without_etag(self):
+    """Test the archive isn't indexed if there's no ETag."""
+    content = ''.join(str(i) for i in xrange(30000))
+    self._mock_seekable_server(content, etag=None)
+    list(self.server.decompress('baz.tgz'))
+    # pylint: disable=protected-access
+    self.assertIsNone(self.server._seek_indexes.get('baz.tgz'))
+
+    rsp = self._decompress_with_range('baz.tgz', 'bytes=100000-100099')
+    self.assertEqual(rsp, content)
+    self.assertIsNone(cherrypy.response.status)
+
   def test_extract_ztar(self):
     """Test extract a file from a compressed tar archive."""
     with mock.patch.object(self.server, '_caching_server') as cache_server:
@@ -262,6 +852,111 @@ class MockedGSArchiveServerTest(unittest.TestCase):
       self.assertTrue(cache_server.download.called)
 
 
+class IndexedGSArchiveServerTest(unittest.TestCase):
+  """Unit test of GsArchiveServer with the index of tar members."""
+
+  def setUp(self):
+    """Setup method."""
+    self.tempdir = tempfile.mkdtemp()
+    self.index = member_index.MemberIndex(
+        os.path.join(self.tempdir, 'members.db'))
+    self.server = gs_archive_server.GsArchiveServer(
+        '', tar_member_index=self.index)
+
+    patcher = mock.patch.object(self.server, '_gsutil')
+    self.gsutil = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.gsutil.Stat.return_value.generation = 123
+
+    patcher = mock.patch.object(self.server, '_caching_server')
+    self.caching_server = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_list_member(self):
+    """Test list_member RPC scans an archive only once."""
+    self.caching_server.download.return_value.iter_content.return_value = (
+        _A_TAR_FILE[:100], _A_TAR_FILE[100:])
+    csv = ''.join(self.server.list_member('baz.tar'))
+    self.assertEqual(csv, 'bar,0,1024,512,4\n')
+    self.gsutil.Stat.assert_called_with('gs://baz.tar')
+    self.assertEqual(self.index.get('baz.tar', 123),
+                     [('bar', 0, 1024, 512, 4)])
+
+    # The second call is served by the index, and the generation is cached
+    # even without the metadata cache.
+    self.caching_server.reset_mock()
+    self.gsutil.reset_mock()
+    self.assertEqual(''.join(self.server.list_member('baz.tar')), csv)
+    self.assertFalse(self.caching_server.download.called)
+    self.assertFalse(self.gsutil.Stat.called)
+
+    # A new generation of the archive is scanned again after the cached
+    # generation expired.
+    self.gsutil.Stat.return_value.generation = 456
+    expired = time.time() + stat_cache.DEFAULT_TTL_SECONDS
+    with mock.patch('time.time', return_value=expired + 1):
+      self.assertEqual(''.join(self.server.list_member('baz.tar')), csv)
+    self.assertTrue(self.caching_server.download.called)
+
+  def test_list_member_stat_error(self):
+    """Test list_member RPC works when failed to stat the archive."""
+    self.gsutil.Stat.side_effect = gs_archive_server.gs.GSNoSuchKey('error')
+    self.caching_server.download.return_value.iter_content.return_value = (
+        _A_TAR_FILE,)
+    self.assertEqual(''.join(self.server.list_member('baz.tar')),
+                     'bar,0,1024,512,4\n')
+    self.assertIsNone(self.index.get('baz.tar', 123))
+
+  def test_list_member_index_error(self):
+    """Test list_member RPC returns all members when failed to index them."""
+    self.caching_server.download.return_value.iter_content.return_value = (
+        _A_TAR_FILE,)
+    with mock.patch.object(self.index, 'put',
+                           side_effect=sqlite3.OperationalError('locked')):
+      self.assertEqual(''.join(self.server.list_member('baz.tar')),
+                       'bar,0,1024,512,4\n')
+    self.assertIsNone(self.index.get('baz.tar', 123))
+
+  def test_extract_from_indexed_tar(self):
+    """Test extracting files from an indexed tar skips list_member RPC."""
+    self.index.put('bar.tar', 123, [
+        tarfile_utils.TarMemberInfo('foo', 0, 1024, 512, 3),
+        tarfile_utils.TarMemberInfo('bar', 1024, 1024, 1536, 10)])
+    self.caching_server.download.return_value.headers = {
+        'Content-Range': 'bytes 1536-1545/*'}
+    self.server.extract('bar.tar', file='bar')
+    self.assertFalse(self.caching_server.list_member.called)
+    self.caching_server.download.assert_called_with(
+        'bar.tar', headers={'Range': 'bytes=1536-1545'})
+
+  def test_extract_from_indexed_compressed_tar(self):
+    """Test the index of a compressed tar is keyed by the compressed file."""
+    self.gsutil.Stat.return_value.generation = None
+    self.caching_server.list_member.return_value.iter_lines.return_value = [
+        'foobar,_,_,0,123']
+    self.caching_server.download.return_value.headers = {
+        'Content-Range': 'bytes 0-122/*'}
+    self.server.extract('baz.tgz', file='foobar')
+    self.gsutil.Stat.assert_called_with('gs://baz.tgz')
+    self.assertTrue(self.caching_server.list_member.called)
+
+
+class ParseArgsTest(unittest.TestCase):
+  """Test parsing the command line arguments."""
+
+  def test_caching_server_url(self):
+    """Test URLs of caching server over TCP or Unix domain socket."""
+    for url, expected in (
+        ('localhost:8080', ('http', 'localhost:8080')),
+        ('https://127.0.0.1', ('https', '127.0.0.1')),
+        ('unix:/var/run/nginx.sock', ('unix', '/var/run/nginx.sock'))):
+      args = gs_archive_server.parse_args(['-p', '80', '-c', url])
+      self.assertEqual(args.caching_server, expected)
+
+
 def testing_server_setup():
   """Check if testing server is setup."""
   try:
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Smoke tests of the benchmark suite of gs_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+# pylint: disable=wrong-import-position
+import gs_cache_benchmark
+
+
+class GsCacheBenchmarkTest(unittest.TestCase):
+  """Tests of running the benchmark suite."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_run_all_cases(self):
+    """Test all cases run on tiny archives without errors."""
+    output = os.path.join(self.tempdir, 'results.json')
+    gs_cache_benchmark.main([
+        '--iterations', '1', '--small-members', '20', '--huge-members', '1',
+        '--huge-mb', '1', '--extract-files', '2', '--output', output])
+    with open(output) as f:
+      results = json.load(f)['results']
+    self.assertEqual(len(results), 11)
+    for result in results:
+      self.assertNotIn('error', result, result)
+      self.assertGreater(result['bytes'], 0, result)
+
+
+if __name__ == '__main__':
+  unittest.main()
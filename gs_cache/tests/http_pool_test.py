@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for http_pool."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import http_pool
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A handler responding the request path, with keep-alive."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(self.path)))
+    self.end_headers()
+    self.wfile.write(self.path)
+
+  def log_message(self, *args):  # pylint: disable=arguments-differ
+    pass
+
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+
+class _TCPHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class HttpPoolTest(unittest.TestCase):
+  """Tests of pooled sessions."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _serve(self, server):
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+
+  def _verify_keep_alive(self, server, session, base_url):
+    for path in ('/foo', '/bar', '/foo?x=1'):
+      rsp = session.get(base_url + path)
+      self.assertEqual(rsp.status_code, 200)
+      self.assertEqual(rsp.content, path)
+    self.assertEqual(server.connections, 1)
+    session.close()
+
+  def test_unix_socket(self):
+    """Test requests over an Unix domain socket reuse the connection."""
+    # Hosts of URLs are lowercased, which doesn't matter to the socket path.
+    socket_path = os.path.join(self.tempdir, 'Server.sock')
+    server = _UnixHTTPServer(socket_path, _Handler)
+    self._serve(server)
+    self._verify_keep_alive(
+        server, http_pool.new_session(unix_socket=socket_path),
+        '%s://%s' % (http_pool.UNIX_SOCKET_SCHEME, http_pool.UNIX_SOCKET_HOST))
+
+  def test_tcp(self):
+    """Test requests over TCP reuse the connection."""
+    server = _TCPHTTPServer(('127.0.0.1', 0), _Handler)
+    self._serve(server)
+    self._verify_keep_alive(server, http_pool.new_session(),
+                            'http://127.0.0.1:%d' % server.server_address[1])
+
+
+if __name__ == '__main__':
+  unittest.main()
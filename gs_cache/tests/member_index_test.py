@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for member_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import member_index
+import tarfile_utils
+
+_MEMBERS = [
+    tarfile_utils.TarMemberInfo('foo', 0, 1024, 512, 3),
+    tarfile_utils.TarMemberInfo('dir/', 1024, 512, 1536, 0),
+    tarfile_utils.TarMemberInfo('dir/bar', 1536, 1024, 2048, 10),
+    tarfile_utils.TarMemberInfo('dir/control', 2560, 1024, 3072, 100),
+]
+
+
+class MemberIndexTest(unittest.TestCase):
+  """Tests of MemberIndex."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.index = member_index.MemberIndex(
+        os.path.join(self.tempdir, 'members.db'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_get_non_indexed_archive(self):
+    """Test getting members of an archive which isn't indexed."""
+    self.assertIsNone(self.index.get('bucket/foo.tar', 1))
+    self.assertIsNone(self.index.search('bucket/foo.tar', 1, ['foo']))
+
+  def test_put_and_get(self):
+    """Test saving members and getting them back."""
+    self.index.put('bucket/foo.tar', 1, iter(_MEMBERS))
+    self.assertEqual(self.index.get('bucket/foo.tar', 1), _MEMBERS)
+    # Another generation of the same archive isn't indexed.
+    self.assertIsNone(self.index.get('bucket/foo.tar', 2))
+
+  def test_put_new_generation(self):
+    """Test indexing a new generation drops the old one."""
+    self.index.put('bucket/foo.tar', 1, _MEMBERS)
+    self.index.put('bucket/foo.tar', 2, _MEMBERS[:1])
+    self.assertIsNone(self.index.get('bucket/foo.tar', 1))
+    self.assertEqual(self.index.get('bucket/foo.tar', 2), _MEMBERS[:1])
+
+  def test_max_archives(self):
+    """Test the earliest indexed archives are dropped beyond the limit."""
+    index = member_index.MemberIndex(
+        os.path.join(self.tempdir, 'limited.db'), max_archives=2)
+    for name in ('a.tar', 'b.tar', 'c.tar'):
+      index.put(name, 1, _MEMBERS)
+    self.assertIsNone(index.get('a.tar', 1))
+    self.assertEqual(index.get('b.tar', 1), _MEMBERS)
+    self.assertEqual(index.get('c.tar', 1), _MEMBERS)
+
+    # Re-indexing an archive makes it the latest one.
+    index.put('b.tar', 2, _MEMBERS)
+    index.put('d.tar', 1, _MEMBERS)
+    self.assertIsNone(index.get('c.tar', 1))
+    self.assertEqual(index.get('b.tar', 2), _MEMBERS)
+
+  def test_persistent(self):
+    """Test the index is available to another instance."""
+    self.index.put('bucket/foo.tar', 1, _MEMBERS)
+    another_index = member_index.MemberIndex(
+        os.path.join(self.tempdir, 'members.db'))
+    self.assertEqual(another_index.get('bucket/foo.tar', 1), _MEMBERS)
+
+  def test_search(self):
+    """Test searching members by file names and patterns."""
+    self.index.put('bucket/foo.tar', 1, _MEMBERS)
+    self.assertEqual(self.index.search('bucket/foo.tar', 1, ['foo']),
+                     {_MEMBERS[0]})
+    self.assertEqual(self.index.search('bucket/foo.tar', 1, ['*/control*']),
+                     {_MEMBERS[3]})
+    self.assertEqual(
+        self.index.search('bucket/foo.tar', 1, ['dir/*', 'dir/bar']),
+        set(_MEMBERS[1:]))
+    self.assertEqual(self.index.search('bucket/foo.tar', 1, ['non-existing']),
+                     set())
+
+
+if __name__ == '__main__':
+  unittest.main()
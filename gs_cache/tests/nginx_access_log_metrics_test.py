@@ -9,51 +9,72 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import unittest
 
 import mock
 
+import log_metrics_pipeline
 import nginx_access_log_metrics
 
+_LINE = ('100.109.169.118 2018-08-01T09:11:27-07:00 "GET '
+         '/extract/a_bucket/a-release/R1-2.3/archive HTTP/1.1" '
+         '200 12345 "agent/1.2.3" HIT')
+
 
 # pylint: disable=protected-access
 class TestMetric(unittest.TestCase):
   """Test class for nginx_access_log_metrics."""
 
-  def test_match_the_log_line(self):
-    """Test the regex to match a target log line."""
-    match = nginx_access_log_metrics._SUCCESS_RESPONSE_MATCHER.match(
-        '100.109.169.118 2018-08-01T09:11:27-07:00 "GET a_url HTTP/1.1" '
-        '200 12345 "agent/1.2.3" HIT')
-    self.assertTrue(match)
-
-    self.assertEqual(match.group('ip_addr'), '100.109.169.118')
-    self.assertEqual(match.group('url_path'), 'a_url')
-    self.assertEqual(match.group('size'), '12345')
-    self.assertEqual(match.group('cache_status'), 'HIT')
-
-  def test_match_URL_path(self):
-    """Test the regex to match a URL path."""
-    url = '/extract/a_bucket/a-release/R1-2.3/archive'
-    # The match works for URL has or hasn't parameter.
+  def test_parse_the_log_line(self):
+    """Test parsing a target log line."""
+    fields, size = nginx_access_log_metrics.parse_line(_LINE)
+    self.assertEqual(size, 12345)
+    self.assertEqual(dict(zip(nginx_access_log_metrics._METRIC_FIELDS, fields)),
+                     {'cache': 'HIT', 'action': 'extract',
+                      'bucket': 'a_bucket', 'build': 'a-release',
+                      'milestone': 'R1', 'version': '2.3',
+                      'endpoint': 'archive'})
+
+  def test_parse_URL_path(self):
+    """Test parsing a URL path."""
+    url = '/extract/a_bucket/a-release/R1-2.3/path/to/archive'
+    # The parsing works for URL has or hasn't parameter.
     for u in [url, url + '?key=value']:
-      match = nginx_access_log_metrics._URL_PATH_MATCHER.match(u)
-
-      self.assertEqual(match.group('action'), 'extract')
-      self.assertEqual(match.group('bucket'), 'a_bucket')
-      self.assertEqual(match.group('build'), 'a-release')
-      self.assertEqual(match.group('milestone'), 'R1')
-      self.assertEqual(match.group('version'), '2.3')
-      self.assertEqual(match.group('filename'), 'archive')
-
-  def test_emitter(self):
-    """Test the emitter."""
-    match = nginx_access_log_metrics._SUCCESS_RESPONSE_MATCHER.match(
-        '100.109.169.118 2018-08-01T09:11:27-07:00 "GET '
-        '/extract/a_bucket/build/R1-2.3/archive HTTP/1.1" '
-        '200 12345 "agent/1.2.3" HIT')
-    # Calling the emitter should not raise any exceptions (for example, by
-    # referencing regex match groups that don't exist.
-    with mock.patch.object(nginx_access_log_metrics, 'metrics') as m:
-      nginx_access_log_metrics.emit_successful_response_metric(match)
+      fields, _ = nginx_access_log_metrics.parse_line(
+          _LINE.replace('/extract/a_bucket/a-release/R1-2.3/archive', u))
+      self.assertEqual(fields, ('HIT', 'extract', 'a_bucket', 'a-release',
+                                'R1', '2.3', 'path/to/archive'))
+
+    # Other URLs are counted without the fields of URL.
+    fields, _ = nginx_access_log_metrics.parse_line(
+        _LINE.replace('/extract/a_bucket/a-release/R1-2.3/archive', 'a_url'))
+    self.assertEqual(fields, ('HIT', '', '', '', '', '', ''))
+
+  def test_ignored_lines(self):
+    """Test lines other than successful responses to clients are ignored."""
+    for line in [_LINE.replace('100.109.169.118', '127.0.0.1'),
+                 _LINE.replace(' 200 ', ' 404 '),
+                 _LINE.replace('"GET ', '"POST '),
+                 _LINE.replace(' 12345 ', ' - '),
+                 'garbage', '']:
+      self.assertIsNone(nginx_access_log_metrics.parse_line(line))
+
+  def test_process_log(self):
+    """Test the sizes of responses are summed up per set of fields."""
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, 'w') as f:
+      f.write('\n'.join([_LINE, _LINE.replace(' HIT', ' MISS'), 'garbage',
+                          _LINE]))
+    with os.fdopen(read_fd) as f, \
+        mock.patch.object(log_metrics_pipeline, 'metrics') as m:
+      nginx_access_log_metrics.process_log(f)
       m.Counter.assert_called_with(nginx_access_log_metrics._METRIC_NAME)
+      increment_by = m.Counter.return_value.increment_by
+      calls = sorted((c[0][0], c[1]['fields']['cache'])
+                     for c in increment_by.call_args_list)
+      self.assertEqual(calls, [(12345, 'MISS'), (24690, 'HIT')])
+
+
+if __name__ == '__main__':
+  unittest.main()
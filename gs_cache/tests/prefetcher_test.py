@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for prefetcher."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import unittest
+
+import prefetcher
+
+
+class PrefetcherTest(unittest.TestCase):
+  """Tests of Prefetcher."""
+
+  def setUp(self):
+    self.warmed = []
+    self.release = threading.Event()
+
+  def _warm(self, path, *args):
+    """A warm function which blocks until self.release is set."""
+    self.assertTrue(self.release.wait(10))
+    if path == 'bad':
+      raise IOError('Not found')
+    self.warmed.append((path,) + args)
+
+  def test_prefetch(self):
+    """Test paths are warmed in the background and their states are kept."""
+    fetcher = prefetcher.Prefetcher(self._warm, workers=1)
+    self.assertEqual(fetcher.submit('foo', 1)['state'], prefetcher.QUEUED)
+    self.assertEqual(fetcher.submit('bad')['state'], prefetcher.QUEUED)
+    # A path being prefetched isn't queued again.
+    fetcher.submit('foo', 2)
+    self.release.set()
+    fetcher._queue.join()  # pylint: disable=protected-access
+
+    self.assertEqual(self.warmed, [('foo', 1)])
+    self.assertEqual(fetcher.status('foo')['state'], prefetcher.DONE)
+    self.assertEqual(fetcher.status('bad')['state'], prefetcher.FAILED)
+    self.assertEqual(fetcher.status('bad')['error'], 'Not found')
+    self.assertIsNone(fetcher.status('baz'))
+    self.assertEqual([s['path'] for s in fetcher.status()], ['foo', 'bad'])
+
+    # A finished path can be prefetched again.
+    self.assertEqual(fetcher.submit('foo')['state'], prefetcher.QUEUED)
+    fetcher._queue.join()  # pylint: disable=protected-access
+    self.assertEqual(self.warmed, [('foo', 1), ('foo',)])
+
+  def test_queue_full(self):
+    """Test submitting is rejected when too many paths are waiting."""
+    running = threading.Event()
+
+    def warm(path):
+      running.set()
+      self._warm(path)
+
+    fetcher = prefetcher.Prefetcher(warm, workers=1, max_queued=1)
+    fetcher.submit('foo')
+    self.assertTrue(running.wait(10))
+    fetcher.submit('bar')
+    with self.assertRaises(prefetcher.QueueFullError):
+      fetcher.submit('baz')
+    self.assertIsNone(fetcher.status('baz'))
+    self.release.set()
+    fetcher._queue.join()  # pylint: disable=protected-access
+
+  def test_history(self):
+    """Test the earliest finished states are dropped beyond the limit."""
+    self.release.set()
+    fetcher = prefetcher.Prefetcher(self._warm, workers=1, max_history=2)
+    for path in ('foo', 'bar', 'baz'):
+      fetcher.submit(path)
+      fetcher._queue.join()  # pylint: disable=protected-access
+    self.assertEqual([s['path'] for s in fetcher.status()], ['bar', 'baz'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -10,6 +10,7 @@ from __future__ import division
 from __future__ import print_function
 
 import json
+import struct
 import unittest
 
 import mock
@@ -26,7 +27,7 @@ class JsonStreamerBasicTest(unittest.TestCase):
     self.streamer = range_response.JsonStreamer()
     self.single_part_response = mock.MagicMock()
     self.single_part_response.headers = {'Content-Range': 'bytes 100-1099/*'}
-    self.single_part_response.content = 'A' * 1000
+    self.single_part_response.iter_content.return_value = iter(['A' * 1000])
     self.file_info_list = [tarfile_utils.TarMemberInfo('foo', '', '', '100',
                                                        '1000')]
 
@@ -62,6 +63,37 @@ class JsonStreamerBasicTest(unittest.TestCase):
       self.streamer.queue_response(self.single_part_response, [])
 
 
+class ChunkReaderTest(unittest.TestCase):
+  """Tests of range_response._ChunkReader."""
+
+  def test_readline(self):
+    """Test reading lines split into chunks."""
+    reader = range_response._ChunkReader(iter(
+        ['ab\r', '\ncd', 'e', '\r\n\r\nfg\r\nh', 'i']))
+    self.assertEqual([reader.readline() for _ in xrange(6)],
+                     ['ab', 'cde', '', 'fg', 'hi', None])
+
+  def test_read(self):
+    """Test reading bytes doesn't wait for more chunks."""
+    chunk = 'x' * 100
+    reader = range_response._ChunkReader(iter(['ab\r\ncd', chunk, 'y']))
+    self.assertEqual(reader.readline(), 'ab')
+    self.assertEqual(reader.read(1000), 'cd')
+    self.assertIs(reader.read(1000), chunk)
+    self.assertEqual(reader.skip(1000), 1)
+    self.assertEqual(reader.read(1000), '')
+
+  def test_readinto(self):
+    """Test reading bytes into a buffer."""
+    reader = range_response._ChunkReader(iter(['abc', 'defg']))
+    buf = bytearray(5)
+    self.assertEqual(reader.readinto(buf), 3)
+    self.assertEqual(reader.readinto(memoryview(buf)[3:]), 2)
+    self.assertEqual(buf, bytearray('abcde'))
+    self.assertEqual(reader.readinto(buf), 2)
+    self.assertEqual(reader.readinto(buf), 0)
+
+
 class MultiPartResponseTest(unittest.TestCase):
   """Test class for handling one response of multi-part range request."""
 
@@ -117,6 +149,21 @@ class MultiPartResponseTest(unittest.TestCase):
     self.assertDictEqual(result, {'foo': '0123456789', 'FOO': '0123456789',
                                   'bar': 'a' * 1000, 'BAR': 'a' * 1000})
 
+  def test_stream__files_in_one_part(self):
+    """Test streaming files in one part of the response."""
+    self.response.iter_content.return_value = iter([
+        '\r\nboundary\r\nContent-Type: some/type\r',
+        '\nContent-Range: bytes 10-132/T\r\n\r\n0123456789',
+        '_' * 113,
+        '\r\nboundary--\r\n',
+    ])
+    self.streamer.queue_response(
+        self.response,
+        self.file_info_list + [
+            tarfile_utils.TarMemberInfo('baz', '', '', '120', '13')])
+    result = json.loads(''.join(self.streamer.stream()))
+    self.assertDictEqual(result, {'foo': '0123456789', 'baz': '_' * 13})
+
   def test_stream__file_not_found(self):
     """Test streaming which cannot find file names."""
     self.response.iter_content.return_value = iter([
@@ -155,7 +202,76 @@ class MultiPartResponseTest(unittest.TestCase):
     """Test formatting a single range response."""
     self.response.headers = {'Content-Type': 'some/type',
                              'Content-Range': 'bytes 10-19/*'}
-    self.response.content = 'x' * 10
+    self.response.iter_content.return_value = iter(['x' * 10])
     self.streamer.queue_response(self.response, self.file_info_list)
     result = ''.join(self.streamer.stream())
-    self.assertEqual(result, json.dumps({'foo': self.response.content}))
+    self.assertEqual(result, json.dumps({'foo': 'x' * 10}))
+
+  def test_stream__large_file(self):
+    """Test streaming a large file in chunks."""
+    self.response.headers = {'Content-Type': 'some/type',
+                             'Content-Range': 'bytes 10-1000009/*'}
+    content = ('\xe4\xb8\xad' + 'x' * 997) * 1000
+    # Multi-byte characters are split into two chunks.
+    self.response.iter_content.return_value = iter(
+        [content[:1]] + [content[i:i + 1000]
+                         for i in xrange(1, len(content), 1000)])
+    self.streamer.queue_response(
+        self.response, [tarfile_utils.TarMemberInfo('foo', '', '', '10',
+                                                    '1000000')])
+    pieces = list(self.streamer.stream())
+    self.assertLess(max(len(p) for p in pieces), 1024)
+    self.assertEqual(json.loads(''.join(pieces)),
+                     {'foo': (u'\u4e2d' + 'x' * 997) * 1000})
+
+
+class OutputFormatTest(unittest.TestCase):
+  """Tests of streaming files in formats other than JSON."""
+
+  def setUp(self):
+    self.response = mock.MagicMock()
+    self.response.headers = {
+        'Content-Type': 'multipart/byteranges; boundary=boundary',
+    }
+    self.response.iter_content.return_value = iter([
+        '\r\nboundary\r\nContent-Type: some/type\r\n'
+        'Content-Range: bytes 10-22/T\r\n\r\n012\x00\xff\r\n___abc',
+        '\r\nboundary--\r\n',
+    ])
+    self.file_info_list = [
+        tarfile_utils.TarMemberInfo('foo', '', '', '10', '7'),
+        tarfile_utils.TarMemberInfo('a/b c', '', '', '20', '3')]
+
+  def test_tar(self):
+    """Test streaming records as a tar archive."""
+    streamer = range_response.TarStreamer()
+    streamer.queue_response(self.response, self.file_info_list)
+    self.assertEqual(''.join(streamer.stream()),
+                     '012\x00\xff\r\nabc' + '\x00' * 1024)
+
+  def test_frames(self):
+    """Test streaming files as length-prefixed frames."""
+    streamer = range_response.FramesStreamer()
+    streamer.queue_response(self.response, self.file_info_list)
+    self.assertEqual(
+        ''.join(streamer.stream()),
+        struct.pack('>I', 3) + 'foo' + struct.pack('>Q', 7) +
+        '012\x00\xff\r\n' +
+        struct.pack('>I', 5) + 'a/b c' + struct.pack('>Q', 3) + 'abc')
+
+  def test_multipart(self):
+    """Test streaming files as a multipart body."""
+    streamer = range_response.MultipartStreamer()
+    streamer.queue_response(self.response, self.file_info_list)
+    boundary = streamer.content_type.split('boundary=')[1]
+    self.assertEqual(
+        ''.join(streamer.stream()),
+        '--%(b)s\r\n'
+        'Content-Type: application/octet-stream\r\n'
+        "Content-Disposition: attachment; filename*=UTF-8''foo\r\n"
+        'Content-Length: 7\r\n\r\n012\x00\xff\r\n\r\n'
+        '--%(b)s\r\n'
+        'Content-Type: application/octet-stream\r\n'
+        "Content-Disposition: attachment; filename*=UTF-8''a%%2Fb%%20c\r\n"
+        'Content-Length: 3\r\n\r\nabc\r\n'
+        '--%(b)s--\r\n' % {'b': boundary})
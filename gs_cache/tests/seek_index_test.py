@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for seek_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bz2
+import gzip
+import random
+import StringIO
+import unittest
+
+import seek_index
+
+_CHUNK_SIZE = 1000
+
+
+def _gzip_compress(data):
+  """Compress |data| in gzip format."""
+  compressed = StringIO.StringIO()
+  with gzip.GzipFile(fileobj=compressed, mode='w') as f:
+    f.write(data)
+  return compressed.getvalue()
+
+
+def _make_content(size):
+  """Make some compressible but not trivial content of |size|."""
+  rand = random.Random(size)
+  words = ['foo', 'bar', 'baz', 'control', 'autotest', '\n', '\0']
+  content = ''.join(rand.choice(words) for _ in xrange(size // 3))
+  return (content * (size // len(content) + 1))[:size]
+
+
+class SeekIndexTest(unittest.TestCase):
+  """Tests of building seek indexes and reading ranges by them."""
+
+  def setUp(self):
+    self.content = _make_content(100 * 1000)
+    self.fetched_offsets = []
+
+  def _build_index(self, ext_name, compressed, interval):
+    builder = seek_index.SeekIndexBuilder(ext_name, interval)
+    decompressed = []
+    for i in xrange(0, len(compressed), _CHUNK_SIZE):
+      decompressed.append(builder.decompress(compressed[i:i + _CHUNK_SIZE]))
+    decompressed.append(builder.flush())
+    self.assertEqual(''.join(decompressed), self.content)
+    return builder.build('etag')
+
+  def _verify_ranges(self, index, compressed):
+    def fetch(offset):
+      self.fetched_offsets.append(offset)
+      return (compressed[i:i + _CHUNK_SIZE]
+              for i in xrange(offset, len(compressed), _CHUNK_SIZE))
+
+    reader = seek_index.RangeReader(index, fetch)
+    ranges = [(0, 10), (5, 100), (20000, 20001), (20001, 30000),
+              (len(self.content) - 1, len(self.content)), (55555, 66666),
+              (10, 20)]
+    for start, stop in ranges:
+      self.assertEqual(''.join(reader.read(start, stop)),
+                       self.content[start:stop])
+    reader.close()
+
+  def test_gzip(self):
+    """Test the seek index of a gzip file."""
+    compressed = _gzip_compress(self.content)
+    index = self._build_index('.gz', compressed, 10000)
+    self.assertEqual(index.size, len(self.content))
+    self.assertEqual(index.etag, 'etag')
+    self.assertGreater(len(index.checkpoints), 5)
+    self._verify_ranges(index, compressed)
+    # Restarted from checkpoints other than the beginning of the file.
+    self.assertGreater(len(set(self.fetched_offsets)), 2)
+
+  def test_multi_member_gzip(self):
+    """Test the seek index of a gzip file of multiple members."""
+    compressed = ''.join(_gzip_compress(self.content[i:i + 7777])
+                         for i in xrange(0, len(self.content), 7777))
+    index = self._build_index('.tgz', compressed, 10000)
+    self._verify_ranges(index, compressed)
+
+  def test_multi_stream_bz2(self):
+    """Test the seek index of a bzip2 file of multiple streams."""
+    compressed = ''.join(bz2.compress(self.content[i:i + 9000])
+                         for i in xrange(0, len(self.content), 9000))
+    index = self._build_index('.bz2', compressed, 20000)
+    self.assertEqual(
+        [c.decompressed_offset for c in index.checkpoints],
+        [0, 27000, 54000, 81000])
+    self._verify_ranges(index, compressed)
+
+  def test_gzip_with_trailing_data(self):
+    """Test the data after the last gzip member is ignored like `gzip -d`."""
+    compressed = _gzip_compress(self.content)
+    for trailing in ('\0' * 512, 'garbage', '\x1f'):
+      index = self._build_index('.tgz', compressed + trailing, 10000)
+      self.assertEqual(index.size, len(self.content))
+      self._verify_ranges(index, compressed + trailing)
+
+  def test_bz2_with_trailing_data(self):
+    """Test the data after the last bzip2 stream is ignored like `bzip2 -d`."""
+    compressed = bz2.compress(self.content)
+    for trailing in ('\0' * 512, 'B'):
+      index = self._build_index('.bz2', compressed + trailing, 20000)
+      self.assertEqual(index.size, len(self.content))
+
+  def test_bz2_stream_scanner(self):
+    """Test telling if a bzip2 file has multiple streams."""
+    single_stream = bz2.compress(self.content)
+    multi_stream = single_stream + bz2.compress(self.content)
+    for compressed, expected in ((single_stream, False), (multi_stream, True)):
+      for chunk_size in (1, 7, _CHUNK_SIZE):
+        scanner = seek_index.Bz2StreamScanner()
+        for i in xrange(0, len(compressed), chunk_size):
+          scanner.feed(compressed[i:i + chunk_size])
+        self.assertEqual(scanner.multi_stream, expected)
+
+  def test_truncated(self):
+    """Test reading a range when the compressed data is truncated."""
+    compressed = _gzip_compress(self.content)
+    index = self._build_index('.gz', compressed, 10000)
+    reader = seek_index.RangeReader(index, lambda offset: [])
+    with self.assertRaises(seek_index.SeekIndexError):
+      list(reader.read(0, 10))
+
+
+class SeekIndexCacheTest(unittest.TestCase):
+  """Tests of SeekIndexCache."""
+
+  def test_lru(self):
+    """Test the least recently used index is dropped."""
+    cache = seek_index.SeekIndexCache(max_indexes=2)
+    cache.put('a', 'index_a')
+    cache.put('b', 'index_b')
+    self.assertEqual(cache.get('a'), 'index_a')
+    cache.put('c', 'index_c')
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(cache.get('a'), 'index_a')
+    cache.drop('a')
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(cache.get('c'), 'index_c')
+
+  def test_multi_stream(self):
+    """Test remembering bzip2 archives of multiple streams."""
+    cache = seek_index.SeekIndexCache(max_indexes=1)
+    self.assertFalse(cache.is_multi_stream('a'))
+    cache.add_multi_stream('a')
+    self.assertTrue(cache.is_multi_stream('a'))
+    cache.add_multi_stream('b')
+    self.assertFalse(cache.is_multi_stream('a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
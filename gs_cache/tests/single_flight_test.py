@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for single_flight."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import single_flight
+
+
+class SingleFlightTest(unittest.TestCase):
+  """Tests of SingleFlight."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.flights = single_flight.SingleFlight(self.tempdir)
+    self.fetched = threading.Event()
+    self.fetch_count = 0
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def _fetch(self, chunks=('foo', 'bar')):
+    """A fetch function which blocks until self.fetched is set."""
+    def fetch():
+      self.fetch_count += 1
+      yield chunks[0]
+      self.assertTrue(self.fetched.wait(10))
+      for chunk in chunks[1:]:
+        yield chunk
+    return fetch
+
+  def test_fetch_once(self):
+    """Test concurrent readers share one fetch and read at their own pace."""
+    reader1 = iter(self.flights.fetch('key', self._fetch()))
+    self.assertEqual(next(reader1), 'foo')
+    reader2 = self.flights.fetch('key', self._fetch())
+    self.fetched.set()
+    self.assertEqual(reader2.wait(), 6)
+    self.assertEqual(''.join(reader2), 'foobar')
+    self.assertEqual(''.join(reader1), 'bar')
+    self.assertEqual(self.fetch_count, 1)
+
+    # The flight is forgotten once done.
+    self.assertEqual(''.join(self.flights.fetch('key', self._fetch())),
+                     'foobar')
+    self.assertEqual(self.fetch_count, 2)
+
+  def test_error(self):
+    """Test the error of fetching is raised to all readers."""
+    def fetch():
+      yield 'foo'
+      self.assertTrue(self.fetched.wait(10))
+      raise IOError('Connection reset')
+
+    reader1 = self.flights.fetch('key', fetch)
+    reader2 = iter(self.flights.fetch('key', fetch))
+    self.fetched.set()
+    with self.assertRaises(IOError):
+      reader1.wait()
+    self.assertEqual(next(reader2), 'foo')
+    with self.assertRaises(IOError):
+      next(reader2)
+
+  def test_cancel(self):
+    """Test the fetch is canceled once all readers are gone."""
+    closed = threading.Event()
+
+    def fetch():
+      try:
+        while True:
+          yield 'x'
+      finally:
+        closed.set()
+
+    reader = iter(self.flights.fetch('key', fetch))
+    next(reader)
+    reader.close()
+    self.assertTrue(closed.wait(10))
+
+
+if __name__ == '__main__':
+  unittest.main()
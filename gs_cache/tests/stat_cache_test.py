@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for stat_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import gcs_client
+import stat_cache
+from chromite.lib import gs
+
+_STAT = gcs_client.StatResult(content_length=10,
+                              content_type='application/octet-stream',
+                              generation=123)
+_MUTABLE_PATH = 'gs://bucket/eve-release/LATEST-master'
+_IMMUTABLE_PATH = 'gs://bucket/eve-release/R80-12739.0.0/image.zip'
+
+
+class StatCacheTest(unittest.TestCase):
+  """Tests of StatCache."""
+
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.db_path = os.path.join(self.tempdir, 'stats.db')
+    self.cache = stat_cache.StatCache(self.db_path, ttl=300, negative_ttl=60)
+    self.stat_func = mock.MagicMock(return_value=_STAT)
+    time_patcher = mock.patch('time.time', return_value=1000.0)
+    self.time = time_patcher.start()
+    self.addCleanup(time_patcher.stop)
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def test_ttl(self):
+    """Test metadata of mutable objects expires after the TTL."""
+    self.assertEqual(self.cache.stat(_MUTABLE_PATH, self.stat_func), _STAT)
+    self.time.return_value += 299
+    self.assertEqual(self.cache.stat(_MUTABLE_PATH, self.stat_func), _STAT)
+    self.assertEqual(self.stat_func.call_count, 1)
+    self.time.return_value += 1
+    self.cache.stat(_MUTABLE_PATH, self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 2)
+
+  def test_immutable(self):
+    """Test metadata of versioned build paths never expires."""
+    self.cache.stat(_IMMUTABLE_PATH, self.stat_func)
+    self.time.return_value += 365 * 24 * 60 * 60
+    self.assertEqual(self.cache.stat(_IMMUTABLE_PATH, self.stat_func), _STAT)
+    self.assertEqual(self.stat_func.call_count, 1)
+
+  def test_negative(self):
+    """Test objects not found are cached for the negative TTL."""
+    self.stat_func.side_effect = gs.GSNoSuchKey('error')
+    for _ in range(2):
+      with self.assertRaises(gs.GSNoSuchKey):
+        self.cache.stat(_IMMUTABLE_PATH, self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 1)
+
+    self.time.return_value += 60
+    self.stat_func.side_effect = None
+    self.assertEqual(self.cache.stat(_IMMUTABLE_PATH, self.stat_func), _STAT)
+
+  def test_db(self):
+    """Test metadata is kept in the database across instances."""
+    self.cache.stat(_IMMUTABLE_PATH, self.stat_func)
+    self.stat_func.side_effect = gs.GSNoSuchKey('error')
+    with self.assertRaises(gs.GSNoSuchKey):
+      self.cache.stat(_MUTABLE_PATH, self.stat_func)
+
+    cache = stat_cache.StatCache(self.db_path)
+    self.assertEqual(cache.stat(_IMMUTABLE_PATH, self.stat_func), _STAT)
+    with self.assertRaises(gs.GSNoSuchKey):
+      cache.stat(_MUTABLE_PATH, self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 2)
+
+  def test_invalidate(self):
+    """Test invalidating the metadata of an object."""
+    self.cache.stat(_IMMUTABLE_PATH, self.stat_func)
+    self.cache.invalidate(_IMMUTABLE_PATH)
+    self.cache.stat(_IMMUTABLE_PATH, self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 2)
+
+  def test_max_entries(self):
+    """Test the least recently used entries are dropped beyond the limit."""
+    cache = stat_cache.StatCache(max_entries=2)
+    for path in ('gs://b/1', 'gs://b/2', 'gs://b/1', 'gs://b/3', 'gs://b/1'):
+      cache.stat(path, self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 3)
+    cache.stat('gs://b/2', self.stat_func)
+    self.assertEqual(self.stat_func.call_count, 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -9,34 +9,95 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import gzip
 import os
+import shutil
 import StringIO
 import subprocess
 import tarfile
+import tempfile
 import unittest
 
 import tarfile_utils
 
 
+def _make_tar(members, tar_format=tarfile.GNU_FORMAT):
+  """Make a tar archive in memory.
+
+  Args:
+    members: A list of (name, content) tuples. A name ends with '/' is a
+      directory, and a content of tuple ('->', target) is a symbolic link.
+    tar_format: The format of the archive.
+
+  Returns:
+    The content of the tar archive.
+  """
+  tar_file = StringIO.StringIO()
+  tar = tarfile.open(fileobj=tar_file, mode='w', format=tar_format)
+  for name, content in members:
+    info = tarfile.TarInfo(name)
+    if name.endswith('/'):
+      info.type = tarfile.DIRTYPE
+      tar.addfile(info)
+    elif isinstance(content, tuple):
+      info.type = tarfile.SYMTYPE
+      info.linkname = content[1]
+      tar.addfile(info)
+    else:
+      info.size = len(content)
+      tar.addfile(info, StringIO.StringIO(content))
+  tar.close()
+  return tar_file.getvalue()
+
+
+def _in_chunks(data, size):
+  """Split |data| into chunks of |size|."""
+  return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
 class TarfileUtilsTest(unittest.TestCase):
   """Tests of tarfile_utils."""
 
+  def _verify_members(self, tar_content, members):
+    """Verify the listed |members| against Python tarfile module."""
+    tar = tarfile.open(fileobj=StringIO.StringIO(tar_content))
+    tar_infos = tar.getmembers()
+    self.assertEqual(len(tar_infos), len(members))
+    for tar_info, result in zip(tar_infos, members):
+      if tar_info.isdir():
+        name = '%s/' % tar_info.name
+      elif tar_info.issym():
+        name = '%s -> %s' % (tar_info.name, tar_info.linkname)
+      elif tar_info.islnk():
+        name = '%s link to %s' % (tar_info.name, tar_info.linkname)
+      else:
+        name = tar_info.name
+
+      self.assertEqual(name, result.filename)
+      self.assertEqual(tar_info.offset_data, result.content_start)
+      self.assertEqual(tar_info.size, result.size)
+      self.assertEqual(
+          tar_content[result.content_start:result.content_start + result.size],
+          tar.extractfile(tar_info).read() if tar_info.isreg() else '')
+
+    # Records are next to each other.
+    for prev, cur in zip(members, members[1:]):
+      self.assertEqual(prev.record_start + prev.record_size, cur.record_start)
+
   def test_list_tar_members_empty_file(self):
     """Test listing file member of an empty tar."""
-    tar_tvR = StringIO.StringIO('block 0: ** Block of NULs **\n')
-    self.assertFalse(list(tarfile_utils.list_tar_members(tar_tvR)))
+    self.assertFalse(list(tarfile_utils.list_tar_members(['\0' * 10240])))
+    self.assertFalse(list(tarfile_utils.list_tar_members([])))
 
   def test_list_tar_members_non_empty_file(self):
     """Test listing file member of an non-empty tar."""
-    tar_tvR = StringIO.StringIO(
-        'block 0: mode owner 1 date hour:min\tfilename\n'
-        'block 2: mode owner 123 date hour:min\tfile name with spaces\n'
-        'block 4: mode owner 0 date hour:min\tdirectory/\n'
-        'block 5: mode owner 0 date hour:min\tdirectory/symbol link -> filename'
-        '\n'
-        'block 6: ** Block of NULs **\n'
-    )
-    result = list(tarfile_utils.list_tar_members(tar_tvR))
+    tar_content = _make_tar([
+        ('filename', 'a'),
+        ('file name with spaces', 'b' * 123),
+        ('directory/', None),
+        ('directory/symbol link', ('->', 'filename')),
+    ])
+    result = list(tarfile_utils.list_tar_members([tar_content]))
     self.assertEqual(result, [
         ('filename', 0, 1024, 512, 1),
         ('file name with spaces', 512 * 2, 1024, 512 * 3, 123),
@@ -44,27 +105,103 @@ class TarfileUtilsTest(unittest.TestCase):
         ('directory/symbol link -> filename', 512 * 5, 512, 512 * 6, 0)
     ])
 
+  def test_list_tar_members_in_small_chunks(self):
+    """Test the result doesn't depend on how the archive is chunked."""
+    tar_content = _make_tar([('foo', 'x' * 1000), ('a' * 200, 'y' * 10),
+                             ('bar', '')])
+    expected = list(tarfile_utils.list_tar_members([tar_content]))
+    for size in (1, 7, 511, 512, 513, 4096):
+      self.assertEqual(
+          list(tarfile_utils.list_tar_members(_in_chunks(tar_content, size))),
+          expected)
+
+  def test_list_tar_members_special_file_names(self):
+    """Test file names with characters which are special to `tar tv`."""
+    members = [('with:colon', 'a'), ('with\ttab', 'b'), ('with\nnew line', ''),
+               ('with,comma -> arrow', 'c')]
+    tar_content = _make_tar(members)
+    self.assertEqual(
+        [m.filename for m in tarfile_utils.list_tar_members([tar_content])],
+        [name for name, _ in members])
+
+  def test_list_tar_members_long_names(self):
+    """Test GNU longname/longlink and PAX extended headers."""
+    long_name = 'dir/' * 50 + 'file'
+    long_target = 'target/' * 30
+    for tar_format in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+      tar_content = _make_tar([('foo', 'x'), (long_name, 'y' * 1000),
+                               ('link', ('->', long_target)), ('bar', 'z')],
+                              tar_format=tar_format)
+      members = list(tarfile_utils.list_tar_members([tar_content]))
+      self._verify_members(tar_content, members)
+      self.assertEqual(members[1].filename, long_name)
+      # The record of a member covers all its extended headers.
+      self.assertGreater(members[1].content_start - members[1].record_start,
+                         512)
+
+  def test_list_tar_members_pax_global_header(self):
+    """Test PAX global header isn't listed as a member."""
+    tar_file = StringIO.StringIO()
+    tar = tarfile.open(fileobj=tar_file, mode='w', format=tarfile.PAX_FORMAT,
+                       pax_headers={'comment': 'foo'})
+    info = tarfile.TarInfo('foo')
+    info.size = 3
+    tar.addfile(info, StringIO.StringIO('foo'))
+    tar.close()
+    members = list(tarfile_utils.list_tar_members([tar_file.getvalue()]))
+    self.assertEqual([m.filename for m in members], ['foo'])
+    self.assertEqual(members[0].record_start, 0)
+
+  def test_list_tar_members_bad_format(self):
+    """Test listing members of a non-tar file."""
+    with self.assertRaises(tarfile_utils.FormatError):
+      list(tarfile_utils.list_tar_members(['x' * 1024]))
+
+  def test_list_tar_members_truncated(self):
+    """Test listing members of a truncated tar."""
+    tar_content = _make_tar([('foo', 'x' * 1000)])
+    with self.assertRaises(tarfile_utils.FormatError):
+      list(tarfile_utils.list_tar_members([tar_content[:700]]))
+
   def test_list_tar_member_with_real_tar_file(self):
     """Using a real tar file to test listing tar member."""
     tar_name = os.path.join(os.path.dirname(__file__),
                             'index_tar_member_testing.tgz')
-    tar_tvR = StringIO.StringIO(
-        subprocess.check_output(['tar', 'tvRzf', tar_name]))
-    members = tarfile_utils.list_tar_members(tar_tvR)
-    with tarfile.open(tar_name, 'r:gz') as tar:
-      for tar_info, result in zip(tar, members):
-        if tar_info.isreg():
-          name = tar_info.name
-
-        if tar_info.isdir():
-          name = '%s/' % tar_info.name
-
-        if tar_info.issym():
-          name = '%s -> %s' % (tar_info.name, tar_info.linkname)
-
-        self.assertEqual(name, result.filename)
-        self.assertEqual(tar_info.offset_data, result.content_start)
-        self.assertEqual(tar_info.size, result.size)
+    with gzip.open(tar_name) as f:
+      tar_content = f.read()
+    self._verify_members(
+        tar_content, list(tarfile_utils.list_tar_members([tar_content])))
+
+  def test_list_tar_member_sparse_files(self):
+    """Test listing sparse files archived by GNU tar in all formats."""
+    tempdir = tempfile.mkdtemp()
+    try:
+      with open(os.path.join(tempdir, 'sparse'), 'w') as f:
+        for _ in range(100):
+          f.write('data')
+          f.seek(1024 * 1024, os.SEEK_CUR)
+      with open(os.path.join(tempdir, 'regular'), 'w') as f:
+        f.write('regular')
+
+      for options in (['--format=gnu'],
+                      ['--format=pax', '--sparse-version=0.1'],
+                      ['--format=pax', '--sparse-version=1.0']):
+        tar_content = subprocess.check_output(
+            ['tar', 'c', '--sparse', '-C', tempdir] + options +
+            ['sparse', 'regular'])
+        sparse, regular = tarfile_utils.list_tar_members(
+            _in_chunks(tar_content, 1000))
+        self.assertEqual(sparse.filename, 'sparse')
+        self.assertEqual(
+            tar_content[sparse.content_start:sparse.content_start + 4], 'data')
+        self.assertEqual(sparse.record_start + sparse.record_size,
+                         regular.record_start)
+        self.assertEqual(regular.filename, 'regular')
+        self.assertEqual(
+            tar_content[regular.content_start:
+                        regular.content_start + regular.size], 'regular')
+    finally:
+      shutil.rmtree(tempdir)
 
 
 if __name__ == '__main__':
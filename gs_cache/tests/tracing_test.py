@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Tests for tracing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import mock
+
+import tracing
+
+
+class TracingTest(unittest.TestCase):
+  """Tests of tracing."""
+
+  def setUp(self):
+    patcher = mock.patch.object(tracing.time, 'time')
+    self.time = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.time.return_value = 100
+
+  def test_spans(self):
+    """Test spans of the same name are summed up."""
+    trace = tracing.Trace('extract')
+    with trace.span('stat'):
+      self.time.return_value += 0.5
+    for _ in range(2):
+      with trace.span('range_request'):
+        self.time.return_value += 1
+    self.assertEqual(trace.spans(), [('stat', 0.5, 1),
+                                     ('range_request', 2, 2)])
+    self.assertEqual(trace.server_timing(),
+                     'stat;dur=500.0, range_request;dur=2000.0;desc="x2"')
+
+  def test_time_to_first_chunk(self):
+    """Test the span ends at the first chunk."""
+    trace = tracing.Trace('download')
+
+    def chunks():
+      self.time.return_value += 2
+      yield 'foo'
+      self.time.return_value += 10
+      yield 'bar'
+
+    content = tracing.time_to_first_chunk(trace, 'gs_first_byte', chunks())
+    self.assertEqual(''.join(content), 'foobar')
+    self.assertEqual(trace.spans(), [('gs_first_byte', 2, 1)])
+
+  def test_trace_content(self):
+    """Test the stream span is added once the content is streamed."""
+    trace = tracing.Trace('download')
+    done = mock.MagicMock()
+    content = tracing.trace_content(iter(['foo', 'bar']), trace, done)
+    self.time.return_value += 3
+    self.assertFalse(done.called)
+    self.assertEqual(''.join(content), 'foobar')
+    done.assert_called_once_with()
+    self.assertEqual(trace.spans(), [(tracing.STREAM, 3, 1)])
+
+    # Closed before streamed.
+    done.reset_mock()
+    tracing.trace_content(iter(['foo']), trace, done).close()
+    done.assert_called_once_with()
+
+    # Strings are done at once.
+    done.reset_mock()
+    self.assertEqual(tracing.trace_content('{}', trace, done), '{}')
+    done.assert_called_once_with()
+
+  def test_stats(self):
+    """Test the spans of traces are added to the histograms."""
+    stats = tracing.Stats()
+    trace = tracing.Trace('extract')
+    trace.add('stat', 0.003)
+    self.time.return_value += 0.15
+    stats.record(trace, 200)
+    stats.record(tracing.Trace('extract'), 404)
+
+    result = stats.to_dict()['extract']
+    self.assertEqual(result['statuses'], {'200': 1, '404': 1})
+    self.assertEqual(result['spans']['stat']['count'], 1)
+    self.assertIn([5, 1], result['spans']['stat']['buckets'])
+    self.assertEqual(result['spans'][tracing.TOTAL]['count'], 2)
+    self.assertIn([1, 1], result['spans'][tracing.TOTAL]['buckets'])
+    self.assertIn([200, 1], result['spans'][tracing.TOTAL]['buckets'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Timing of the phases of requests.
+
+A Trace collects the spans of a request, e.g. stat the object, wait for the
+first byte from GS, decompress, list tar members, fetch ranges and stream the
+response. Spans of the same name, e.g. concurrent range fetches, are summed
+up. The spans finished before the response is sent are reported by the
+header Server-Timing, and all spans are added to the histograms of Stats once
+the request is done.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+import closing_content
+
+# The upper bounds of the buckets of histograms, in milliseconds.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+              30000, 60000, float('inf'))
+
+# The span of a whole request.
+TOTAL = 'total'
+# The span of streaming the response.
+STREAM = 'stream'
+
+
+class Trace(object):
+  """The spans of a request."""
+
+  def __init__(self, name):
+    """Constructor.
+
+    Args:
+      name: The name of the request, usually the RPC name.
+    """
+    self.name = name
+    self._start = time.time()
+    self._lock = threading.Lock()
+    # Span name => [total seconds, count], in the order of first finished.
+    self._spans = collections.OrderedDict()
+
+  def add(self, name, seconds):
+    """Add a span of |name| lasting |seconds|."""
+    with self._lock:
+      span = self._spans.setdefault(name, [0, 0])
+      span[0] += seconds
+      span[1] += 1
+
+  @contextlib.contextmanager
+  def span(self, name):
+    """A context of a span of |name|."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - start)
+
+  def elapsed(self):
+    """Get the seconds since the request began."""
+    return time.time() - self._start
+
+  def spans(self):
+    """Get a list of (span name, total seconds, count) tuples."""
+    with self._lock:
+      return [(name, seconds, count)
+              for name, (seconds, count) in self._spans.iteritems()]
+
+  def server_timing(self):
+    """Format the finished spans as the value of header Server-Timing.
+
+    Examples:
+      >>> trace = Trace('extract')
+      >>> trace.add('stat', 0.0123)
+      >>> trace.add('range', 0.1)
+      >>> trace.add('range', 0.2)
+      >>> trace.server_timing()
+      'stat;dur=12.3, range;dur=300.0;desc="x2"'
+    """
+    metrics = []
+    for name, seconds, count in self.spans():
+      metric = '%s;dur=%.1f' % (name, seconds * 1000)
+      if count > 1:
+        metric += ';desc="x%d"' % count
+      metrics.append(metric)
+    return ', '.join(metrics)
+
+
+def time_to_first_chunk(trace, name, chunks):
+  """Add a span of |name| from now to the first chunk of |chunks|.
+
+  Args:
+    trace: The Trace to add the span.
+    name: The name of the span.
+    chunks: An iterable of chunks, which is usually lazy.
+
+  Returns:
+    An iterator of the chunks.
+  """
+  start = time.time()
+  iterator = iter(chunks)
+
+  def timed_chunks():
+    try:
+      chunk = next(iterator)
+    except StopIteration:
+      return
+    finally:
+      trace.add(name, time.time() - start)
+    try:
+      yield chunk
+      for chunk in iterator:
+        yield chunk
+    finally:
+      if hasattr(iterator, 'close'):
+        iterator.close()
+
+  return timed_chunks()
+
+
+def trace_content(content, trace, on_done):
+  """Add a span of streaming the response content.
+
+  Args:
+    content: The response content, either a string, an iterable of strings or
+      None.
+    trace: The Trace of the request.
+    on_done: A function called once the content is streamed or closed.
+
+  Returns:
+    The content, which is wrapped if it's an iterable.
+  """
+  if content is None or isinstance(content, basestring):
+    on_done()
+    return content
+
+  start = time.time()
+
+  def on_close():
+    trace.add(STREAM, time.time() - start)
+    on_done()
+
+  return closing_content.ClosingContent(content, on_close)
+
+
+class NullTrace(object):
+  """A trace which drops all spans, for work out of a request."""
+
+  name = None
+
+  def add(self, name, seconds):
+    pass
+
+  @contextlib.contextmanager
+  def span(self, _):
+    yield
+
+
+class _Histogram(object):
+  """A histogram of durations."""
+
+  def __init__(self):
+    self.buckets = [0] * len(BUCKETS_MS)
+    self.count = 0
+    self.sum_ms = 0
+
+  def add(self, ms):
+    self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+    self.count += 1
+    self.sum_ms += ms
+
+  def to_dict(self):
+    return {
+        'count': self.count,
+        'sum_ms': self.sum_ms,
+        'buckets': [['+Inf' if b == float('inf') else b, n]
+                    for b, n in zip(BUCKETS_MS, self.buckets)],
+    }
+
+
+class Stats(object):
+  """The histograms of spans of finished requests."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Request name => span name => _Histogram.
+    self._histograms = collections.defaultdict(
+        lambda: collections.defaultdict(_Histogram))
+    # Request name => status => count.
+    self._statuses = collections.defaultdict(collections.Counter)
+
+  def record(self, trace, status=None):
+    """Add the spans of a finished |trace| to the histograms.
+
+    Args:
+      trace: A finished Trace.
+      status: The HTTP status of the request.
+    """
+    spans = trace.spans()
+    total = trace.elapsed()
+    with self._lock:
+      histograms = self._histograms[trace.name]
+      for name, seconds, _ in spans:
+        histograms[name].add(seconds * 1000)
+      histograms[TOTAL].add(total * 1000)
+      self._statuses[trace.name][str(status)] += 1
+
+  def to_dict(self):
+    """Get the histograms as a dict.
+
+    Returns:
+      A dict of request name => a dict of:
+        statuses: HTTP status => the number of requests.
+        spans: span name => a dict of count, sum_ms and buckets, which is a
+          list of [upper bound in ms, count] pairs.
+    """
+    with self._lock:
+      return {
+          name: {
+              'statuses': dict(self._statuses[name]),
+              'spans': {span: h.to_dict() for span, h in spans.iteritems()},
+          } for name, spans in self._histograms.iteritems()
+      }
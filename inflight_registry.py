@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Collapse concurrent downloads of the same artifact into one.
+
+Test schedulers often stage the same artifacts of a build within seconds of
+each other, in calls of different sets of artifacts. Each call used to go
+through the downloader, and contended on the file locks of the artifacts only
+to find them staged by another call. The registry keeps a flight per
+artifact being downloaded. Later callers of the same artifact wait for the
+flight instead of downloading it again, and get the same result or error.
+
+A flight is forgotten once done, so a failed artifact is retried by the next
+caller. The time spent waiting for flights is kept as metrics.
+
+The first item of a tuple key is its group, e.g. the build. A group can be
+held exclusively, e.g. to remove the files of the build. Holding it waits for
+the running flights of the group, and new flights of the group wait until it
+is released.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import sys
+import threading
+import time
+
+import six
+
+
+class _Flight(object):
+  """A download in progress."""
+
+  def __init__(self):
+    self.started = time.time()
+    self.waiters = 0
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+
+  def finish(self, result=None, exc_info=None):
+    """Set the outcome of the flight and wake up the waiters."""
+    self._result = result
+    self._exc_info = exc_info
+    self._done.set()
+
+  def wait(self):
+    """Wait until the flight is done.
+
+    Returns:
+      The result of the download.
+
+    Raises:
+      The exception raised by the download if it failed.
+    """
+    self._done.wait()
+    if self._exc_info:
+      six.reraise(*self._exc_info)
+    return self._result
+
+
+class InFlightRegistry(object):
+  """The registry of in-flight downloads, keyed by what is downloaded."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._changed = threading.Condition(self._lock)
+    # Key => _Flight.
+    self._flights = {}
+    # Groups held exclusively.
+    self._exclusive = set()
+    self._started = 0
+    self._joined = 0
+    self._wait_seconds = 0.0
+    self._max_wait_seconds = 0.0
+
+  def run(self, key, func, *args):
+    """Run |func|, or wait for the flight of |key| running it.
+
+    Args:
+      key: The key of what is downloaded, e.g. (build, artifact).
+      func: The function downloading it, which is called in the calling
+        thread only if there isn't a flight of |key|.
+      *args: The arguments of |func|.
+
+    Returns:
+      The return value of |func|, which may be run by another caller.
+
+    Raises:
+      The exception raised by |func|, which may be run by another caller.
+    """
+    with self._lock:
+      while _group(key) in self._exclusive:
+        self._changed.wait()
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight()
+        self._started += 1
+      else:
+        flight.waiters += 1
+        self._joined += 1
+
+    if not leader:
+      return self._wait(flight)
+
+    try:
+      result = func(*args)
+    except Exception:  # pylint: disable=broad-except
+      exc_info = sys.exc_info()
+      self._forget(key, flight)
+      flight.finish(exc_info=exc_info)
+      six.reraise(*exc_info)
+    self._forget(key, flight)
+    flight.finish(result=result)
+    return result
+
+  def _forget(self, key, flight):
+    with self._lock:
+      if self._flights.get(key) is flight:
+        del self._flights[key]
+        self._changed.notify_all()
+
+  @contextlib.contextmanager
+  def exclusive(self, group):
+    """Hold |group| exclusively while in the context.
+
+    Args:
+      group: The group of keys, i.e. the first item of them.
+    """
+    with self._lock:
+      while group in self._exclusive or any(
+          _group(key) == group for key in self._flights):
+        self._changed.wait()
+      self._exclusive.add(group)
+    try:
+      yield
+    finally:
+      with self._lock:
+        self._exclusive.discard(group)
+        self._changed.notify_all()
+
+  def _wait(self, flight):
+    """Wait for |flight| and account the wait time."""
+    start = time.time()
+    try:
+      return flight.wait()
+    finally:
+      seconds = time.time() - start
+      with self._lock:
+        self._wait_seconds += seconds
+        self._max_wait_seconds = max(self._max_wait_seconds, seconds)
+
+  def status(self):
+    """Get the metrics of the registry.
+
+    Returns:
+      A dict of:
+        in_flight: A list of dicts of key, waiters and elapsed seconds of the
+          flights.
+        started: The number of downloads run.
+        joined: The number of callers waiting for a flight instead of
+          downloading.
+        wait_seconds_total, wait_seconds_max: The total and the max seconds
+          of the callers waiting for flights.
+    """
+    now = time.time()
+    with self._lock:
+      return {
+          'in_flight': [{'key': list(key) if isinstance(key, tuple) else key,
+                         'waiters': f.waiters,
+                         'elapsed': now - f.started}
+                        for key, f in six.iteritems(self._flights)],
+          'started': self._started,
+          'joined': self._joined,
+          'wait_seconds_total': self._wait_seconds,
+          'wait_seconds_max': self._max_wait_seconds,
+      }
+
+
+def _group(key):
+  """Get the group of |key|, which is None if it isn't a tuple."""
+  return key[0] if isinstance(key, tuple) else None
@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for inflight_registry.py"""
+
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import inflight_registry
+
+
+class InFlightRegistryTest(unittest.TestCase):
+  """Tests the registry of in-flight downloads."""
+
+  def setUp(self):
+    self.registry = inflight_registry.InFlightRegistry()
+    self.release = threading.Event()
+    self.running = threading.Event()
+    self.calls = []
+
+  def _Download(self, name):
+    self.calls.append(name)
+    self.running.set()
+    self.release.wait()
+    if name == 'bad':
+      raise ValueError('bad artifact')
+    return name
+
+  def _RunConcurrently(self, key, names):
+    """Run downloads of |names| concurrently, the first one as the leader."""
+    results = {}
+
+    def run(name):
+      try:
+        results[name] = self.registry.run(key, self._Download, name)
+      except ValueError as e:
+        results[name] = e
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in names]
+    threads[0].start()
+    self.running.wait()
+    for thread in threads[1:]:
+      thread.start()
+    while self.registry.status()['joined'] < len(names) - 1:
+      time.sleep(0.01)
+    self.release.set()
+    for thread in threads:
+      thread.join()
+    return results
+
+  def testJoinFlight(self):
+    results = self._RunConcurrently('key', ['first', 'second', 'third'])
+    self.assertEqual(self.calls, ['first'])
+    self.assertEqual(results, {'first': 'first', 'second': 'first',
+                               'third': 'first'})
+    status = self.registry.status()
+    self.assertEqual(status['started'], 1)
+    self.assertEqual(status['joined'], 2)
+    self.assertEqual(status['in_flight'], [])
+    self.assertGreater(status['wait_seconds_total'], 0)
+    self.assertGreater(status['wait_seconds_max'], 0)
+
+  def testShareError(self):
+    results = self._RunConcurrently('key', ['bad', 'good'])
+    self.assertEqual(self.calls, ['bad'])
+    self.assertIs(results['bad'], results['good'])
+
+    # A failed flight is forgotten and retried.
+    self.assertEqual(self.registry.run('key', self._Download, 'good'), 'good')
+    self.assertEqual(self.calls, ['bad', 'good'])
+
+  def testDifferentKeys(self):
+    self.release.set()
+    self.assertEqual(self.registry.run(('build', 'a'), self._Download, 'a'),
+                     'a')
+    self.assertEqual(self.registry.run(('build', 'b'), self._Download, 'b'),
+                     'b')
+    self.assertEqual(self.calls, ['a', 'b'])
+    self.assertEqual(self.registry.status()['joined'], 0)
+
+  def testExclusiveWaitsForFlights(self):
+    download = threading.Thread(
+        target=self.registry.run, args=(('build', 'a'), self._Download, 'a'))
+    download.start()
+    self.running.wait()
+    held = threading.Event()
+
+    def clean():
+      with self.registry.exclusive('build'):
+        held.set()
+
+    cleaner = threading.Thread(target=clean)
+    cleaner.start()
+    # Another build isn't blocked.
+    self.assertEqual(self.registry.run(('other', 'a'), lambda: 'other'),
+                     'other')
+    self.assertFalse(held.wait(0.1))
+    self.release.set()
+    download.join()
+    cleaner.join()
+    self.assertTrue(held.is_set())
+
+  def testFlightsWaitForExclusive(self):
+    self.release.set()
+    started = []
+    with self.registry.exclusive('build'):
+      download = threading.Thread(
+          target=self.registry.run,
+          args=(('build', 'a'), started.append, 'a'))
+      download.start()
+      download.join(0.1)
+      self.assertEqual(started, [])
+    download.join()
+    self.assertEqual(started, ['a'])
+
+
+if __name__ == '__main__':
+  unittest.main()
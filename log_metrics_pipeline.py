@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Emit metrics of the sizes of responses in a web server log.
+
+The log is read in chunks from a pipe, e.g. the stdin piped by the web server.
+The sizes of responses are summed up in memory per metric and set of fields,
+and emitted once every flush window, so a busy server doesn't cost a metric
+update per request.
+
+It's shared by apache_log_metrics and gs_cache/nginx_access_log_metrics, which
+imports it by a symlink. Import it after setup_chromite, since it imports
+chromite.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import select
+import time
+
+from chromite.lib import cros_logging as logging
+from chromite.lib import metrics
+
+DEFAULT_FLUSH_INTERVAL_SECONDS = 60
+_READ_SIZE_BYTES = 64 * 1024
+
+
+class Aggregator(object):
+  """Sums up the sizes of responses per metric and set of fields."""
+
+  def __init__(self, classify):
+    """Constructor.
+
+    Args:
+      classify: A function of a line of the log, which returns a list of
+        (metric name, fields, size) tuples, where fields is a tuple of
+        (field name, value) pairs.
+    """
+    self._classify = classify
+    self.counts = collections.Counter()
+    self.lines = 0
+
+  def add_line(self, line):
+    """Add a line of the log."""
+    self.lines += 1
+    for metric_name, fields, size in self._classify(line):
+      self.counts[metric_name, fields] += size
+
+  def merge(self, counts, lines):
+    """Merge the |counts| of |lines| lines aggregated by another aggregator."""
+    self.counts.update(counts)
+    self.lines += lines
+
+  def flush(self):
+    """Emit the sums to the metrics and reset them."""
+    for (metric_name, fields), size in self.counts.iteritems():
+      metrics.Counter(metric_name).increment_by(size, fields=dict(fields))
+    logging.debug('Emitted %d metric updates of %d lines.', len(self.counts),
+                  self.lines)
+    self.counts.clear()
+    self.lines = 0
+
+
+def read_lines(fd, timeout):
+  """Read lines from file descriptor |fd| in chunks.
+
+  Args:
+    fd: The file descriptor to read.
+    timeout: The max seconds of waiting for new data.
+
+  Yields:
+    Lists of complete lines read. An empty list is yielded if no data comes in
+    |timeout| seconds.
+  """
+  pending = ''
+  while True:
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+      yield []
+      continue
+    data = os.read(fd, _READ_SIZE_BYTES)
+    if not data:
+      break
+    lines = (pending + data).split('\n')
+    pending = lines.pop()
+    yield lines
+  if pending:
+    yield [pending]
+
+
+def run(stream, aggregator, flush_interval=DEFAULT_FLUSH_INTERVAL_SECONDS):
+  """Emit the metrics of the log from |stream| every flush window.
+
+  Args:
+    stream: The file object of the log.
+    aggregator: The Aggregator of the lines.
+    flush_interval: The seconds of a flush window.
+  """
+  next_flush = time.time() + flush_interval
+  for lines in read_lines(stream.fileno(), flush_interval):
+    for line in lines:
+      aggregator.add_line(line)
+    if time.time() >= next_flush:
+      aggregator.flush()
+      next_flush = time.time() + flush_interval
+  aggregator.flush()
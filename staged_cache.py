@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An in-memory cache of the staged artifacts of builds.
+
+Lab schedulers poll `is_staged` heavily, and each call used to check the
+marker files of the artifacts on disk. The cache remembers the artifacts
+known to be staged in each build directory, once staging completes or the
+disk says so, and the listing of the directory for `list_image_dir`.
+
+Entries are invalidated by inotify events of the build directories if
+pyinotify is installed: removing anything from a directory forgets its
+staged artifacts, and any change forgets its listing. All entries are
+forgotten if the kernel drops events. Otherwise, or for directories which
+can't be watched, e.g. the limit of inotify watches is reached, an entry is
+valid as long as the mtime of the directory is unchanged, which costs a stat
+per lookup instead of a check per artifact.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+
+try:
+  import pyinotify  # pylint: disable=import-error
+except ImportError:
+  # pyinotify isn't installed everywhere the devserver runs, e.g. lakitu.
+  # Entries are validated by the mtime of the build directories then.
+  pyinotify = None
+
+import setup_chromite  # pylint: disable=unused-import
+from chromite.lib.xbuddy import cherrypy_log_util
+
+
+def _Log(message, *args):
+  """Module-local log function."""
+  return cherrypy_log_util.LogWithTag('STAGED_CACHE', message, *args)
+
+
+class _Entry(object):
+  """The cached state of a build directory."""
+
+  def __init__(self, mtime=None):
+    self.mtime = mtime
+    self.staged = set()
+    self.listing = None
+
+
+class StagedCache(object):
+  """The cache of staged artifacts, keyed by build directories."""
+
+  def __init__(self, use_inotify=True):
+    """Constructor.
+
+    Args:
+      use_inotify: Whether to invalidate entries by inotify events. It's
+        ignored if pyinotify isn't installed.
+    """
+    self._lock = threading.Lock()
+    # Build directory => _Entry.
+    self._entries = {}
+    # Build directory => inotify watch descriptor, and the reverse.
+    self._watches = {}
+    self._watched_dirs = {}
+    self._watch_manager = None
+    self._watch_failed = False
+    if not (use_inotify and pyinotify):
+      return
+
+    self._watch_manager = pyinotify.WatchManager()
+    self._removal_mask = (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                          pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+    self._gone_mask = (pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF |
+                       pyinotify.IN_IGNORED)
+    self._watch_mask = (self._removal_mask | pyinotify.IN_CREATE |
+                        pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+    notifier = pyinotify.ThreadedNotifier(self._watch_manager,
+                                          self._handle_event)
+    notifier.daemon = True
+    notifier.start()
+
+  def _handle_event(self, event):
+    """Invalidate the entry of the build directory of inotify |event|."""
+    with self._lock:
+      if event.mask & pyinotify.IN_Q_OVERFLOW:
+        # Events of any directory may be lost.
+        _Log('Inotify events overflowed, forgetting all staged artifacts')
+        self._entries.clear()
+        return
+      build_dir = self._watched_dirs.get(event.wd)
+      if build_dir is None:
+        return
+      if event.mask & self._gone_mask:
+        # The kernel drops the watch of a removed directory by itself.
+        self._unwatch(build_dir,
+                      remove_watch=bool(event.mask & pyinotify.IN_MOVE_SELF))
+      elif event.mask & self._removal_mask:
+        self._entries.pop(build_dir, None)
+      elif build_dir in self._entries:
+        self._entries[build_dir].listing = None
+
+  def _watch(self, build_dir):
+    """Watch |build_dir| if not watched. Called with the lock held.
+
+    Returns:
+      True if |build_dir| is watched.
+    """
+    if build_dir in self._watches:
+      return True
+    # Avoid the error logs of watching a directory not staged yet.
+    if not os.path.isdir(build_dir):
+      return False
+    wd = self._watch_manager.add_watch(build_dir, self._watch_mask,
+                                       quiet=True).get(build_dir, -1)
+    if wd < 0:
+      if not self._watch_failed:
+        self._watch_failed = True
+        _Log('Failed to watch %s, e.g. too many inotify watches. Unwatched '
+             'directories are validated by mtime instead.', build_dir)
+      return False
+    self._watches[build_dir] = wd
+    self._watched_dirs[wd] = build_dir
+    # Drop the entry validated by mtime before.
+    self._entries.pop(build_dir, None)
+    return True
+
+  def _unwatch(self, build_dir, remove_watch):
+    """Stop watching |build_dir| and drop its entry."""
+    self._entries.pop(build_dir, None)
+    wd = self._watches.pop(build_dir, None)
+    if wd is not None:
+      del self._watched_dirs[wd]
+      if remove_watch:
+        self._watch_manager.rm_watch(wd, quiet=True)
+
+  def _get_entry(self, build_dir, create=False):
+    """Get the valid entry of |build_dir|. Called with the lock held.
+
+    Args:
+      build_dir: The build directory.
+      create: Whether to create the entry if it doesn't exist.
+
+    Returns:
+      The _Entry of |build_dir|, or None if it doesn't exist or can't be
+      validated later, e.g. the directory doesn't exist. Entries of
+      directories which can't be watched are validated by mtime.
+    """
+    if self._watch_manager and self._watch(build_dir):
+      entry = self._entries.get(build_dir)
+      if not entry and create:
+        entry = self._entries[build_dir] = _Entry()
+      return entry
+
+    try:
+      mtime = os.stat(build_dir).st_mtime
+    except OSError:
+      self._entries.pop(build_dir, None)
+      return None
+    entry = self._entries.get(build_dir)
+    if entry and entry.mtime != mtime:
+      entry = None
+      del self._entries[build_dir]
+    if not entry and create:
+      entry = self._entries[build_dir] = _Entry(mtime)
+    return entry
+
+  def is_staged(self, build_dir, names):
+    """Whether all artifacts |names| of |build_dir| are known to be staged.
+
+    False means unknown, which should be checked on disk.
+    """
+    with self._lock:
+      entry = self._get_entry(build_dir)
+      return bool(entry) and entry.staged.issuperset(names)
+
+  def mark_staged(self, build_dir, names):
+    """Remember that artifacts |names| of |build_dir| are staged."""
+    with self._lock:
+      entry = self._get_entry(build_dir, create=True)
+      if entry:
+        entry.staged.update(names)
+        entry.listing = None
+
+  def get_listing(self, build_dir):
+    """Get the cached listing of |build_dir|, or None if unknown."""
+    with self._lock:
+      entry = self._get_entry(build_dir)
+      return entry.listing if entry else None
+
+  def set_listing(self, build_dir, listing):
+    """Remember the listing of |build_dir|."""
+    with self._lock:
+      entry = self._get_entry(build_dir, create=True)
+      if entry:
+        entry.listing = listing
+
+  def invalidate(self, build_dir):
+    """Forget everything about |build_dir|, e.g. before it's removed."""
+    _Log('Invalidating the staged artifacts of %s', build_dir)
+    with self._lock:
+      self._entries.pop(build_dir, None)
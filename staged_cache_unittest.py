@@ -0,0 +1,129 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for staged_cache.py"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+import staged_cache
+
+
+class StagedCacheTest(unittest.TestCase):
+  """Tests the cache of staged artifacts validated by mtime."""
+
+  use_inotify = False
+
+  def setUp(self):
+    self.static_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.static_dir)
+    self.build_dir = os.path.join(self.static_dir, 'board-release', 'R1-1.0')
+    os.makedirs(self.build_dir)
+    self.cache = staged_cache.StagedCache(use_inotify=self.use_inotify)
+
+  def _Touch(self, name):
+    with open(os.path.join(self.build_dir, name), 'w'):
+      pass
+
+  def _ChangeDir(self, change):
+    """Apply |change| to the build dir, making sure its mtime changes."""
+    mtime = os.stat(self.build_dir).st_mtime
+    change()
+    os.utime(self.build_dir, (mtime + 1, mtime + 1))
+    self._WaitForEvents()
+
+  def _WaitForEvents(self):
+    pass
+
+  def testMarkStaged(self):
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+    self.cache.mark_staged(self.build_dir, ['autotest', 'test_suites'])
+    self.assertTrue(self.cache.is_staged(self.build_dir, ['autotest']))
+    self.assertTrue(self.cache.is_staged(self.build_dir,
+                                         ['autotest', 'test_suites']))
+    self.assertFalse(self.cache.is_staged(self.build_dir,
+                                          ['autotest', 'full_payload']))
+
+  def testInvalidate(self):
+    self.cache.mark_staged(self.build_dir, ['autotest'])
+    self.cache.invalidate(self.build_dir)
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+
+  def testRemovedFile(self):
+    self._Touch('.autotest')
+    self.cache.mark_staged(self.build_dir, ['autotest'])
+    self._ChangeDir(lambda: os.unlink(os.path.join(self.build_dir,
+                                                   '.autotest')))
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+
+  def testRemovedBuildDir(self):
+    self.cache.mark_staged(self.build_dir, ['autotest'])
+    shutil.rmtree(self.build_dir)
+    self._WaitForEvents()
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+    os.makedirs(self.build_dir)
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+
+  def testNonexistentBuildDir(self):
+    build_dir = os.path.join(self.static_dir, 'nonexistent')
+    self.cache.mark_staged(build_dir, ['autotest'])
+    self.assertFalse(self.cache.is_staged(build_dir, ['autotest']))
+
+  def testListing(self):
+    self.assertIsNone(self.cache.get_listing(self.build_dir))
+    self.cache.set_listing(self.build_dir, 'autotest')
+    self.assertEqual(self.cache.get_listing(self.build_dir), 'autotest')
+
+    self._ChangeDir(lambda: self._Touch('new_file'))
+    self.assertIsNone(self.cache.get_listing(self.build_dir))
+
+    self.cache.set_listing(self.build_dir, 'autotest')
+    self.cache.mark_staged(self.build_dir, ['full_payload'])
+    self.assertIsNone(self.cache.get_listing(self.build_dir))
+
+
+@unittest.skipUnless(staged_cache.pyinotify, 'pyinotify is not installed.')
+class InotifyStagedCacheTest(StagedCacheTest):
+  """Tests the cache of staged artifacts invalidated by inotify."""
+
+  use_inotify = True
+
+  def _WaitForEvents(self):
+    time.sleep(0.5)
+
+  def testNewFileKeepsStaged(self):
+    self.cache.mark_staged(self.build_dir, ['autotest'])
+    self._Touch('new_file')
+    self._WaitForEvents()
+    self.assertTrue(self.cache.is_staged(self.build_dir, ['autotest']))
+
+  def testEventsOverflow(self):
+    self.cache.mark_staged(self.build_dir, ['autotest'])
+    # pylint: disable=protected-access
+    self.cache._handle_event(mock.Mock(
+        wd=-1, mask=staged_cache.pyinotify.IN_Q_OVERFLOW))
+    self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+
+  def testWatchFailure(self):
+    # pylint: disable=protected-access
+    with mock.patch.object(self.cache._watch_manager, 'add_watch',
+                           return_value={self.build_dir: -1}):
+      self.cache.mark_staged(self.build_dir, ['autotest'])
+      self.assertTrue(self.cache.is_staged(self.build_dir, ['autotest']))
+      # The entry is validated by mtime instead.
+      self._ChangeDir(lambda: self._Touch('new_file'))
+      self.assertFalse(self.cache.is_staged(self.build_dir, ['autotest']))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A queue of jobs staging build artifacts.
+
+Staging used to run in the CherryPy request thread, so a burst of `stage`
+calls could take all threads of the server and block serving /static. Jobs
+are now run by a dedicated pool of worker threads. The queue is bounded, so
+the callers exceeding it are rejected at once instead of piling up.
+
+A job identical to a queued or running one, i.e. the same artifacts of the
+same build, isn't queued again. The caller gets the in-flight job instead. The
+states of recent jobs are kept to be queried by their IDs.
+
+Synchronous callers wait for their jobs in the request threads, so the number
+of waiting callers is bounded too, including those of identical jobs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import sys
+import threading
+import time
+import uuid
+
+import six
+from six.moves import queue
+
+import setup_chromite  # pylint: disable=unused-import
+from chromite.lib.xbuddy import cherrypy_log_util
+
+
+def _Log(message, *args):
+  """Module-local log function."""
+  return cherrypy_log_util.LogWithTag('STAGING', message, *args)
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_MAX_HISTORY = 1000
+DEFAULT_MAX_WAITERS = 50
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+  """Exception raised when too many jobs or callers are waiting."""
+
+
+class Job(object):
+  """A job staging artifacts."""
+
+  def __init__(self, key, func, args, description):
+    self.id = uuid.uuid4().hex
+    self.key = key
+    self.description = description
+    self.state = QUEUED
+    self.queued = time.time()
+    self.started = None
+    self.finished = None
+    self.error = None
+    self._func = func
+    self._args = args
+    self._exc_info = None
+    self._done = threading.Event()
+
+  def _run(self):
+    """Run the job. Called by a worker thread."""
+    self.started = time.time()
+    self.state = RUNNING
+    try:
+      self._func(*self._args)
+    except Exception as e:  # pylint: disable=broad-except
+      _Log('Failed to stage %s: %s', self.description, e)
+      self._exc_info = sys.exc_info()
+      self.error = str(e)
+      self.state = FAILED
+    else:
+      self.state = DONE
+    finally:
+      self.finished = time.time()
+      # Drop the references to the downloader and the artifacts.
+      self._func = self._args = None
+
+  def _finish(self):
+    """Wake up the waiters. Called once the job isn't in flight."""
+    self._done.set()
+
+  def wait(self):
+    """Wait until the job is finished.
+
+    Raises:
+      The exception raised by the job if it failed.
+    """
+    self._done.wait()
+    if self._exc_info:
+      six.reraise(*self._exc_info)
+
+  def to_dict(self):
+    """Get the state of the job as a dict."""
+    now = self.finished or time.time()
+    state = {
+        'id': self.id,
+        'description': self.description,
+        'state': self.state,
+        'queued': self.queued,
+        'started': self.started,
+        'finished': self.finished,
+        'elapsed': now - (self.started or self.queued),
+    }
+    if self.error:
+      state['error'] = self.error
+    return state
+
+
+class StagingQueue(object):
+  """A pool of workers running staging jobs."""
+
+  def __init__(self, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED,
+               max_history=DEFAULT_MAX_HISTORY,
+               max_waiters=DEFAULT_MAX_WAITERS):
+    """Constructor.
+
+    Args:
+      workers: The number of worker threads.
+      max_queued: The max number of jobs waiting for a worker.
+      max_history: The max number of jobs whose states are kept. The earliest
+        finished ones are dropped first.
+      max_waiters: The max number of callers waiting for jobs by `wait`.
+    """
+    self._workers = workers
+    self._max_history = max_history
+    self._max_waiters = max_waiters
+    self._waiters = 0
+    self._queue = queue.Queue(max_queued)
+    self._threads = []
+    # Job ID => Job, in the order of submitting.
+    self._jobs = collections.OrderedDict()
+    # Key => the queued or running Job.
+    self._in_flight = {}
+    self._lock = threading.Lock()
+
+  def _start_workers(self):
+    """Start the worker threads if not started. Called with the lock held."""
+    if self._threads:
+      return
+    for _ in range(self._workers):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def submit(self, key, func, args=(), description=None):
+    """Queue a job, unless an identical one is in flight.
+
+    Args:
+      key: A hashable key identifying identical jobs, e.g. the build and the
+        artifacts to stage.
+      func: The function of the job, which is called in a worker thread.
+      args: The arguments of |func|.
+      description: A readable description of the job. Default to str(key).
+
+    Returns:
+      The queued Job, or the in-flight one identical to it.
+
+    Raises:
+      QueueFullError if too many jobs are waiting.
+    """
+    with self._lock:
+      job = self._in_flight.get(key)
+      if job:
+        return job
+
+      self._start_workers()
+      job = Job(key, func, args, description or str(key))
+      try:
+        self._queue.put_nowait(job)
+      except queue.Full:
+        raise QueueFullError('Too many jobs (%d) are waiting to be staged.' %
+                             self._queue.qsize())
+      self._in_flight[key] = job
+      self._jobs[job.id] = job
+      self._drop_history()
+      return job
+
+  def _drop_history(self):
+    """Drop the earliest finished jobs beyond the limit."""
+    excess = len(self._jobs) - self._max_history
+    for job_id, job in list(self._jobs.items()):
+      if excess <= 0:
+        break
+      if job.state in (DONE, FAILED):
+        del self._jobs[job_id]
+        excess -= 1
+
+  def get_status(self, job_id=None, key=None):
+    """Get the state of a job by its ID, or of the latest job of |key|.
+
+    Returns:
+      A dict of the state of the job, see Job.to_dict. A queued job also has
+      queue_position, the number of jobs queued before it. None if the job is
+      unknown.
+    """
+    with self._lock:
+      if job_id is not None:
+        job = self._jobs.get(job_id)
+      else:
+        job = self._in_flight.get(key) or next(
+            (j for j in reversed(list(self._jobs.values())) if j.key == key),
+            None)
+      if not job:
+        return None
+      state = job.to_dict()
+      if job.state == QUEUED:
+        state['queue_position'] = sum(
+            1 for j in six.itervalues(self._in_flight)
+            if j.state == QUEUED and j.queued < job.queued)
+      return state
+
+  def wait(self, job):
+    """Wait until |job| is finished, unless too many callers are waiting.
+
+    Raises:
+      QueueFullError if too many callers are waiting for jobs.
+      The exception raised by the job if it failed.
+    """
+    with self._lock:
+      if self._waiters >= self._max_waiters:
+        raise QueueFullError('Too many (%d) callers are waiting for staging '
+                             'jobs.' % self._waiters)
+      self._waiters += 1
+    try:
+      job.wait()
+    finally:
+      with self._lock:
+        self._waiters -= 1
+
+  @property
+  def running_count(self):
+    """The number of running jobs."""
+    with self._lock:
+      return sum(1 for j in six.itervalues(self._in_flight)
+                 if j.state == RUNNING)
+
+  def status(self):
+    """Get the states of the queue and the kept jobs.
+
+    Returns:
+      A dict of:
+        workers: The number of worker threads.
+        queued, running: The number of queued or running jobs.
+        waiters: The number of callers waiting for jobs.
+        jobs: A list of dicts of the states of jobs, see Job.to_dict.
+    """
+    with self._lock:
+      states = collections.Counter(j.state for j in self._in_flight.values())
+      return {
+          'workers': self._workers,
+          'queued': states[QUEUED],
+          'running': states[RUNNING],
+          'waiters': self._waiters,
+          'jobs': [j.to_dict() for j in six.itervalues(self._jobs)],
+      }
+
+  def _work(self):
+    """The main loop of a worker thread."""
+    while True:
+      job = self._queue.get()
+      # pylint: disable=protected-access
+      try:
+        job._run()
+      finally:
+        with self._lock:
+          del self._in_flight[job.key]
+        job._finish()
+        self._queue.task_done()
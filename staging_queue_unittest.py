@@ -0,0 +1,117 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+# Copyright 2020 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for staging_queue.py"""
+
+from __future__ import print_function
+
+import threading
+import time
+import unittest
+
+import staging_queue
+
+
+class StagingQueueTest(unittest.TestCase):
+  """Tests the queue of staging jobs."""
+
+  def setUp(self):
+    self.release = threading.Event()
+    self.running = threading.Event()
+    self.calls = []
+
+  def _Stage(self, name):
+    self.calls.append(name)
+    self.running.set()
+    self.release.wait()
+    if name == 'bad':
+      raise ValueError('bad artifact')
+
+  def testRunJob(self):
+    queue = staging_queue.StagingQueue(workers=1)
+    self.release.set()
+    job = queue.submit('key', self._Stage, ('good',))
+    job.wait()
+    self.assertEqual(self.calls, ['good'])
+    status = queue.get_status(job_id=job.id)
+    self.assertEqual(status['state'], staging_queue.DONE)
+    self.assertEqual(status['description'], 'key')
+    self.assertEqual(queue.get_status(key='key'), status)
+
+  def testFailedJob(self):
+    queue = staging_queue.StagingQueue(workers=1)
+    self.release.set()
+    job = queue.submit('key', self._Stage, ('bad',))
+    with self.assertRaises(ValueError):
+      job.wait()
+    status = queue.get_status(job_id=job.id)
+    self.assertEqual(status['state'], staging_queue.FAILED)
+    self.assertEqual(status['error'], 'bad artifact')
+
+  def testDeduplicateInFlightJobs(self):
+    queue = staging_queue.StagingQueue(workers=1)
+    job = queue.submit('key', self._Stage, ('first',))
+    self.running.wait()
+    self.assertIs(queue.submit('key', self._Stage, ('second',)), job)
+    self.assertEqual(queue.running_count, 1)
+    self.release.set()
+    job.wait()
+    self.assertEqual(self.calls, ['first'])
+
+    # A finished job is staged again.
+    queue.submit('key', self._Stage, ('third',)).wait()
+    self.assertEqual(self.calls, ['first', 'third'])
+
+  def testQueueFull(self):
+    queue = staging_queue.StagingQueue(workers=1, max_queued=1)
+    running = queue.submit('a', self._Stage, ('a',))
+    self.running.wait()
+    queued = queue.submit('b', self._Stage, ('b',))
+    with self.assertRaises(staging_queue.QueueFullError):
+      queue.submit('c', self._Stage, ('c',))
+
+    self.assertEqual(queue.get_status(job_id=queued.id)['queue_position'], 0)
+    status = queue.status()
+    self.assertEqual(status['queued'], 1)
+    self.assertEqual(status['running'], 1)
+    self.assertEqual([j['id'] for j in status['jobs']],
+                     [running.id, queued.id])
+
+    self.release.set()
+    queued.wait()
+    self.assertEqual(self.calls, ['a', 'b'])
+
+  def testTooManyWaiters(self):
+    queue = staging_queue.StagingQueue(workers=1, max_waiters=1)
+    job = queue.submit('key', self._Stage, ('good',))
+    waiter = threading.Thread(target=queue.wait, args=(job,))
+    waiter.start()
+    self.running.wait()
+    while queue.status()['waiters'] < 1:
+      time.sleep(0.01)
+
+    # A caller of the identical job counts too.
+    with self.assertRaises(staging_queue.QueueFullError):
+      queue.wait(queue.submit('key', self._Stage, ('good',)))
+    self.release.set()
+    waiter.join()
+    queue.wait(job)
+    self.assertEqual(queue.status()['waiters'], 0)
+
+  def testDropHistory(self):
+    queue = staging_queue.StagingQueue(workers=1, max_history=2)
+    self.release.set()
+    jobs = []
+    for key in 'abc':
+      jobs.append(queue.submit(key, self._Stage, ('good',)))
+      jobs[-1].wait()
+    self.assertIsNone(queue.get_status(job_id=jobs[0].id))
+    self.assertEqual(
+        [j['id'] for j in queue.status()['jobs']], [j.id for j in jobs[1:]])
+
+
+if __name__ == '__main__':
+  unittest.main()